@@ -219,7 +219,7 @@ class DeleteBranches(models.Model, Queue):
             _deleter.info('✘ PR owner != FP target owner (%s)', repo_owner)
             return # probably don't have access to arbitrary repos
 
-        github = GH(token=repository.project_id.fp_github_token, repo=fp_remote)
+        github = GH(token=repository.project_id.fp_github_token, repo=fp_remote, dbname=self.env.cr.dbname)
         refurl = 'git/refs/heads/' + branch
         ref = github('get', refurl, check=False)
         if ref.status_code != 200:
@@ -7,7 +7,7 @@
     'website': "http://runbot.odoo.com",
     'category': 'Website',
     'version': '5.1',
-    'depends': ['base', 'base_automation', 'website'],
+    'depends': ['base', 'base_automation', 'website', 'runbot_github'],
     'data': [
         'templates/dockerfile.xml',
         'data/dockerfile_data.xml',
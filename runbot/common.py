@@ -1,10 +1,14 @@
 # -*- coding: utf-8 -*-
 
 import contextlib
+import hashlib
+import heapq
 import itertools
 import logging
+import math
 import psycopg2
 import re
+import select
 import socket
 import time
 import os
@@ -15,11 +19,13 @@ from datetime import timedelta
 from babel.dates import format_timedelta
 from werkzeug import utils
 
+from odoo import sql_db
 from odoo.tools.misc import DEFAULT_SERVER_DATETIME_FORMAT
 
 _logger = logging.getLogger(__name__)
 
 dest_reg = re.compile(r'^\d{5,}-.+$')
+DB_TEMPLATE_PREFIX = 'runbot-template-'  # installed databases kept by runbot.database.template
 
 
 class RunbotException(Exception):
@@ -120,6 +126,120 @@ def list_local_dbs(additionnal_conditions=None):
         return [d[0] for d in local_cr.fetchall()]
 
 
+def host_channel(host_name):
+    """ Name of the NOTIFY channel of a host, must match the one computed in runbot_build_notify trigger """
+    return 'runbot_host_%s' % hashlib.md5(host_name.encode()).hexdigest()[:16]
+
+
+class PgListener():
+    """ Wait for postgresql notifications on a dedicated autocommit connection.
+
+    Notifications sent by the connection with backend pid `ignore_pid` (usually
+    the cursor of the listening process itself) are discarded so that a process
+    is not woken up by its own writes.
+    """
+
+    def __init__(self, dbname, channels, ignore_pid=None):
+        self.dbname = dbname
+        self.channels = channels
+        self.ignore_pid = ignore_pid
+        self.cr = None
+
+    def _connect(self):
+        self.cr = sql_db.db_connect(self.dbname).cursor()
+        self.cr.autocommit(True)
+        for channel in self.channels:
+            self.cr.execute('LISTEN "%s"' % channel)
+
+    def close(self):
+        if self.cr:
+            try:
+                self.cr.close()
+            except psycopg2.Error:
+                pass
+        self.cr = None
+
+    def wait(self, timeout, interrupt=None):
+        """ Block until a notification is received, timeout is reached or interrupt is set.
+        Returns the list of channels that were notified.
+        """
+        end = time.time() + timeout
+        try:
+            if self.cr is None:
+                self._connect()
+            cnx = self.cr._cnx
+            while True:
+                remaining = end - time.time()
+                if remaining <= 0 or (interrupt and interrupt.is_set()):
+                    return []
+                # wake up at least every second to check interrupt
+                if select.select([cnx], [], [], min(remaining, 1)) == ([], [], []):
+                    continue
+                cnx.poll()
+                channels = {notify.channel for notify in cnx.notifies if notify.pid != self.ignore_pid}
+                del cnx.notifies[:]
+                if channels:
+                    return list(channels)
+        except (psycopg2.Error, OSError) as e:
+            _logger.warning('Listening on %s failed, falling back on sleep: %s', self.channels, e)
+            self.close()
+            remaining = max(end - time.time(), 0)
+            if interrupt:
+                interrupt.wait(remaining)
+            else:
+                time.sleep(remaining)
+            return []
+
+
+class PortAllocator():
+    """ Hand out port triples (odoo, longpolling, spare) of a host starting at `start`.
+
+    Released ports are reused lowest first, like the previous linear search did.
+    """
+
+    def __init__(self, start, used_ports=(), step=3):
+        self.start = start
+        self.step = step
+        self.used = {port for port in used_ports if port and port >= start and (port - start) % step == 0}
+        self.next = max(self.used) + step if self.used else start
+        self.free = [port for port in range(start, self.next, step) if port not in self.used]
+        heapq.heapify(self.free)
+        self.created = time.time()
+
+    def allocate(self):
+        port = heapq.heappop(self.free) if self.free else None
+        if port is None:
+            port = self.next
+            self.next += self.step
+        self.used.add(port)
+        return port
+
+    def release(self, port):
+        if port in self.used:
+            self.used.discard(port)
+            heapq.heappush(self.free, port)
+
+    def reserve(self, port):
+        """ Mark a released port as used again """
+        if port in self.used or port < self.start or (port - self.start) % self.step:
+            return
+        if port >= self.next:
+            self.free.extend(range(self.next, port, self.step))
+            self.next = port + self.step
+        else:
+            self.free.remove(port)
+        heapq.heapify(self.free)
+        self.used.add(port)
+
+
+def percentile(values, ratio):
+    """ Nearest rank percentile of values, ratio being between 0 and 1 """
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values), max(1, math.ceil(ratio * len(values)))) - 1]
+
+
 def pseudo_markdown(text):
     text = utils.escape(text)
 
@@ -9,15 +9,21 @@ When testing this file:
     The second parameter is the exposed port
 """
 import configparser
+import contextlib
 import io
 import json
 import logging
 import os
 import re
 import subprocess
+import threading
+import time
 
 
 _logger = logging.getLogger(__name__)
+# running containers names shared by docker_state callers inside a docker_cache context
+_containers_cache = {'enabled': False, 'running': None}
+_docker_calls = {'count': 0}
 DOCKERUSER = """
 RUN groupadd -g %(group_id)s odoo \\
 && useradd -u %(user_id)s -g odoo -G audio,video odoo \\
@@ -109,6 +115,7 @@ def _docker_build(build_dir, image_tag):
         df.write(DOCKERUSER)
     log_path = os.path.join(build_dir, 'docker_build.txt')
     logs = open(log_path, 'w')
+    _count_docker_call()
     dbuild = subprocess.Popen(['docker', 'build', '--tag', image_tag, '.'], stdout=logs, stderr=logs, cwd=build_dir)
     return dbuild.wait()
 
@@ -117,7 +124,7 @@ def docker_run(*args, **kwargs):
     return _docker_run(*args, **kwargs)
 
 
-def _docker_run(cmd=False, log_path=False, build_dir=False, container_name=False, image_tag=False, exposed_ports=None, cpu_limit=None, memory=None, preexec_fn=None, ro_volumes=None, env_variables=None):
+def _docker_run(cmd=False, log_path=False, build_dir=False, container_name=False, image_tag=False, exposed_ports=None, cpu_limit=None, memory=None, preexec_fn=None, ro_volumes=None, env_variables=None, cpus=None, rw_volumes=None):
     """Run tests in a docker container
     :param run_cmd: command string to run in container
     :param log_path: path to the logfile that will contain odoo stdout and stderr
@@ -127,7 +134,9 @@ def _docker_run(cmd=False, log_path=False, build_dir=False, container_name=False
     :param image_tag: Docker image tag name to select which docker image to use
     :param exposed_ports: if not None, starting at 8069, ports will be exposed as exposed_ports numbers
     :param memory: memory limit in bytes for the container
+    :param cpus: number of cpus the container can use
     :params ro_volumes: dict of dest:source volumes to mount readonly in builddir
+    :params rw_volumes: dict of dest:source volumes to mount read write in builddir
     :params env_variables: list of environment variables
     """
     assert cmd and log_path and build_dir and container_name
@@ -158,11 +167,19 @@ def _docker_run(cmd=False, log_path=False, build_dir=False, container_name=False
     if memory:
         docker_command.append('--memory=%s' % memory)
 
+    if cpus:
+        docker_command.append('--cpus=%s' % cpus)
+
     if ro_volumes:
         for dest, source in ro_volumes.items():
             logs.write("Adding readonly volume '%s' pointing to %s \n" % (dest, source))
             docker_command.append('--volume=%s:/data/build/%s:ro' % (source, dest))
 
+    if rw_volumes:
+        for dest, source in rw_volumes.items():
+            logs.write("Adding volume '%s' pointing to %s \n" % (dest, source))
+            docker_command.append('--volume=%s:/data/build/%s' % (source, dest))
+
     if env_variables:
         for var in env_variables:
             docker_command.append('-e=%s' % var)
@@ -182,7 +199,9 @@ def _docker_run(cmd=False, log_path=False, build_dir=False, container_name=False
     if cpu_limit:
         docker_command.extend(['--ulimit', 'cpu=%s' % int(cpu_limit)])
     docker_command.extend([image_tag, '/bin/bash', '-c', "%s" % run_cmd])
+    _count_docker_call()
     subprocess.Popen(docker_command, stdout=logs, stderr=logs, preexec_fn=preexec_fn, close_fds=False, cwd=build_dir)
+    _containers_cache['running'] = None  # the new container is not known yet
     _logger.info('Started Docker container %s', container_name)
     return
 
@@ -200,15 +219,155 @@ def _docker_stop(container_name, build_dir):
         subprocess.run(['touch', end_file])
     else:
         _logger.info('Stopping docker without defined build_dir')
+    _count_docker_call()
     subprocess.run(['docker', 'stop', container_name])
+    if _containers_cache['running'] is not None:
+        _containers_cache['running'].discard(container_name)
+
+
+def _count_docker_call():
+    _docker_calls['count'] += 1
+
+
+def docker_calls_count():
+    """Return the number of docker commands run by this process"""
+    return _docker_calls['count']
+
+
+@contextlib.contextmanager
+def docker_cache():
+    """Inside this context, running containers are listed with a single docker ps
+    shared by all docker_state, docker_is_running and docker_ps calls"""
+    _containers_cache['enabled'] = True
+    _containers_cache['running'] = None
+    try:
+        yield
+    finally:
+        _containers_cache['enabled'] = False
+        _containers_cache['running'] = None
+
+
+def _running_containers():
+    if not _containers_cache['enabled']:
+        return set(_docker_ps())
+    if _containers_cache['running'] is None:
+        _containers_cache['running'] = set(_docker_ps())
+    return _containers_cache['running']
 
 
 def docker_is_running(container_name):
     container_name = sanitize_container_name(container_name)
+    if _containers_cache['enabled']:
+        return container_name in _running_containers()
+    _count_docker_call()
     dinspect = subprocess.run(['docker', 'container', 'inspect', container_name], stderr=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
     return True if dinspect.returncode == 0 else False
 
 
+class DockerEventsWatcher(threading.Thread):
+    """Follow the docker events stream to know the state of containers without polling.
+
+    The last known state of each container is kept, start/die/oom events are queued
+    until they are consumed by the scheduler and the `wakeup` event is set when a
+    container dies.
+    """
+
+    def __init__(self, wakeup=None):
+        super().__init__(name='docker_events_watcher', daemon=True)
+        self.wakeup = wakeup
+        self.lock = threading.Lock()
+        self.states = {}
+        self.events = []
+        self.process = None
+        self.stopped = False
+
+    def run(self):
+        while not self.stopped:
+            try:
+                _count_docker_call()
+                self.process = subprocess.Popen(
+                    ['docker', 'events', '--filter', 'type=container', '--format', '{{json .}}'],
+                    stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+                )
+                for line in self.process.stdout:
+                    self._process_line(line)
+            except FileNotFoundError:
+                _logger.warning('Docker not found, stopping docker events watcher')
+                self.stopped = True
+            except Exception:
+                _logger.exception('Docker events watcher failed')
+            if not self.stopped:
+                # events may have been missed, forget states to fallback on marker files
+                with self.lock:
+                    self.states.clear()
+                time.sleep(5)
+
+    def stop(self):
+        self.stopped = True
+        if self.process:
+            self.process.terminate()
+
+    def _process_line(self, line):
+        try:
+            event = json.loads(line)
+        except ValueError:
+            return
+        action = event.get('Action') or event.get('status')
+        attributes = event.get('Actor', {}).get('Attributes', {})
+        name = attributes.get('name')
+        if not name or action not in ('start', 'die', 'oom'):
+            return
+        exit_code = attributes.get('exitCode')
+        with self.lock:
+            state = self.states.setdefault(name, {'running': False, 'exit_code': None, 'oom': False})
+            if action == 'start':
+                state.update(running=True, exit_code=None, oom=False)
+            elif action == 'oom':
+                state['oom'] = True
+            elif action == 'die':
+                state.update(running=False, exit_code=int(exit_code) if exit_code is not None else None)
+            self.events.append((name, action, exit_code))
+        if action == 'die' and self.wakeup:
+            self.wakeup.set()
+
+    def get_state(self, container_name):
+        with self.lock:
+            return dict(self.states[container_name]) if container_name in self.states else None
+
+    def forget(self, container_name):
+        with self.lock:
+            self.states.pop(container_name, None)
+
+    def pop_events(self):
+        with self.lock:
+            events, self.events = self.events, []
+        return events
+
+
+_events_watcher = {'watcher': None}
+
+
+def start_docker_events_watcher(wakeup=None):
+    """Start following docker events, docker_state will use them when available"""
+    if not _events_watcher['watcher']:
+        watcher = DockerEventsWatcher(wakeup)
+        watcher.start()
+        _events_watcher['watcher'] = watcher
+    return _events_watcher['watcher']
+
+
+def stop_docker_events_watcher():
+    if _events_watcher['watcher']:
+        _events_watcher['watcher'].stop()
+        _events_watcher['watcher'] = None
+
+
+def docker_events():
+    """Return and consume the (container_name, action, exit_code) events received since last call"""
+    watcher = _events_watcher['watcher']
+    return watcher.pop_events() if watcher else []
+
+
 def docker_state(container_name, build_dir):
     container_name = sanitize_container_name(container_name)
     exist = os.path.exists(os.path.join(build_dir, 'exist-%s' % container_name))
@@ -221,7 +380,15 @@ def docker_state(container_name, build_dir):
     if ended:
         return 'END'
 
+    # marker files are written by the container itself, docker events are faster to detect a dead container
+    watcher = _events_watcher['watcher']
+    event_state = watcher.get_state(container_name) if watcher else None
+    if event_state and not event_state['running']:
+        return 'GHOST'  # died without writing its end marker: killed or out of memory
+
     if started:
+        if event_state:
+            return 'RUNNING'
         if docker_is_running(container_name):
             return 'RUNNING'
         else:
@@ -233,6 +400,8 @@ def docker_state(container_name, build_dir):
 def docker_clear_state(container_name, build_dir):
     """Return True if container is still running"""
     container_name = sanitize_container_name(container_name)
+    if _events_watcher['watcher']:
+        _events_watcher['watcher'].forget(container_name)
     if os.path.exists(os.path.join(build_dir, 'start-%s' % container_name)):
         os.remove(os.path.join(build_dir, 'start-%s' % container_name))
     if os.path.exists(os.path.join(build_dir, 'end-%s' % container_name)):
@@ -243,6 +412,7 @@ def docker_clear_state(container_name, build_dir):
 
 def docker_get_gateway_ip():
     """Return the host ip of the docker default bridge gateway"""
+    _count_docker_call()
     docker_net_inspect = subprocess.run(['docker', 'network', 'inspect', 'bridge'], stdout=subprocess.PIPE)
     if docker_net_inspect.returncode != 0:
         return None
@@ -254,11 +424,14 @@ def docker_get_gateway_ip():
 
 
 def docker_ps():
+    if _containers_cache['enabled']:
+        return list(_running_containers())
     return _docker_ps()
 
 
 def _docker_ps():
     """Return a list of running containers names"""
+    _count_docker_call()
     try:
         docker_ps = subprocess.run(['docker', 'ps', '--format', '{{.Names}}'], stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
     except FileNotFoundError:
@@ -272,6 +445,42 @@ def _docker_ps():
     return output.strip().split('\n')
 
 
+MEMORY_UNITS = {'b': 1, 'kb': 1000, 'kib': 1024, 'mb': 1000 ** 2, 'mib': 1024 ** 2, 'gb': 1000 ** 3, 'gib': 1024 ** 3, 'tb': 1000 ** 4, 'tib': 1024 ** 4}
+
+
+def parse_memory(value):
+    """Convert a docker memory string like '1.5GiB' in bytes"""
+    match = re.match(r'^\s*([\d.]+)\s*([a-zA-Z]*)', value)
+    if not match:
+        return 0
+    return int(float(match.group(1)) * MEMORY_UNITS.get(match.group(2).lower() or 'b', 1))
+
+
+def docker_stats():
+    return _docker_stats()
+
+
+def _docker_stats():
+    """Return a dict {container_name: (cpus, memory)} for running containers,
+    cpus being the number of cpus used and memory the used memory in bytes"""
+    _count_docker_call()
+    try:
+        docker_stats = subprocess.run(['docker', 'stats', '--no-stream', '--format', '{{.Name}}\t{{.CPUPerc}}\t{{.MemUsage}}'], stderr=subprocess.DEVNULL, stdout=subprocess.PIPE)
+    except FileNotFoundError:
+        _logger.warning('Docker not found, returning empty stats.')
+        return {}
+    if docker_stats.returncode != 0:
+        return {}
+    stats = {}
+    for line in docker_stats.stdout.decode().strip().split('\n'):
+        try:
+            name, cpu_percent, mem_usage = line.split('\t')
+            stats[name] = (float(cpu_percent.strip('% ')) / 100, parse_memory(mem_usage.split('/')[0]))
+        except ValueError:
+            continue
+    return stats
+
+
 def build(args):
     """Build container from CLI"""
     _logger.info('Building the base image container')
@@ -312,3 +521,8 @@ if os.environ.get('RUNBOT_MODE') == 'test':
             log_file.write('Initiating shutdown\n')
 
     docker_run = fake_docker_run
+
+    def fake_start_docker_events_watcher(wakeup=None):
+        _logger.info('Docker events watcher disabled with Fake Docker')
+
+    start_docker_events_watcher = fake_start_docker_events_watcher
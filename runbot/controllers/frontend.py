@@ -16,6 +16,8 @@ from odoo.addons.website.controllers.main import QueryURL
 from odoo.http import Controller, Response, request, route as o_route
 from odoo.osv import expression
 
+from odoo.addons.runbot_github import github
+
 _logger = logging.getLogger(__name__)
 
 
@@ -356,6 +358,7 @@ class Runbot(Controller):
             'scheduled_count': pending[2],
             'bundles': bundles,
             'hosts_data': hosts_data,
+            'github_metrics': github.metrics(request.env.cr),
             'auto_tags': request.env['runbot.build.error'].disabling_tags(),
             'build_errors': request.env['runbot.build.error'].search([('random', '=', True)]),
             'kwargs': kwargs,
@@ -36,12 +36,17 @@ class Hook(http.Controller):
 
         # force update of dependencies too in case a hook is lost
         if not payload or event == 'push':
+            ref = payload.get('ref', '')
+            if ref.startswith('refs/heads/') and payload.get('after') and not payload.get('deleted'):
+                remote._queue_hook_ref(ref[len('refs/heads/'):], False, payload['after'])
             remote.repo_id.set_hook_time(time.time())
         elif event == 'pull_request':
             pr_number = payload.get('pull_request', {}).get('number', '')
             branch = request.env['runbot.branch'].sudo().search([('remote_id', '=', remote.id), ('name', '=', pr_number)])
             branch.recompute_infos(payload.get('pull_request', {}))
             if payload.get('action') in ('synchronize', 'opened', 'reopened'):
+                if pr_number:
+                    remote._queue_hook_ref(str(pr_number), True, payload['pull_request'].get('head', {}).get('sha'))
                 remote.repo_id.set_hook_time(time.time())
             # remaining recurrent actions: labeled, review_requested, review_request_removed
         elif event == 'delete':
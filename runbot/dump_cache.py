@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""Host local cache of the dumps downloaded by restore steps.
+
+Dumps are stored under their sha256, as published by the install step that
+produced them. The first restore of a dump downloads it in the cache from its
+container, holding a lock so that concurrent restores of the same dump wait
+for a single download, and verifies its checksum before making it visible.
+Later restores mount the cache read only.
+"""
+import logging
+import os
+import re
+import time
+
+_logger = logging.getLogger(__name__)
+
+_re_checksum = re.compile(r'^[0-9a-f]{64}$')
+
+
+class DumpCache(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def has(self, checksum):
+        """ Return True if the dump is cached, marking it as recently used """
+        dump_path = os.path.join(self.path, checksum)
+        if not os.path.isfile(dump_path):
+            return False
+        os.utime(dump_path)
+        return True
+
+    def fetch_cmd(self, checksum, url, mount_path):
+        """ Shell command downloading url in the cache as seen from a container
+        mounting the cache read write in mount_path. The download is done once,
+        under a lock, and the dump is only renamed to its checksum once verified.
+        """
+        dump_path = '%s/%s' % (mount_path, checksum)
+        tmp_path = '%s.tmp' % dump_path
+        download = 'test -f {dump} || (wget -q -O {tmp} {url} && echo "{checksum}  {tmp}" | sha256sum -c --quiet - && mv {tmp} {dump})'.format(
+            dump=dump_path, tmp=tmp_path, url=url, checksum=checksum)
+        return "flock %s.lock sh -c '%s'" % (dump_path, download)
+
+    def gc(self, max_size, max_age=24 * 3600, now=None):
+        """ Remove the least recently used dumps exceeding max_size (in bytes),
+        and the leftovers of downloads older than max_age.
+        :return: number of removed dumps
+        """
+        removed = 0
+        now = now or time.time()
+        if not os.path.isdir(self.path):
+            return removed
+        dumps = []
+        for file_name in os.listdir(self.path):
+            file_path = os.path.join(self.path, file_name)
+            stat = os.stat(file_path)
+            if _re_checksum.match(file_name):
+                dumps.append((stat.st_mtime, stat.st_size, file_path))
+            elif stat.st_mtime + max_age < now:  # interrupted download or unused lock
+                os.remove(file_path)
+        total_size = 0
+        for _, size, file_path in sorted(dumps, reverse=True):
+            total_size += size
+            if total_size > max_size:
+                _logger.info('Removing cached dump %s', file_path)
+                os.remove(file_path)
+                removed += 1
+        return removed
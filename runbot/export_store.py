@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+"""Content addressed store for source exports.
+
+Instead of extracting a full `git archive` for each exported commit, the blobs
+of the exported tree are written once in a store keyed by blob sha, and the
+export is materialized as hardlinks (or reflinks, on filesystems supporting
+them) to the stored files. Consecutive commits sharing most of their files,
+only the blobs changed since an already exported commit are written.
+
+Stored files are read only: exports are mounted read only in the builds and a
+hardlinked file must never be modified in place.
+"""
+import fcntl
+import logging
+import os
+import shutil
+import subprocess
+import time
+import uuid
+
+_logger = logging.getLogger(__name__)
+
+FICLONE = 0x40049409  # from linux/fs.h
+
+
+class ExportStore(object):
+
+    def __init__(self, path, git_dir, mode='hardlink'):
+        """
+        :param path: directory of the store, on the same filesystem as the exports
+        :param git_dir: path of the bare repo to export from
+        :param mode: 'hardlink' or 'reflink'
+        """
+        self.path = path
+        self.git_dir = git_dir
+        self.mode = mode
+
+    def _blob_path(self, sha, executable=False):
+        return os.path.join(self.path, sha[:2], sha[2:] + ('.x' if executable else ''))
+
+    def _ls_tree(self, tree_ish):
+        """ Yield (mode, type, sha, path) for each entry of tree_ish, recursively """
+        output = subprocess.check_output(['git', '--git-dir=%s' % self.git_dir, 'ls-tree', '-r', '-z', '--full-tree', tree_ish])
+        for entry in output.split(b'\0'):
+            if entry:
+                meta, path = entry.split(b'\t', 1)
+                mode, object_type, sha = meta.decode().split()
+                yield mode, object_type, sha, os.fsdecode(path)
+
+    def _read_blobs(self, shas):
+        """ Yield (sha, content) for each sha, using a single git cat-file process """
+        process = subprocess.Popen(['git', '--git-dir=%s' % self.git_dir, 'cat-file', '--batch'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        try:
+            for sha in shas:
+                process.stdin.write(sha.encode() + b'\n')
+                process.stdin.flush()
+                header = process.stdout.readline().split()
+                if len(header) != 3:
+                    raise OSError('Cannot read blob %s from %s' % (sha, self.git_dir))
+                content = process.stdout.read(int(header[2]))
+                process.stdout.read(1)  # trailing newline
+                yield sha, content
+        finally:
+            process.stdin.close()
+            process.stdout.close()
+            process.wait()
+
+    def _write_blob(self, blob_path, content, executable):
+        """ Write a blob in the store, atomically since other exports may use it """
+        os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+        tmp_path = '%s.%s.tmp' % (blob_path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as blob_file:
+            blob_file.write(content)
+        os.chmod(tmp_path, 0o555 if executable else 0o444)
+        os.replace(tmp_path, blob_path)
+
+    def _link(self, blob_path, dest):
+        if self.mode == 'hardlink':
+            try:
+                os.link(blob_path, dest)
+            except OSError as e:
+                # too many links on this blob or store on another device, copy it
+                _logger.debug('Cannot hardlink %s: %s', blob_path, e)
+                shutil.copy2(blob_path, dest)
+            return
+        with open(blob_path, 'rb') as src, open(dest, 'wb') as dst:
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except OSError:
+                shutil.copyfileobj(src, dst)
+        shutil.copymode(blob_path, dest)
+
+    def export(self, tree_ish, export_path):
+        """ Materialize tree_ish in export_path, which must not exist.
+        The export is done in a temporary directory renamed at the end, so that
+        a failed export never leaves a partial tree behind.
+        :return: tuple (number of files, number of blobs written in the store)
+        """
+        tmp_path = '%s.%s.tmp' % (export_path, uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        try:
+            files = []
+            symlinks = []
+            missing = {}
+            for mode, object_type, sha, path in self._ls_tree(tree_ish):
+                dest = os.path.join(tmp_path, path)
+                if object_type == 'commit':  # submodule, exported as an empty directory like git archive does
+                    os.makedirs(dest, exist_ok=True)
+                    continue
+                if mode == '120000':
+                    symlinks.append((sha, dest))
+                    continue
+                executable = mode == '100755'
+                blob_path = self._blob_path(sha, executable)
+                files.append((blob_path, dest))
+                if blob_path not in missing and not os.path.exists(blob_path):
+                    missing[blob_path] = (sha, executable)
+
+            # blobs are written as they are read to avoid keeping a whole tree in memory
+            missing_per_sha = {}
+            for blob_path, (sha, executable) in missing.items():
+                missing_per_sha.setdefault(sha, []).append((blob_path, executable))
+            symlink_shas = {sha for sha, _ in symlinks}
+            targets = {}
+            to_read = sorted(set(missing_per_sha) | symlink_shas)
+            for sha, content in self._read_blobs(to_read) if to_read else []:
+                for blob_path, executable in missing_per_sha.get(sha, []):
+                    self._write_blob(blob_path, content, executable)
+                if sha in symlink_shas:
+                    targets[sha] = os.fsdecode(content)
+
+            for blob_path, dest in files:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                self._link(blob_path, dest)
+            for sha, dest in symlinks:
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                os.symlink(targets[sha], dest)
+            os.rename(tmp_path, export_path)
+        except BaseException:
+            shutil.rmtree(tmp_path, ignore_errors=True)
+            raise
+        return len(files) + len(symlinks), len(missing)
+
+    def gc(self, max_age=7 * 24 * 3600, now=None):
+        """ Remove the blobs not used anymore: in hardlink mode the ones only
+        linked by the store, in reflink mode the ones older than max_age.
+        Must not run concurrently with an export of the same store.
+        :return: number of removed blobs
+        """
+        removed = 0
+        now = now or time.time()
+        if not os.path.isdir(self.path):
+            return removed
+        for dir_path, _, file_names in os.walk(self.path):
+            for file_name in file_names:
+                blob_path = os.path.join(dir_path, file_name)
+                stat = os.lstat(blob_path)
+                if file_name.endswith('.tmp'):
+                    unused = True  # leftover of an interrupted export
+                elif self.mode == 'hardlink':
+                    unused = stat.st_nlink == 1
+                else:
+                    unused = stat.st_mtime + max_age < now
+                if unused:
+                    os.remove(blob_path)
+                    removed += 1
+        return removed
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""Single pass analysis of build logs.
+
+The checkers of a step result and the stat regexes all look for something in
+the same log file. Instead of reading the whole file for each of them, the log
+is streamed once, line by line, and every string, line pattern and stat regex
+is evaluated on each line. Patterns and regexes are thus matched inside a line,
+like they were when `.` does not match new lines.
+
+Analyses are memoized by (path, size, mtime): a log analyzed for the results of
+a step is not read again for its stats.
+
+While a step is running, its log can be followed by a LogTail, scanning the
+lines written since the previous turn. An analysis given the tail of the log
+only reads what was written after its offset for the strings and patterns the
+tail already followed.
+"""
+import collections
+import logging
+import os
+import re
+
+_logger = logging.getLogger(__name__)
+
+_analyses = collections.OrderedDict()  # (path, size, mtime) -> LogAnalysis
+ANALYSES_CACHE_SIZE = 16
+
+
+class LogAnalysis(object):
+
+    def __init__(self):
+        self.strings = {}  # string: found in a line
+        self.patterns = {}  # pattern: matched by a line
+        self.stats = {}  # (name, regex): {key: value}
+
+    def found(self, string):
+        return self.strings[string]
+
+    def matched(self, pattern):
+        return self.patterns[pattern]
+
+    def stat_values(self, stat_regexes):
+        """ Return the {key: value} found by the (name, regex) stat_regexes, the last regex winning on a key """
+        key_values = {}
+        for stat_regex in stat_regexes:
+            key_values.update(self.stats[stat_regex])
+        return key_values
+
+
+def _cache_key(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return (path, stat.st_size, stat.st_mtime_ns)
+
+
+class LogTail(object):
+    """ Incremental scan of a growing log. The strings and patterns followed are
+    the ones given when the tail starts, at offset 0, and only complete lines are
+    read so that a line being written is scanned entirely on the next update.
+    """
+
+    def __init__(self, strings=(), patterns=(), offset=0, found=None, matched=None):
+        self.offset = offset
+        self.found = found if found is not None else dict.fromkeys(strings, False)  # string: found before offset
+        self.matched = matched if matched is not None else dict.fromkeys(patterns, False)  # pattern: first matching line before offset
+
+    @classmethod
+    def from_dict(cls, values):
+        return cls(offset=values['offset'], found=dict(values['found']), matched=dict(values['matched']))
+
+    def to_dict(self):
+        return {'offset': self.offset, 'found': self.found, 'matched': self.matched}
+
+    def update(self, path):
+        """ Scan the complete lines written since the last update
+        :return: dict {pattern: line} of the patterns matched for the first time
+        """
+        pending_strings = [string for string, found in self.found.items() if not found]
+        pending_patterns = {pattern: re.compile(pattern) for pattern, matched in self.matched.items() if not matched}
+        new_matches = {}
+        try:
+            with open(path, 'rb') as log_file:
+                if os.fstat(log_file.fileno()).st_size < self.offset:  # the log was rewritten, start again
+                    _logger.info('Log %s is shorter than its tail offset, scanning it again', path)
+                    self.offset = 0
+                    self.found = dict.fromkeys(self.found, False)
+                    self.matched = dict.fromkeys(self.matched, False)
+                    return self.update(path)
+                log_file.seek(self.offset)
+                for raw_line in iter(log_file.readline, b''):
+                    if not raw_line.endswith(b'\n'):
+                        break
+                    self.offset += len(raw_line)
+                    line = raw_line.decode('utf-8', 'replace')
+                    for string in [string for string in pending_strings if string in line]:
+                        pending_strings.remove(string)
+                        self.found[string] = True
+                    for pattern in [pattern for pattern, regex in pending_patterns.items() if regex.search(line)]:
+                        del pending_patterns[pattern]
+                        self.matched[pattern] = new_matches[pattern] = line.rstrip('\n')
+        except FileNotFoundError:
+            pass
+        return new_matches
+
+
+def _lines(path, offset=0):
+    if not offset:
+        with open(path, 'r') as log_file:
+            yield from iter(log_file.readline, '')
+        return
+    with open(path, 'rb') as log_file:
+        log_file.seek(offset)
+        for raw_line in iter(log_file.readline, b''):
+            yield raw_line.decode('utf-8', 'replace')
+
+
+def _scan(path, analysis, strings, patterns, stat_regexes, offset=0):
+    """ Read path once from offset, evaluating all strings, patterns and stat regexes, and store the results in analysis """
+    pending_strings = set(strings)
+    pending_patterns = {pattern: re.compile(pattern) for pattern in patterns}
+    compiled_stats = [(stat_regex, re.compile(stat_regex[1])) for stat_regex in stat_regexes]
+    stats = {stat_regex: {} for stat_regex in stat_regexes}
+    try:
+        for line in _lines(path, offset):
+            if pending_strings:
+                for string in [string for string in pending_strings if string in line]:
+                    pending_strings.remove(string)
+                    analysis.strings[string] = True
+            if pending_patterns:
+                for pattern in [pattern for pattern, regex in pending_patterns.items() if regex.search(line)]:
+                    del pending_patterns[pattern]
+                    analysis.patterns[pattern] = True
+            for stat_regex, regex in compiled_stats:
+                for match in regex.finditer(line):
+                    group_dict = match.groupdict()
+                    try:
+                        value = float(group_dict.get('value'))
+                    except ValueError:
+                        _logger.warning('The matched value (%s) of "%s" cannot be converted into float', group_dict.get('value'), stat_regex[1])
+                        continue
+                    key = '%s.%s' % (stat_regex[0], group_dict['key']) if 'key' in group_dict else stat_regex[0]
+                    stats[stat_regex][key] = value
+    except FileNotFoundError:
+        pass
+    for string in pending_strings:
+        analysis.strings[string] = False
+    for pattern in pending_patterns:
+        analysis.patterns[pattern] = False
+    analysis.stats.update(stats)
+
+
+def analyze_log(path, strings=(), patterns=(), stat_regexes=(), tail=None):
+    """ Return the LogAnalysis of path for the given strings, line patterns and (name, regex) stat regexes.
+    Only what was not already computed for the same version of the file is read,
+    and the strings and patterns followed by tail are only searched after its offset.
+    """
+    key = _cache_key(path)
+    analysis = _analyses.get(key) if key else None
+    if analysis is None:
+        analysis = LogAnalysis()
+    missing_strings = [string for string in strings if string not in analysis.strings]
+    missing_patterns = [pattern for pattern in patterns if pattern not in analysis.patterns]
+    missing_stats = [stat_regex for stat_regex in stat_regexes if stat_regex not in analysis.stats]
+    if tail and tail.offset and key and tail.offset <= key[1] and (missing_strings or missing_patterns):
+        tail_strings = [string for string in missing_strings if string in tail.found]
+        tail_patterns = [pattern for pattern in missing_patterns if pattern in tail.matched]
+        analysis.strings.update({string: True for string in tail_strings if tail.found[string]})
+        analysis.patterns.update({pattern: True for pattern in tail_patterns if tail.matched[pattern]})
+        unread_strings = [string for string in tail_strings if not tail.found[string]]
+        unread_patterns = [pattern for pattern in tail_patterns if not tail.matched[pattern]]
+        if unread_strings or unread_patterns:
+            _scan(path, analysis, unread_strings, unread_patterns, [], tail.offset)
+        missing_strings = [string for string in missing_strings if string not in analysis.strings]
+        missing_patterns = [pattern for pattern in missing_patterns if pattern not in analysis.patterns]
+    if missing_strings or missing_patterns or missing_stats:
+        _scan(path, analysis, missing_strings, missing_patterns, missing_stats)
+    if key:
+        _analyses[key] = analysis
+        _analyses.move_to_end(key)
+        while len(_analyses) > ANALYSES_CACHE_SIZE:
+            _analyses.popitem(last=False)
+    return analysis
@@ -4,6 +4,7 @@ from . import batch
 from . import branch
 from . import build
 from . import build_config
+from . import build_duration
 from . import build_error
 from . import bundle
 from . import codeowner
@@ -22,10 +22,27 @@ class Batch(models.Model):
     state = fields.Selection([('preparing', 'Preparing'), ('ready', 'Ready'), ('done', 'Done'), ('skipped', 'Skipped')])
     hidden = fields.Boolean('Hidden', default=False)
     age = fields.Integer(compute='_compute_age', string='Build age')
+    predicted_remaining = fields.Integer(compute='_compute_predicted_remaining', string='Predicted remaining time')
     category_id = fields.Many2one('runbot.category', default=lambda self: self.env.ref('runbot.default_category', raise_if_not_found=False))
     log_ids = fields.One2many('runbot.batch.log', 'batch_id')
     has_warning = fields.Boolean("Has warning")
 
+    def init(self):
+        """ Wake up the leader when a new batch needs to be prepared """
+        self._cr.execute("""
+CREATE OR REPLACE FUNCTION runbot_batch_notify() RETURNS TRIGGER AS $runbot_batch_notify$
+BEGIN
+  PERFORM pg_notify('runbot_leader', '');
+  RETURN NULL;
+END;
+$runbot_batch_notify$ language plpgsql;
+
+DROP TRIGGER IF EXISTS runbot_batch_notify_trigger ON runbot_batch;
+CREATE TRIGGER runbot_batch_notify_trigger
+AFTER INSERT ON runbot_batch
+FOR EACH ROW WHEN (NEW.state = 'preparing') EXECUTE PROCEDURE runbot_batch_notify();
+        """)
+
     @api.depends('slot_ids.build_id')
     def _compute_all_build_ids(self):
         all_builds = self.env['runbot.build'].search([('id', 'child_of', self.slot_ids.build_id.ids)])
@@ -46,9 +63,23 @@ class Batch(models.Model):
             else:
                 batch.buildage_age = 0
 
+    @api.depends('slot_ids.build_id.global_state', 'slot_ids.build_id.predicted_duration')
+    def _compute_predicted_remaining(self):
+        """Time before all builds of the batch are done according to their predicted duration, queue time excluded"""
+        for batch in self:
+            remaining = 0
+            for build in batch.slot_ids.build_id:
+                if build.global_state in ('done', 'running'):
+                    continue
+                remaining = max(remaining, build.predicted_duration - build.build_time)
+            batch.predicted_remaining = max(remaining, 0)
+
     def get_formated_age(self):
         return s2human_long(self.age)
 
+    def get_formated_predicted_remaining(self):
+        return s2human_long(datetime.timedelta(seconds=self.predicted_remaining))
+
     def _url(self):
         self.ensure_one()
         return "/runbot/batch/%s" % self.id
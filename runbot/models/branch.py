@@ -177,17 +177,25 @@ class Branch(models.Model):
     @api.model_create_multi
     def create(self, value_list):
         branches = super().create(value_list)
-        for branch in branches:
-            if branch.head:
-                self.env['runbot.ref.log'].create({'commit_id': branch.head.id, 'branch_id': branch.id})
+        self.env['runbot.ref.log'].create([{'commit_id': branch.head.id, 'branch_id': branch.id} for branch in branches if branch.head])
         return branches
 
     def write(self, values):
         if 'head' in values:
-            head = self.head
+            heads = {branch: branch.head for branch in self}
         super().write(values)
-        if 'head' in values and head != self.head:
-            self.env['runbot.ref.log'].create({'commit_id': self.head.id, 'branch_id': self.id})
+        if 'head' in values:
+            self.env['runbot.ref.log'].create([{'commit_id': branch.head.id, 'branch_id': branch.id} for branch, head in heads.items() if head != branch.head])
+
+    def _set_heads(self, heads):
+        """ Update the heads of many branches, with one write per head commit
+        :param heads: dict {branch: commit}
+        """
+        branches_per_head = defaultdict(lambda: self.env['runbot.branch'])
+        for branch, commit in heads.items():
+            branches_per_head[commit] |= branch
+        for commit, branches in branches_per_head.items():
+            branches.write({'head': commit.id})
 
     def _get_pull_info(self):
         self.ensure_one()
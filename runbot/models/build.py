@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 import fnmatch
+import functools
 import logging
 import pwd
 import re
@@ -8,8 +9,9 @@ import subprocess
 import time
 import datetime
 import hashlib
-from ..common import dt2time, fqdn, now, grep, local_pgadmin_cursor, s2human, dest_reg, os, list_local_dbs, pseudo_markdown, RunbotException
+from ..common import dt2time, fqdn, now, grep, local_pgadmin_cursor, s2human, dest_reg, os, list_local_dbs, DB_TEMPLATE_PREFIX, pseudo_markdown, PortAllocator, RunbotException
 from ..container import docker_stop, docker_state, Command, docker_run
+from ..dump_cache import DumpCache
 from ..fields import JsonDictField
 from odoo import models, fields, api
 from odoo.exceptions import UserError, ValidationError
@@ -22,6 +24,11 @@ from subprocess import CalledProcessError
 
 _logger = logging.getLogger(__name__)
 
+# port allocator of the builds of a host, by (dbname, host name)
+_port_allocators = {}
+# builds in these states do not hold their port
+PORTLESS_STATES = ('pending', 'done')
+
 result_order = ['ok', 'warn', 'ko', 'skipped', 'killed', 'manually_killed']
 state_order = ['pending', 'testing', 'waiting', 'running', 'done']
 
@@ -179,6 +186,8 @@ class BuildResult(models.Model):
     docker_start = fields.Datetime('Docker start')
     job_time = fields.Integer(compute='_compute_job_time', string='Job time')
     build_time = fields.Integer(compute='_compute_build_time', string='Build time')
+    predicted_duration = fields.Integer('Predicted duration', readonly=True,
+                                        help="Duration of the build and of its children according to the durations of previous builds, set on create")
 
     gc_date = fields.Datetime('Local cleanup date', compute='_compute_gc_date')
     gc_delay = fields.Integer('Cleanup Delay', help='Used to compute gc_date')
@@ -214,14 +223,43 @@ class BuildResult(models.Model):
     build_error_ids = fields.Many2many('runbot.build.error', 'runbot_build_error_ids_runbot_build_rel', string='Errors')
     keep_running = fields.Boolean('Keep running', help='Keep running', index=True)
     log_counter = fields.Integer('Log Lines counter', default=100)
+    log_tail = JsonDictField('Log tail', help="Offset and findings of the log of the active step, scanned while it runs")
 
     slot_ids = fields.One2many('runbot.batch.slot', 'build_id')
     killable = fields.Boolean('Killable')
+    peak_cpu = fields.Float('Peak cpus used by the current step')
+    peak_memory = fields.Float('Peak memory used by the current step (GiB)')
 
     database_ids = fields.One2many('runbot.database', 'build_id')
 
     static_run = fields.Char('Static run URL')
 
+    def init(self):
+        """ Notify builders when a build they may have to handle changes, see PgListener """
+        self._cr.execute("""
+CREATE OR REPLACE FUNCTION runbot_build_notify() RETURNS TRIGGER AS $runbot_build_notify$
+BEGIN
+  IF (TG_OP = 'UPDATE'
+      AND NEW.local_state IS NOT DISTINCT FROM OLD.local_state
+      AND NEW.host IS NOT DISTINCT FROM OLD.host
+      AND NEW.requested_action IS NOT DISTINCT FROM OLD.requested_action) THEN
+    RETURN NULL;
+  END IF;
+  IF (NEW.host IS NOT NULL) THEN
+    PERFORM pg_notify('runbot_host_' || left(md5(NEW.host), 16), '');
+  ELSIF (NEW.local_state = 'pending') THEN
+    PERFORM pg_notify('runbot_pending', '');
+  END IF;
+  RETURN NULL;
+END;
+$runbot_build_notify$ language plpgsql;
+
+DROP TRIGGER IF EXISTS runbot_build_notify_trigger ON runbot_build;
+CREATE TRIGGER runbot_build_notify_trigger
+AFTER INSERT OR UPDATE OF local_state, host, requested_action ON runbot_build
+FOR EACH ROW EXECUTE PROCEDURE runbot_build_notify();
+        """)
+
     @api.depends('description', 'params_id.config_id')
     def _compute_display_name(self):
         for build in self:
@@ -319,6 +357,16 @@ class BuildResult(models.Model):
         })
         return [values]
 
+    @api.model_create_multi
+    def create(self, vals_list):
+        Duration = self.env['runbot.build.duration']
+        cache = {}
+        for values in vals_list:
+            if values.get('params_id') and 'predicted_duration' not in values:
+                params = self.env['runbot.build.params'].browse(values['params_id'])
+                values['predicted_duration'] = int(Duration._predict(params.trigger_id, params.config_id, params.version_id, cache))
+        return super().create(vals_list)
+
     def write(self, values):
         # some validation to ensure db consistency
         if 'local_state' in values:
@@ -488,7 +536,7 @@ class BuildResult(models.Model):
             build = self._build_from_dest(dest)
             if build:
                 dest_by_builds_ids[build.id].append(dest)
-            elif dest != hide_in_logs:
+            elif dest != hide_in_logs and not dest.startswith(DB_TEMPLATE_PREFIX):
                 ignored.add(dest)
         if ignored:
             _logger.info('%s (%s) not deleted because not dest format', label, list(ignored))
@@ -533,6 +581,11 @@ class BuildResult(models.Model):
             self._logger('Removing database')
             self._local_pg_dropdb(db)
 
+        if force is not True:
+            self.env['runbot.database.template']._evict()
+            dump_cache_size = float(self.env['ir.config_parameter'].get_param('runbot.runbot_dump_cache_size', default=0))
+            DumpCache(os.path.join(self.env['runbot.runbot']._root(), 'dump_cache')).gc(dump_cache_size * 1024 ** 3)
+
         root = self.env['runbot.runbot']._root()
         builds_dir = os.path.join(root, 'build')
 
@@ -556,20 +609,42 @@ class BuildResult(models.Model):
                         elif not f.endswith('.txt'):
                             os.unlink(log_file_path)
 
-    def _find_port(self):
-        # currently used port
-        ids = self.search([('local_state', 'not in', ['pending', 'done']), ('host', '=', fqdn())])
-        ports = set(i['port'] for i in ids.read(['port']))
-
-        # starting port
-        icp = self.env['ir.config_parameter']
-        port = int(icp.get_param('runbot.runbot_starting_port', default=2000))
+    def _get_port_allocator(self, used_ports=None):
+        """ Return the port allocator of the current host, rebuilt from the database
+        when missing or older than a minute, or from used_ports if given.
+        """
+        host_name = fqdn()
+        starting_port = int(self.env['ir.config_parameter'].get_param('runbot.runbot_starting_port', default=2000))
+        key = (self.env.cr.dbname, host_name)
+        allocator = _port_allocators.get(key)
+        if used_ports is None and allocator and allocator.start == starting_port and time.time() - allocator.created < 60:
+            return allocator
+        if used_ports is None:
+            self.flush(['port', 'local_state', 'host'])
+            self.env.cr.execute("""
+                SELECT port FROM runbot_build
+                WHERE host = %s AND local_state NOT IN %s AND port IS NOT NULL
+            """, [host_name, PORTLESS_STATES])
+            used_ports = [port for (port,) in self.env.cr.fetchall()]
+        allocator = PortAllocator(starting_port, used_ports)
+        _port_allocators[key] = allocator
+        return allocator
 
-        # find next free port
-        while port in ports:
-            port += 3
+    def _find_port(self):
+        allocator = self._get_port_allocator()
+        port = allocator.allocate()
+        # the port is not written if the transaction is rolled back
+        self.env.cr.after('rollback', functools.partial(allocator.release, port))
         return port
 
+    def _release_port(self):
+        allocator = _port_allocators.get((self.env.cr.dbname, fqdn()))
+        if allocator:
+            for build in self:
+                if build.port:
+                    allocator.release(build.port)
+                    self.env.cr.after('rollback', functools.partial(allocator.reserve, build.port))
+
     def _logger(self, *l):
         l = list(l)
         for build in self:
@@ -668,6 +743,8 @@ class BuildResult(models.Model):
             # check if current job is finished
             _docker_state = docker_state(build._get_docker_name(), build._path())
             if _docker_state == 'RUNNING':
+                if build.local_state == 'testing' and build.active_step._tail_log(build):
+                    continue  # killed on the first error
                 timeout = min(build.active_step.cpu_limit, int(icp.get_param('runbot.runbot_timeout', default=10000)))
                 if build.local_state != 'running' and build.job_time > timeout:
                     build._log('_schedule', '%s time exceeded (%ss)' % (build.active_step.name if build.active_step else "?", build.job_time))
@@ -686,6 +763,7 @@ class BuildResult(models.Model):
             build_values = {
                 'job_end': now(),
                 'docker_start': False,
+                'log_tail': {},
             }
             # make result of previous job
             try:
@@ -706,6 +784,13 @@ class BuildResult(models.Model):
 
             build.active_step.log_end(build)
 
+            if build.local_state == 'testing' and build.job_start and build_values.get('local_result') != 'killed':
+                self.env['runbot.build.duration']._learn(build, build.active_step, time.time() - dt2time(build.job_start))
+
+            if build.peak_cpu or build.peak_memory:
+                build.active_step._learn_resources(build.peak_cpu, build.peak_memory)
+                build_values.update({'peak_cpu': 0, 'peak_memory': 0})
+
             build_values.update(build._next_job_values())  # find next active_step or set to done
 
             ending_build = build.local_state not in ('done', 'running') and build_values.get('local_state') in ('done', 'running')
@@ -713,6 +798,8 @@ class BuildResult(models.Model):
                 build.update_build_end()
 
             build.write(build_values)
+            if build.local_state == 'done':
+                build._release_port()
             if ending_build:
                 if not build.local_result:  # Set 'ok' result if no result set (no tests job on build)
                     build.local_result = 'ok'
@@ -744,6 +831,14 @@ class BuildResult(models.Model):
             kwargs.update({'image_tag': self.params_id.dockerfile_id.image_tag})
         if kwargs['image_tag'] != 'odoo:DockerDefault':
             self._log('Preparing', 'Using Dockerfile Tag %s' % kwargs['image_tag'])
+        host = self.env['runbot.host'].search([('name', '=', self.host)], limit=1)
+        if host and host._uses_resources():
+            margin = float(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_resources_margin', default=1.5))
+            cpu, memory = self.active_step._get_resources()
+            if cpu and 'cpus' not in kwargs:
+                kwargs['cpus'] = round(cpu * margin, 2)
+            if memory and 'memory' not in kwargs:
+                kwargs['memory'] = int(memory * margin * 1024 ** 3)
         containers_memory_limit = self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_containers_memory', 0)
         if containers_memory_limit and 'memory' not in kwargs:
             kwargs['memory'] = int(float(containers_memory_limit) * 1024 ** 3)
@@ -754,6 +849,11 @@ class BuildResult(models.Model):
                 _logger.info('Step took %s seconds before starting docker', start_step_time)
         docker_run(**kwargs)
 
+    def _get_resources(self):
+        """ Return the (cpus, memory in GiB) reserved on the host for this build """
+        self.ensure_one()
+        return self.params_id.config_id._get_resources()
+
     def _path(self, *l, **kw):
         """Return the repo build path"""
         self.ensure_one()
@@ -853,9 +953,9 @@ class BuildResult(models.Model):
         _logger.info(' '.join(cmd))
         subprocess.call(cmd)
 
-    def _local_pg_createdb(self, dbname):
+    def _local_pg_createdb(self, dbname, db_template=None):
         icp = self.env['ir.config_parameter']
-        db_template = icp.get_param('runbot.runbot_db_template', default='template0')
+        db_template = db_template or icp.get_param('runbot.runbot_db_template', default='template0')
         self._local_pg_dropdb(dbname)
         _logger.info("createdb %s", dbname)
         with local_pgadmin_cursor() as local_cr:
@@ -887,7 +987,8 @@ class BuildResult(models.Model):
                 continue
             build._log('kill', 'Kill build %s' % build.dest)
             docker_stop(build._get_docker_name(), build._path())
-            v = {'local_state': 'done', 'requested_action': False, 'active_step': False, 'job_end': now()}
+            build._release_port()
+            v = {'local_state': 'done', 'requested_action': False, 'active_step': False, 'job_end': now(), 'log_tail': {}}
             if not build.build_end:
                 v['build_end'] = now()
             if result:
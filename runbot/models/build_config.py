@@ -1,5 +1,6 @@
 import base64
 import glob
+import hashlib
 import json
 import logging
 import fnmatch
@@ -9,6 +10,8 @@ import time
 from unidiff import PatchSet
 from ..common import now, grep, time2str, rfind, s2human, os, RunbotException
 from ..container import docker_get_gateway_ip, Command
+from ..dump_cache import DumpCache
+from ..log_analyzer import analyze_log, LogTail
 from odoo import models, fields, api
 from odoo.exceptions import UserError, ValidationError
 from odoo.tools.safe_eval import safe_eval, test_python_expr
@@ -17,8 +20,19 @@ _logger = logging.getLogger(__name__)
 
 _re_error = r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|(?:Traceback \(most recent call last\):)$'
 _re_warning = r'^\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ WARNING '
+_log_modules_loaded = '.modules.loading: Modules loaded.'
+_log_shutdown = 'Initiating shutdown'
 
 PYTHON_DEFAULT = "# type python code here\n\n\n\n\n\n"
+DUMP_MANIFEST_SUFFIX = '.manifest.json'
+
+
+def _directory_dump_files(db_name):
+    """ Files of a directory format dump, published next to its manifest """
+    return {
+        'dump': '%s.dump.tar.zst' % db_name,
+        'filestore': '%s.filestore.tar.zst' % db_name,
+    }
 
 
 class Config(models.Model):
@@ -58,6 +72,12 @@ class Config(models.Model):
         self.ensure_one()
         return [ordered_step.step_id for ordered_step in self.step_order_ids.sorted('sequence')]
 
+    def _get_resources(self):
+        """ Resources are reserved for the whole build, return the ones of the biggest step """
+        self.ensure_one()
+        resources = [step._get_resources() for step in self.step_ids()]
+        return max([cpu for cpu, _ in resources], default=0), max([memory for _, memory in resources], default=0)
+
     def _check_step_ids_order(self):
         install_job = False
         step_ids = self.step_ids()
@@ -126,6 +146,14 @@ class ConfigStep(models.Model):
     install_modules = fields.Char('Modules to install', help="List of module patterns to install, use * to install all available modules, prefix the pattern with dash to remove the module.", default='')
     db_name = fields.Char('Db Name', compute='_compute_db_name', inverse='_inverse_db_name', tracking=True)
     cpu_limit = fields.Integer('Cpu limit', default=3600, tracking=True)
+    dump_format = fields.Selection([('zip', 'Zip of a sql dump'), ('directory', 'Parallel directory dump')], 'Dump format', default='zip', tracking=True,
+                                   help="The directory format is dumped and restored by parallel jobs, compressed with zstd and described by a manifest")
+    dump_jobs = fields.Integer('Dump jobs', default=4, tracking=True, help="Parallel jobs of pg_dump and pg_restore for the directory dump format")
+    cpu_estimate = fields.Float('Estimated cpus', tracking=True, help="Number of cpus used by this step, learned from containers stats if not set")
+    memory_estimate = fields.Float('Estimated memory (GiB)', tracking=True, help="Memory used by this step, learned from containers stats if not set")
+    learned_cpu = fields.Float('Learned cpus', readonly=True)
+    learned_memory = fields.Float('Learned memory (GiB)', readonly=True)
+    learned_count = fields.Integer('Resources samples count', readonly=True)
     coverage = fields.Boolean('Coverage', default=False, tracking=True)
     paths_to_omit = fields.Char('Paths to omit from coverage', tracking=True)
     flamegraph = fields.Boolean('Allow Flamegraph', default=False, tracking=True)
@@ -139,6 +167,7 @@ class ConfigStep(models.Model):
     python_code = fields.Text('Python code', tracking=True, default=PYTHON_DEFAULT)
     python_result_code = fields.Text('Python code for result', tracking=True, default=PYTHON_DEFAULT)
     ignore_triggered_result = fields.Boolean('Ignore error triggered in logs', tracking=True, default=False)
+    fail_fast = fields.Boolean('Fail fast', tracking=True, default=False, help="Kill the build as soon as an error is found in the log of this step")
     running_job = fields.Boolean('Job final state is running', default=False, help="Docker won't be killed if checked")
     # create_build
     create_config_ids = fields.Many2many('runbot.build.config', 'runbot_build_config_step_ids_create_config_ids_rel', string='New Build Configs', tracking=True, index=True)
@@ -292,6 +321,25 @@ class ConfigStep(models.Model):
             else:
                 raise
 
+    def _get_resources(self):
+        """ Return a (cpus, memory in GiB) tuple of the resources needed to run this step """
+        self.ensure_one()
+        if not self._is_docker_step():
+            return 0, 0
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        cpu = self.cpu_estimate or (self.learned_count and self.learned_cpu) or float(get_param('runbot.runbot_default_step_cpu', default=1))
+        memory = self.memory_estimate or (self.learned_count and self.learned_memory) or float(get_param('runbot.runbot_default_step_memory', default=2))
+        return cpu, memory
+
+    def _learn_resources(self, cpu, memory):
+        """ Update learned resources with the peak usage observed during a run of the step (exponential moving average) """
+        alpha = 0.3
+        for step in self:
+            if step.learned_count:
+                cpu = alpha * cpu + (1 - alpha) * step.learned_cpu
+                memory = alpha * memory + (1 - alpha) * step.learned_memory
+            step.write({'learned_cpu': cpu, 'learned_memory': memory, 'learned_count': step.learned_count + 1})
+
     def _is_docker_step(self):
         if not self:
             return False
@@ -369,13 +417,23 @@ class ConfigStep(models.Model):
             python_params = ['-m', 'flamegraph', '-o', self._perfs_data_path()]
         cmd = build._cmd(python_params, py_version, sub_command=self.sub_command)
         # create db if needed
-        db_suffix = build.params_id.config_data.get('db_name') or (build.params_id.dump_db.db_suffix if not self.create_db else False) or self.db_name
-        db_name = '%s-%s' % (build.dest, db_suffix)
-        if self.create_db:
+        db_name = self._install_db_name(build)
+        extra_params = build.params_id.extra_params or self.extra_params or ''
+        db_template = self.env['runbot.database.template']
+        template_key = self._db_template_key(build, modules_to_install, extra_params)
+        if template_key:
+            host = self.env['runbot.host']._get_current()
+            db_template = db_template._find(template_key)
+            if db_template and db_template._clone(build, db_name):
+                host.db_template_hits += 1
+                build._log('_run_install_odoo', 'Database restored from template %s, installed by build %s' % (db_template.name, db_template.build_id.id))
+            else:
+                db_template = db_template.browse()
+                host.db_template_misses += 1
+        if self.create_db and not db_template:
             build._local_pg_createdb(db_name)
         cmd += ['-d', db_name]
         # list module to install
-        extra_params = build.params_id.extra_params or self.extra_params or ''
         if mods and '-i' not in extra_params:
             cmd += ['-i', mods]
         config_path = build._server("tools/config.py")
@@ -416,17 +474,41 @@ class ConfigStep(models.Model):
         if extra_params:
             cmd.extend(shlex.split(extra_params))
 
+        if db_template:
+            # modules are already installed, only run the post install and dump commands
+            cmd.cmd = ['echo', 'Modules already installed in template %s' % db_template.name]
         cmd.finals.extend(self._post_install_commands(build, modules_to_install, py_version))  # coverage post, extra-checks, ...
         dump_dir = '/data/build/logs/%s/' % db_name
-        sql_dest = '%s/dump.sql' % dump_dir
         filestore_path = '/data/build/datadir/filestore/%s' % db_name
-        filestore_dest = '%s/filestore/' % dump_dir
-        zip_path = '/data/build/logs/%s.zip' % db_name
-        cmd.finals.append(['pg_dump', db_name, '>', sql_dest])
-        cmd.finals.append(['cp', '-r', filestore_path, filestore_dest])
-        cmd.finals.append(['cd', dump_dir, '&&', 'zip', '-rmq9', zip_path, '*'])
-        infos = '{\n    "db_name": "%s",\n    "build_id": %s,\n    "shas": [%s]\n}' % (db_name, build.id, ', '.join(['"%s"' % build_commit.commit_id.dname for build_commit in build.params_id.commit_link_ids]))
-        build.write_file('logs/%s/info.json' % db_name, infos)
+        if self.dump_format == 'directory':
+            dump_files = _directory_dump_files(db_name)
+            dump_path = '%sdump' % dump_dir
+            cmd.finals.append(['pg_dump', '-Fd', '-j', str(self.dump_jobs or 1), '-Z0', '-f', dump_path, db_name])
+            cmd.finals.append(['tar', '-I', '"zstd -T0"', '-cf', '/data/build/logs/%s' % dump_files['dump'], '-C', dump_dir, 'dump', '&&', 'rm', '-r', dump_dir])
+            cmd.finals.append(['mkdir', '-p', filestore_path, '&&', 'tar', '-I', '"zstd -T0"', '-cf', '/data/build/logs/%s' % dump_files['filestore'], '-C', filestore_path, '.'])
+            cmd.finals.append(['cd', '/data/build/logs', '&&', 'sha256sum', dump_files['dump'], dump_files['filestore'], '>', '%s.sha256' % db_name])
+            manifest = {
+                'format': 'directory',
+                'version': 1,
+                'db_name': db_name,
+                'build_id': build.id,
+                'shas': [build_commit.commit_id.dname for build_commit in build.params_id.commit_link_ids],
+                'jobs': self.dump_jobs or 1,
+                'compression': 'zstd',
+                'files': dump_files,
+            }
+            build.write_file('logs/%s%s' % (db_name, DUMP_MANIFEST_SUFFIX), json.dumps(manifest, indent=4))
+        else:
+            sql_dest = '%s/dump.sql' % dump_dir
+            filestore_dest = '%s/filestore/' % dump_dir
+            zip_path = '/data/build/logs/%s.zip' % db_name
+            cmd.finals.append(['pg_dump', db_name, '>', sql_dest])
+            cmd.finals.append(['cp', '-r', filestore_path, filestore_dest])
+            cmd.finals.append(['cd', dump_dir, '&&', 'zip', '-rmq9', zip_path, '*'])
+            cmd.finals.append(['cd', '/data/build/logs', '&&', 'sha256sum', '%s.zip' % db_name, '>', '%s.sha256' % db_name])
+            infos = '{\n    "db_name": "%s",\n    "build_id": %s,\n    "shas": [%s]\n}' % (db_name, build.id, ', '.join(['"%s"' % build_commit.commit_id.dname for build_commit in build.params_id.commit_link_ids]))
+            build.write_file('logs/%s/info.json' % db_name, infos)
+        self.env['runbot.database'].create({'name': db_name, 'build_id': build.id}).dump_format = self.dump_format
 
         if self.flamegraph:
             cmd.finals.append(['flamegraph.pl', '--title', 'Flamegraph %s for build %s' % (self.name, build.id), self._perfs_data_path(), '>', self._perfs_data_path(ext='svg')])
@@ -436,6 +518,88 @@ class ConfigStep(models.Model):
         env_variables = self.additionnal_env.split(';') if self.additionnal_env else []
         return dict(cmd=cmd, log_path=log_path, build_dir=build._path(), container_name=build._get_docker_name(), cpu_limit=timeout, ro_volumes=exports, env_variables=env_variables)
 
+    def _install_db_name(self, build):
+        db_suffix = build.params_id.config_data.get('db_name') or (build.params_id.dump_db.db_suffix if not self.create_db else False) or self.db_name
+        return '%s-%s' % (build.dest, db_suffix)
+
+    def _publish_dump_checksums(self, build):
+        """ Store the checksums of the dump files computed at the end of the step, used by
+        restore steps to verify and cache the downloaded dumps, and publish them with the dump
+        """
+        db_name = self._install_db_name(build)
+        checksums_path = 'logs/%s.sha256' % db_name
+        if not build.is_file(checksums_path):
+            return
+        checksums = {}
+        for line in (build.read_file(checksums_path) or '').splitlines():
+            if line.strip():
+                checksum, file_name = line.split(None, 1)
+                checksums[file_name.lstrip('*')] = checksum
+        database = self.env['runbot.database'].search([('name', '=', db_name), ('build_id', '=', build.id)], limit=1)
+        if not database or not checksums:
+            return
+        database.dump_checksums = checksums
+        if database.dump_format == 'directory':
+            manifest_path = 'logs/%s%s' % (db_name, DUMP_MANIFEST_SUFFIX)
+            manifest = json.loads(build.read_file(manifest_path) or '{}')
+            manifest['sha256'] = checksums
+            build.write_file(manifest_path, json.dumps(manifest, indent=4))
+        else:
+            # the info.json of the dump is inside the zip, the checksum of the zip is published next to it
+            infos = {
+                'db_name': db_name,
+                'build_id': build.id,
+                'shas': [build_commit.commit_id.dname for build_commit in build.params_id.commit_link_ids],
+                'sha256': checksums,
+            }
+            build.write_file('logs/%s.info.json' % db_name, json.dumps(infos, indent=4))
+
+    def _can_use_db_template(self, extra_params):
+        if not float(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_db_template_quota', default=0)):
+            return False
+        return self.job_type == 'install_odoo' and self.create_db and not (self.test_enable or self.test_tags or self.coverage or self.flamegraph or '--test-tags' in extra_params)
+
+    def _db_template_key(self, build, modules_to_install, extra_params):
+        """ Key of the installed database template usable by this step, False if the step cannot use one.
+        Only steps installing without running any test are cached, tests cannot be skipped.
+        """
+        if not self._can_use_db_template(extra_params):
+            return False
+        icp = self.env['ir.config_parameter'].sudo()
+        commits = self.env.context.get('defined_commit_ids') or build.params_id.commit_ids
+        cleaned_vals = {
+            'commit_ids': sorted(commits.ids),
+            'modules': sorted(modules_to_install),
+            'extra_params': extra_params,
+            'sub_command': self.sub_command or '',
+            'additionnal_env': self.additionnal_env or '',
+            'dockerfile_id': build.params_id.dockerfile_id.id,
+            'skip_requirements': build.params_id.skip_requirements,
+            'db_template': icp.get_param('runbot.runbot_db_template', default='template0'),
+        }
+        return hashlib.sha256(str(cleaned_vals).encode('utf8')).hexdigest()
+
+    def _store_db_template(self, build, build_values):
+        """ Keep the database installed by a successful step as template for the next builds with the same key """
+        extra_params = build.params_id.extra_params or self.extra_params or ''
+        if not self._can_use_db_template(extra_params):
+            return
+        if build_values.get('local_result', build.local_result) not in ('ok', False) or build.triggered_result:
+            return
+        log_path = build._path('logs', '%s.txt' % self.name)
+        if not os.path.isfile(log_path):
+            return
+        log_analysis = self._log_analysis(build)
+        if not log_analysis.found(_log_modules_loaded) or log_analysis.matched(_re_error):
+            return
+        template_key = self._db_template_key(build, self._modules_to_install(build), extra_params)
+        if not template_key or self.env['runbot.database.template']._find(template_key):
+            return
+        db_name = self._install_db_name(build)
+        template = self.env['runbot.database.template']._store(template_key, build, db_name)
+        if template:
+            build._log('_store_db_template', 'Database stored as template %s' % template.name)
+
     def _upgrade_create_childs(self):
         pass
 
@@ -675,31 +839,55 @@ class ConfigStep(models.Model):
 
         if 'dump_url' in params.config_data:
             dump_url = params.config_data['dump_url']
-            zip_name = dump_url.split('/')[-1]
-            build._log('test-migration', 'Restoring db [%s](%s)' % (zip_name, dump_url), log_type='markdown')
+            dump_name = dump_url.split('/')[-1]
+            dump_format = 'directory' if dump_name.endswith(DUMP_MANIFEST_SUFFIX) else 'zip'
+            checksums = {}
+            build._log('test-migration', 'Restoring db [%s](%s)' % (dump_name, dump_url), log_type='markdown')
         else:
             download_db_suffix = params.dump_db.db_suffix or self.restore_download_db_suffix
             dump_build = params.dump_db.build_id or build.parent_id
             assert download_db_suffix and dump_build
             download_db_name = '%s-%s' % (dump_build.dest, download_db_suffix)
-            zip_name = '%s.zip' % download_db_name
-            dump_url = '%s%s' % (dump_build.http_log_url(), zip_name)
-            build._log('test-migration', 'Restoring dump [%s](%s) from build [%s](%s)' % (zip_name, dump_url, dump_build.id, dump_build.build_url), log_type='markdown')
+            dump_db = params.dump_db or self.env['runbot.database'].search([('name', '=', download_db_name), ('build_id', '=', dump_build.id)], limit=1)
+            dump_format = dump_db.dump_format or 'zip'
+            checksums = dump_db.dump_checksums.dict if dump_db else {}
+            dump_name = '%s%s' % (download_db_name, DUMP_MANIFEST_SUFFIX if dump_format == 'directory' else '.zip')
+            dump_url = '%s%s' % (dump_build.http_log_url(), dump_name)
+            build._log('test-migration', 'Restoring dump [%s](%s) from build [%s](%s)' % (dump_name, dump_url, dump_build.id, dump_build.build_url), log_type='markdown')
         restore_suffix = self.restore_rename_db_suffix or params.dump_db.db_suffix
         assert restore_suffix
         restore_db_name = '%s-%s' % (build.dest, restore_suffix)
 
         build._local_pg_createdb(restore_db_name)
+        base_url = dump_url[:-len(dump_name)]
+        dump_cache = self._dump_cache()
+        if dump_format == 'directory':
+            dump_files = _directory_dump_files(dump_name[:-len(DUMP_MANIFEST_SUFFIX)])
+            fetch_cmds, paths, cache_volumes = self._restore_fetch_cmds(dump_cache, base_url, [dump_name, dump_files['dump'], dump_files['filestore']], checksums)
+            restore_cmds = fetch_cmds + [
+                'grep -q \'"format": "directory"\' %s' % dump_name,
+                'echo "### restoring filestore"',
+                'mkdir -p /data/build/datadir/filestore/%s' % restore_db_name,
+                'tar -I zstd -xf %s -C /data/build/datadir/filestore/%s' % (paths[dump_files['filestore']], restore_db_name),
+                'echo "###restoring db"',
+                'tar -I zstd -xf %s' % paths[dump_files['dump']],
+                # like psql with a plain dump, errors on objects (owners, comments) do not stop the restore
+                '(pg_restore -j %s --no-owner -d %s dump || echo "### pg_restore reported errors")' % (self.dump_jobs or 1, restore_db_name),
+            ]
+        else:
+            fetch_cmds, paths, cache_volumes = self._restore_fetch_cmds(dump_cache, base_url, [dump_name], checksums)
+            restore_cmds = fetch_cmds + [
+                'unzip -q %s' % paths[dump_name],
+                'echo "### restoring filestore"',
+                'mkdir -p /data/build/datadir/filestore/%s' % restore_db_name,
+                'mv filestore/* /data/build/datadir/filestore/%s' % restore_db_name,
+                'echo "###restoring db"',
+                'psql -q %s < dump.sql' % (restore_db_name),
+            ]
         cmd = ' && '.join([
             'mkdir /data/build/restore',
             'cd /data/build/restore',
-            'wget %s' % dump_url,
-            'unzip -q %s' % zip_name,
-            'echo "### restoring filestore"',
-            'mkdir -p /data/build/datadir/filestore/%s' % restore_db_name,
-            'mv filestore/* /data/build/datadir/filestore/%s' % restore_db_name,
-            'echo "###restoring db"',
-            'psql -q %s < dump.sql' % (restore_db_name),
+            ] + restore_cmds + [
             'cd /data/build',
             'echo "### cleaning"',
             'rm -r restore',
@@ -708,7 +896,41 @@ class ConfigStep(models.Model):
 
             ])
 
-        return dict(cmd=cmd, log_path=log_path, build_dir=build._path(), container_name=build._get_docker_name(), cpu_limit=self.cpu_limit)
+        return dict(cmd=cmd, log_path=log_path, build_dir=build._path(), container_name=build._get_docker_name(), cpu_limit=self.cpu_limit, **cache_volumes)
+
+    def _restore_fetch_cmds(self, dump_cache, base_url, file_names, checksums):
+        """ Commands downloading the files of a dump, through the dump cache for the files with a known checksum.
+        :return: tuple (commands, {file_name: path in the container}, docker volumes params)
+        """
+        cmds = []
+        paths = {}
+        to_download = []
+        cached = []
+        for file_name in file_names:
+            checksum = checksums.get(file_name)
+            if dump_cache and checksum:
+                paths[file_name] = '/data/build/dump_cache/%s' % checksum
+                cached.append(dump_cache.has(checksum))
+                if not cached[-1]:
+                    cmds.append(dump_cache.fetch_cmd(checksum, base_url + file_name, '/data/build/dump_cache'))
+            else:
+                paths[file_name] = file_name
+                to_download.append(file_name)
+        if to_download:
+            cmds.insert(0, 'wget %s%s' % ('-q ' if len(file_names) > 1 else '', ' '.join(base_url + file_name for file_name in to_download)))
+        volumes = {}
+        if cached:
+            # only the restores downloading in the cache can write in it
+            volumes['ro_volumes' if all(cached) else 'rw_volumes'] = {'dump_cache': dump_cache.path}
+        return cmds, paths, volumes
+
+    def _dump_cache(self):
+        """ Return the dump cache of the host, None if disabled """
+        if not float(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_dump_cache_size', default=0)):
+            return None
+        path = os.path.join(self.env['runbot.runbot']._root(), 'dump_cache')
+        os.makedirs(path, exist_ok=True)
+        return DumpCache(path)
 
     def _reference_builds(self, bundle, trigger):
         upgrade_dumps_trigger_id = trigger.upgrade_dumps_trigger_id
@@ -794,7 +1016,7 @@ class ConfigStep(models.Model):
         if self.job_type == 'install_odoo':
             kwargs['message'] += ' $$fa-download$$'
             db_suffix = build.params_id.config_data.get('db_name') or self.db_name
-            kwargs['path'] = '%s%s-%s.zip' % (build.http_log_url(), build.dest, db_suffix)
+            kwargs['path'] = '%s%s-%s%s' % (build.http_log_url(), build.dest, db_suffix, DUMP_MANIFEST_SUFFIX if self.dump_format == 'directory' else '.zip')
             kwargs['log_type'] = 'link'
         build._log('', **kwargs)
 
@@ -854,6 +1076,9 @@ class ConfigStep(models.Model):
                 build_values.update(self._make_coverage_results(build))
             if self.test_enable or self.test_tags:
                 build_values.update(self._make_tests_results(build))
+            if self.job_type == 'install_odoo':
+                self._publish_dump_checksums(build)
+                self._store_db_template(build, build_values)
         elif self.job_type == 'test_upgrade':
             build_values.update(self._make_upgrade_results(build))
         return build_values
@@ -920,32 +1145,77 @@ class ConfigStep(models.Model):
             return 'ko'
         return 'ok'
 
-    def _check_module_loaded(self, build):
+    def _log_analysis(self, build, patterns=()):
+        """ Analyze the log of the step in a single pass for all the checkers, and for the stats if the step makes them """
         log_path = build._path('logs', '%s.txt' % self.name)
-        if not grep(log_path, ".modules.loading: Modules loaded."):
+        stat_regexes = self._stat_regexes()._analyzer_regexes() if self.make_stats else []
+        return analyze_log(
+            log_path,
+            strings=[_log_modules_loaded, _log_shutdown],
+            patterns=[_re_error, _re_warning] + list(patterns),
+            stat_regexes=stat_regexes,
+            tail=self._log_tail(build),
+        )
+
+    def _tails_log(self):
+        """ Steps whose results are checked in their log, the ones followed while running """
+        if self.job_type == 'test_upgrade':
+            return True
+        if self.job_type == 'python' and self.python_result_code and self.python_result_code != PYTHON_DEFAULT:
+            return False
+        return self.job_type in ('install_odoo', 'python') and bool(self.test_enable or self.test_tags)
+
+    def _log_tail(self, build):
+        """ Return the LogTail of the step log stored on build, if it follows this step """
+        if build.log_tail.get('step_id') != self.id:
+            return None
+        return LogTail.from_dict(build.log_tail.dict)
+
+    def _tail_log(self, build):
+        """ Scan the lines added to the step log since the last turn, and fail
+        the build as soon as an error appears instead of waiting for the end of
+        the step. Warnings are only remembered for the checks made at the end.
+        :return: True if the build was killed
+        """
+        if not self._tails_log():
+            return False
+        tail = self._log_tail(build) or LogTail(strings=[_log_modules_loaded, _log_shutdown], patterns=[_re_error, _re_warning])
+        offset = tail.offset
+        new_matches = tail.update(build._path('logs', '%s.txt' % self.name))
+        if tail.offset != offset:
+            build.log_tail = dict(tail.to_dict(), step_id=self.id)
+        if _re_error not in new_matches or build.local_result == 'ko':
+            return False
+        build._log('_tail_log', 'Error found in logs while running %s:\n%s' % (self.name, new_matches[_re_error][:1000]), level='ERROR')
+        if self.fail_fast:
+            build._kill(result='ko')
+            return True
+        build.local_result = 'ko'
+        build._github_status()  # failfast
+        return False
+
+    def _check_module_loaded(self, build):
+        if not self._log_analysis(build).found(_log_modules_loaded):
             build._log('_make_tests_results', "Modules loaded not found in logs", level="ERROR")
             return 'ko'
         return 'ok'
 
     def _check_error(self, build, regex=None):
-        log_path = build._path('logs', '%s.txt' % self.name)
         regex = regex or _re_error
-        if rfind(log_path, regex):
+        if self._log_analysis(build, [regex]).matched(regex):
             build._log('_make_tests_results', 'Error or traceback found in logs', level="ERROR")
             return 'ko'
         return 'ok'
 
     def _check_warning(self, build, regex=None):
-        log_path = build._path('logs', '%s.txt' % self.name)
         regex = regex or _re_warning
-        if rfind(log_path, regex):
+        if self._log_analysis(build, [regex]).matched(regex):
             build._log('_make_tests_results', 'Warning found in logs', level="WARNING")
             return 'warn'
         return 'ok'
 
     def _check_build_ended(self, build):
-        log_path = build._path('logs', '%s.txt' % self.name)
-        if not grep(log_path, "Initiating shutdown"):
+        if not self._log_analysis(build).found(_log_shutdown):
             build._log('_make_tests_results', 'No "Initiating shutdown" found in logs, maybe because of cpu limit.', level="ERROR")
             return 'ko'
         return 'ok'
@@ -989,16 +1259,16 @@ class ConfigStep(models.Model):
             build._log('make_stats', 'Log **%s.txt** file not found' % self.name, level='INFO', log_type='markdown')
             return
         try:
-            regex_ids = self.build_stat_regex_ids
-            if not regex_ids:
-                regex_ids = regex_ids.search([('generic', '=', True)])
-            key_values = regex_ids._find_in_file(log_path)
+            key_values = self._stat_regexes()._find_in_file(log_path)
             self.env['runbot.build.stat']._write_key_values(build, self, key_values)
         except Exception as e:
             message = '**An error occured while computing statistics of %s:**\n`%s`' % (build.job, str(e).replace('\\n', '\n').replace("\\'", "'"))
             _logger.exception(message)
             build._log('make_stats', message, level='INFO', log_type='markdown')
 
+    def _stat_regexes(self):
+        return self.build_stat_regex_ids or self.build_stat_regex_ids.search([('generic', '=', True)])
+
     def _step_state(self):
         self.ensure_one()
         if self.job_type == 'run_odoo' or (self.job_type == 'python' and self.running_job):
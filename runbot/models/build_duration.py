@@ -0,0 +1,77 @@
+import logging
+
+from odoo import models, fields, api
+
+_logger = logging.getLogger(__name__)
+
+
+class BuildDuration(models.Model):
+    _name = 'runbot.build.duration'
+    _description = "Step duration"
+    _log_access = False
+
+    trigger_id = fields.Many2one('runbot.trigger', 'Trigger', index=True, ondelete='cascade')
+    config_id = fields.Many2one('runbot.build.config', 'Config', index=True, required=True, ondelete='cascade')
+    step_id = fields.Many2one('runbot.build.config.step', 'Step', required=True, ondelete='cascade')
+    version_id = fields.Many2one('runbot.version', 'Version', ondelete='cascade')
+    duration = fields.Float('Duration (s)', help="Exponential moving average of the duration of the step")
+    count = fields.Integer('Count')
+    last_update = fields.Datetime('Last update')
+
+    @api.model
+    def _learn(self, build, step, duration):
+        """ Update the moving average duration of step for builds like build """
+        alpha = float(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_duration_alpha', default=0.3))
+        key = [
+            ('trigger_id', '=', build.trigger_id.id),
+            ('config_id', '=', build.config_id.id),
+            ('step_id', '=', step.id),
+            ('version_id', '=', build.version_id.id),
+        ]
+        record = self.search(key, limit=1)
+        values = {'last_update': fields.Datetime.now()}
+        if record:
+            values.update(duration=alpha * duration + (1 - alpha) * record.duration, count=record.count + 1)
+            record.write(values)
+        else:
+            values.update({field: value for field, _, value in key}, duration=duration, count=1)
+            record = self.create(values)
+        return record
+
+    @api.model
+    def _step_durations(self, trigger, config, version):
+        """ Return the known duration of each step of config by step id.
+        Durations learned with the same trigger and version are preferred,
+        otherwise the average of the best matching ones is used.
+        """
+        candidates = {}
+        for record in self.search([('config_id', '=', config.id)]):
+            score = (record.trigger_id == trigger, record.version_id == version)
+            best_score, durations = candidates.get(record.step_id.id, (None, []))
+            if best_score is None or score > best_score:
+                candidates[record.step_id.id] = (score, [record.duration])
+            elif score == best_score:
+                durations.append(record.duration)
+        return {step_id: sum(durations) / len(durations) for step_id, (_, durations) in candidates.items()}
+
+    @api.model
+    def _predict(self, trigger, config, version, cache=None):
+        """ Predicted duration of a build using config, until it and the builds
+        it creates are done: the longest path between its own steps and the
+        critical path of its children. Running steps are not counted.
+        """
+        cache = {} if cache is None else cache
+        key = (trigger.id, config.id, version.id)
+        if key not in cache:
+            cache[key] = 0  # a config creating builds of itself would recurse without end
+            durations = self._step_durations(trigger, config, version)
+            elapsed = critical_path = 0
+            for step in config.step_ids():
+                if step._step_state() == 'running':
+                    continue
+                elapsed += durations.get(step.id, 0)
+                if step.job_type == 'create_build':
+                    for create_config in step.create_config_ids:
+                        critical_path = max(critical_path, elapsed + self._predict(trigger, create_config, version, cache))
+            cache[key] = max(elapsed, critical_path)
+        return cache[key]
@@ -2,6 +2,7 @@
 import logging
 
 from ..common import os
+from ..log_analyzer import analyze_log
 import re
 
 from odoo import models, fields, api
@@ -44,30 +45,14 @@ class BuildStatRegex(models.Model):
                     "The regular expresion should contain the name group pattern 'value' e.g: '(?P<value>.+)'"
                 )
 
+    def _analyzer_regexes(self):
+        return [(build_stat_regex.name, build_stat_regex.regex) for build_stat_regex in self]
+
     def _find_in_file(self, file_path):
         """ Search file regexes and write stats
             returns a dict of key:values
         """
         if not os.path.exists(file_path):
             return {}
-        key_values = {}
-        with open(file_path, "r") as log_file:
-            data = log_file.read()
-            for build_stat_regex in self:
-                for match in re.finditer(build_stat_regex.regex, data):
-                    group_dict = match.groupdict()
-                    try:
-                        value = float(group_dict.get("value"))
-                    except ValueError:
-                        _logger.warning(
-                            'The matched value (%s) of "%s" cannot be converted into float',
-                            group_dict.get("value"), build_stat_regex.regex
-                        )
-                        continue
-                    key = (
-                        "%s.%s" % (build_stat_regex.name, group_dict["key"])
-                        if "key" in group_dict
-                        else build_stat_regex.name
-                    )
-                    key_values[key] = value
-        return key_values
+        stat_regexes = self._analyzer_regexes()
+        return analyze_log(file_path, stat_regexes=stat_regexes).stat_values(stat_regexes)
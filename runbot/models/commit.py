@@ -2,15 +2,31 @@
 import subprocess
 
 from ..common import os, RunbotException
+from odoo.addons.runbot_github.github import GithubClient
 import glob
-import shutil
+import json
+import tempfile
 
+import requests
+
+from concurrent.futures import ThreadPoolExecutor
 from odoo import models, fields, api, registry
 import logging
 
 _logger = logging.getLogger(__name__)
 
 
+def _post_status(domain, token, url, payload, dbname=None):
+    """ Post a status to github, return an error message or None. Runs outside of any cursor """
+    client = GithubClient(token, host='api.%s' % domain, dbname=dbname)
+    try:
+        response = client.request('POST', url, data=json.dumps(payload), headers={'Accept': 'application/vnd.github.she-hulk-preview+json'})
+        response.raise_for_status()
+    except requests.RequestException as e:
+        return str(e)
+    return None
+
+
 class Commit(models.Model):
     _name = 'runbot.commit'
     _description = "Commit"
@@ -39,6 +55,20 @@ class Commit(models.Model):
             commit = self.env['runbot.commit'].create({**(vals or {}), 'name': name, 'repo_id': repo_id, 'rebase_on_id': rebase_on_id})
         return commit
 
+    @api.model
+    def _get_many(self, repo_id, vals_per_name):
+        """ Bulk version of _get for non rebased commits: one search for all
+        names and a single create for the missing ones.
+        :param vals_per_name: dict {sha: values used if the commit is created}
+        :return: dict {sha: commit}
+        """
+        commits = {commit.name: commit for commit in self.search([('name', 'in', list(vals_per_name)), ('repo_id', '=', repo_id), ('rebase_on_id', '=', False)])}
+        missing = [name for name in vals_per_name if name not in commits]
+        if missing:
+            new_commits = self.create([{**(vals_per_name[name] or {}), 'name': name, 'repo_id': repo_id, 'rebase_on_id': False} for name in missing])
+            commits.update(zip(missing, new_commits))
+        return commits
+
     def _rebase_on(self, commit):
         if self == commit:
             return self
@@ -65,14 +95,25 @@ class Commit(models.Model):
 
 
         _logger.info('git export: exporting to %s (new)', export_path)
-        os.makedirs(export_path)
 
         self.repo_id._fetch(self.name)
         export_sha = self.name
         if self.rebase_on_id:
-            export_sha = self.rebase_on_id.name
-            self.rebase_on_id.repo_id._fetch(export_sha)
+            self.rebase_on_id.repo_id._fetch(self.rebase_on_id.name)
+            _logger.info('Rebasing %s on %s', self.name, self.rebase_on_id.name)
+            export_sha = self._rebased_tree()
+
+        store = self.repo_id._export_store()
+        if store:
+            try:
+                files, written = store.export(export_sha, export_path)
+            except (OSError, subprocess.CalledProcessError) as e:
+                raise RunbotException("Export for %s failed. (%s)" % (self.name, e))
+            _logger.info('git export: %s files exported, %s new blobs stored', files, written)
+            self._link_migration_scripts()
+            return export_path
 
+        os.makedirs(export_path)
         p1 = subprocess.Popen(['git', '--git-dir=%s' % self.repo_id.path, 'archive', export_sha], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
         p2 = subprocess.Popen(['tar', '-xmC', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
         p1.stdout.close()  # Allow p1 to receive a SIGPIPE if p2 exits.
@@ -83,22 +124,37 @@ class Commit(models.Model):
         if err:
             raise RunbotException("Export for %s failed. (%s)" % (self.name, err))
 
-        if self.rebase_on_id:
-            # we could be smart here and detect if merge_base == commit, in witch case checkouting base_commit is enough. Since we don't have this info
-            # and we are exporting in a custom folder anyway, lets
-            _logger.info('Applying patch for %s', self.name)
-            p1 = subprocess.Popen(['git', '--git-dir=%s' % self.repo_id.path, 'diff', '%s...%s' % (export_sha, self.name)], stderr=subprocess.PIPE, stdout=subprocess.PIPE)
-            p2 = subprocess.Popen(['patch', '-p0', '-d', export_path], stdin=p1.stdout, stdout=subprocess.PIPE)
-            p1.stdout.close()
-            (message, err) = p2.communicate()
-            p1.poll()
-            if err:
-                shutil.rmtree(export_path)
-                raise RunbotException("Apply patch failed for %s...%s. (%s)" % (export_sha, self.name, err))
-            if p1.returncode or p2.returncode:
-                shutil.rmtree(export_path)
-                raise RunbotException("Apply patch failed for %s...%s with error code %s+%s. (%s)" % (export_sha, self.name, p1.returncode, p2.returncode, message))
+        self._link_migration_scripts()
+        return export_path
 
+    def _rebased_tree(self):
+        """ Apply the changes of this commit since its merge base with
+        rebase_on_id on top of rebase_on_id, in a temporary index of the bare
+        repo, and return the sha of the resulting tree object. Renames and
+        binary files are supported. Conflicts fall back on a 3 way merge,
+        where git supports it in the index only (older versions refuse
+        --3way with --cached, the patch has to apply cleanly there).
+        """
+        self.ensure_one()
+        base_sha = self.rebase_on_id.name
+        git = ['git', '--git-dir=%s' % self.repo_id.path]
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmp_dir, 'index'))
+            try:
+                subprocess.check_output(git + ['read-tree', base_sha], env=env, stderr=subprocess.STDOUT)
+                diff = subprocess.check_output(git + ['diff', '--binary', '--full-index', '--find-renames', '%s...%s' % (base_sha, self.name)], stderr=subprocess.PIPE)
+                if diff:
+                    apply = subprocess.run(git + ['apply', '--cached'], input=diff, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+                    if apply.returncode:
+                        # a failed apply leaves the index untouched
+                        merge = subprocess.run(git + ['apply', '--cached', '--3way'], input=diff, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, env=env)
+                        if merge.returncode:
+                            raise RunbotException("Apply patch failed for %s...%s with error code %s. (%s)" % (base_sha, self.name, apply.returncode, apply.stdout.decode() + merge.stdout.decode()))
+                return subprocess.check_output(git + ['write-tree'], env=env, stderr=subprocess.STDOUT).decode().strip()
+            except subprocess.CalledProcessError as e:
+                raise RunbotException("Rebase of %s on %s failed. (%s)" % (self.name, base_sha, (e.output or b'').decode() + (e.stderr or b'').decode()))
+
+    def _link_migration_scripts(self):
         # migration scripts link if necessary
         icp = self.env['ir.config_parameter']
         ln_param = icp.get_param('runbot_migration_ln', default='')
@@ -110,8 +166,6 @@ class Commit(models.Model):
             except FileNotFoundError:
                 _logger.warning('Impossible to create migration symlink')
 
-        return export_path
-
     def read_source(self, file, mode='r'):
         file_path = self._source_path(file)
         try:
@@ -179,8 +233,27 @@ class CommitStatus(models.Model):
     target_url = fields.Char('Url')
     description = fields.Char('Description')
     sent_date = fields.Datetime('Sent Date')
+    to_send = fields.Boolean('To send', index=True, help="Waiting in the queue of the status worker")
+    send_tries = fields.Integer('Send tries')
+    claimed_date = fields.Datetime('Claimed date', help="Set while a status worker is sending it")
+
+    def init(self):
+        self.env.cr.execute("""
+CREATE OR REPLACE FUNCTION runbot_commit_status_notify() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('runbot_status', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS runbot_commit_status_notify_trigger ON runbot_commit_status;
+CREATE TRIGGER runbot_commit_status_notify_trigger
+AFTER INSERT OR UPDATE OF to_send ON runbot_commit_status
+FOR EACH ROW WHEN (NEW.to_send) EXECUTE PROCEDURE runbot_commit_status_notify();
+        """)
 
     def _send(self, post_commit=True):
+        if self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_status_queue'):
+            return self._enqueue()
         user_id = self.env.user.id
         _dbname = self.env.cr.dbname
         _context = self.env.context
@@ -195,12 +268,7 @@ class CommitStatus(models.Model):
         remote_ids = remotes.ids
         commit_name = commit.name
 
-        status = {
-            'context': self.context,
-            'state': self.state,
-            'target_url': self.target_url,
-            'description': self.description,
-        }
+        status = self._github_payload()
         if remote_ids:
 
             def send_github_status(env):
@@ -224,3 +292,104 @@ class CommitStatus(models.Model):
                 self._cr.after('commit', send_github_status_async)
             else:
                 send_github_status(self.env)
+
+    def _github_payload(self):
+        self.ensure_one()
+        return {
+            'context': self.context,
+            'state': self.state,
+            'target_url': self.target_url,
+            'description': self.description,
+        }
+
+    def _enqueue(self):
+        """ Queue the statuses for the status worker, superseding the ones of the same commit and context still in the queue """
+        self.flush(['to_send', 'commit_id', 'context'])
+        for status in self:
+            # only the rows locked by a worker claiming them are skipped. Claimed
+            # statuses are committed and unlocked while being sent, so they are
+            # superseded too: the worker still posts them, but does not retry them
+            self.env.cr.execute("""
+                UPDATE runbot_commit_status SET to_send = false
+                WHERE id IN (
+                    SELECT id FROM runbot_commit_status
+                    WHERE to_send AND commit_id = %s AND context = %s AND id < %s
+                    FOR UPDATE SKIP LOCKED
+                )
+            """, [status.commit_id.id, status.context, status.id])
+            self.invalidate_cache(['to_send'])
+            status.write({'to_send': True, 'send_tries': 0})
+
+    @api.model
+    def _send_queued(self, limit=100):
+        """ Send the queued statuses to github with a bounded pool of threads, return the number of statuses handled.
+        The statuses are claimed and committed before being sent, so that no lock is held during the requests.
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        max_workers = int(get_param('runbot.runbot_status_workers', default=4))
+        max_tries = int(get_param('runbot.runbot_status_max_tries', default=3))
+        self.flush(['to_send', 'commit_id', 'context', 'claimed_date'])
+        # only the newest state of a (commit, context) is worth sending
+        self.env.cr.execute("""
+            UPDATE runbot_commit_status SET to_send = false
+            WHERE id IN (
+                SELECT id FROM runbot_commit_status status
+                WHERE to_send AND EXISTS (
+                    SELECT 1 FROM runbot_commit_status newer
+                    WHERE newer.to_send AND newer.commit_id = status.commit_id AND newer.context = status.context AND newer.id > status.id
+                )
+                FOR UPDATE SKIP LOCKED
+            )
+        """)
+        # a claim older than ten minutes is the one of a dead worker, a status
+        # waits for an older one of the same commit and context being sent
+        self.env.cr.execute("""
+            UPDATE runbot_commit_status SET claimed_date = (now() at time zone 'UTC')
+            WHERE id IN (
+                SELECT id FROM runbot_commit_status status
+                WHERE to_send
+                AND (claimed_date IS NULL OR claimed_date < (now() at time zone 'UTC') - interval '10 minutes')
+                AND NOT EXISTS (
+                    SELECT 1 FROM runbot_commit_status older
+                    WHERE older.commit_id = status.commit_id AND older.context = status.context AND older.id < status.id
+                    AND older.claimed_date >= (now() at time zone 'UTC') - interval '10 minutes'
+                )
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id
+        """, [limit])
+        statuses = self.browse(sorted(status_id for (status_id,) in self.env.cr.fetchall()))
+        self.invalidate_cache(['to_send', 'claimed_date'])
+        if not statuses:
+            return 0
+
+        requests_by_status = {}
+        for status in statuses:
+            remotes = status.commit_id.repo_id.remote_ids.sudo().filtered(lambda remote: remote.token and remote.owner and remote.repo_name and remote.repo_domain)
+            payload = status._github_payload()
+            requests_by_status[status] = [(
+                remote.repo_domain,
+                remote.token,
+                'https://api.%s/repos/%s/%s/statuses/%s' % (remote.repo_domain, remote.owner, remote.repo_name, status.commit_id.name),
+                payload,
+                self.env.cr.dbname,
+            ) for remote in remotes]
+
+        self.env.cr.commit()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {status: [executor.submit(_post_status, *request) for request in status_requests] for status, status_requests in requests_by_status.items()}
+            errors = {status: [future.result() for future in status_futures if future.result()] for status, status_futures in futures.items()}
+
+        statuses.invalidate_cache(['to_send'])  # may have been superseded while sending
+        now = fields.Datetime.now()
+        for status in statuses:
+            if not errors[status]:
+                _logger.info('github updated %s status %s to %s', status.context, status.commit_id.name, status.state)
+                status.write({'to_send': False, 'sent_date': now, 'claimed_date': False})
+            else:
+                tries = status.send_tries + 1
+                _logger.warning('Failed to send %s status %s (try %s): %s', status.context, status.commit_id.name, tries, ', '.join(errors[status]))
+                status.write({'to_send': status.to_send and tries < max_tries, 'send_tries': tries, 'claimed_date': False})
+        return len(statuses)
@@ -1,5 +1,11 @@
 import logging
+import shutil
+
+from psycopg2 import sql
+
 from odoo import models, fields, api
+from ..common import fqdn, local_pgadmin_cursor, os, DB_TEMPLATE_PREFIX
+from ..fields import JsonDictField
 _logger = logging.getLogger(__name__)
 
 
@@ -10,6 +16,8 @@ class Database(models.Model):
     name = fields.Char('Host name', required=True, unique=True)
     build_id = fields.Many2one('runbot.build', index=True, required=True)
     db_suffix = fields.Char(compute='_compute_db_suffix')
+    dump_format = fields.Selection([('zip', 'Zip of a sql dump'), ('directory', 'Parallel directory dump')], 'Dump format', default='zip')
+    dump_checksums = JsonDictField('Dump checksums', help="sha256 of the published dump files, by file name")
 
     def _compute_db_suffix(self):
         for record in self:
@@ -21,3 +29,105 @@ class Database(models.Model):
         if res:
             return res
         return super().create(values)
+
+
+class DatabaseTemplate(models.Model):
+    _name = 'runbot.database.template'
+    _description = "Installed database template"
+    _order = 'last_used desc, id desc'
+
+    name = fields.Char('Database name', required=True)
+    key = fields.Char('Key', required=True, index=True, help="Hash of the commits, modules and step parameters used to install the database")
+    host = fields.Char('Host', required=True, index=True)
+    build_id = fields.Many2one('runbot.build', 'Installed by', ondelete='set null')
+    size = fields.Float('Size (MiB)')
+    last_used = fields.Datetime('Last used', default=fields.Datetime.now)
+    hits = fields.Integer('Hits')
+
+    _sql_constraints = [
+        ('unique_host_key', 'unique (host, key)', 'A template is installed only once per host'),
+    ]
+
+    def _filestore_path(self, name=None):
+        return os.path.join(self.env['runbot.runbot']._root(), 'db_templates', name or self.name)
+
+    @api.model
+    def _find(self, key):
+        return self.search([('host', '=', fqdn()), ('key', '=', key)], limit=1)
+
+    @api.model
+    def _store(self, key, build, db_name):
+        """ Keep a copy of the database and filestore installed by build as template for key """
+        name = '%s%s' % (DB_TEMPLATE_PREFIX, key[:16])
+        filestore_path = build._path('datadir', 'filestore', db_name)
+        template_filestore_path = self._filestore_path(name)
+        try:
+            build._local_pg_dropdb(name)
+            shutil.rmtree(template_filestore_path, ignore_errors=True)
+            with local_pgadmin_cursor() as local_cr:
+                local_cr.execute(sql.SQL("CREATE DATABASE {} TEMPLATE {}").format(sql.Identifier(name), sql.Identifier(db_name)))
+                local_cr.execute("SELECT pg_database_size(%s)", (name,))
+                size = local_cr.fetchone()[0]
+            if os.path.exists(filestore_path):
+                shutil.copytree(filestore_path, template_filestore_path, copy_function=_link_or_copy)
+            else:
+                os.makedirs(template_filestore_path)
+            for dir_path, _, file_names in os.walk(template_filestore_path):
+                size += sum(os.lstat(os.path.join(dir_path, file_name)).st_size for file_name in file_names)
+        except Exception as e:
+            _logger.warning('Cannot store database %s as template: %s', db_name, e)
+            build._local_pg_dropdb(name)
+            shutil.rmtree(template_filestore_path, ignore_errors=True)
+            return self
+        template = self.create({
+            'name': name,
+            'key': key,
+            'host': fqdn(),
+            'build_id': build.id,
+            'size': size / 1024 / 1024,
+        })
+        self._evict()
+        return template.exists()
+
+    def _clone(self, build, db_name):
+        """ Create db_name and its filestore from the template, return False if the template is not usable """
+        self.ensure_one()
+        filestore_path = build._path('datadir', 'filestore', db_name)
+        try:
+            build._local_pg_createdb(db_name, db_template=self.name)
+            shutil.rmtree(filestore_path, ignore_errors=True)
+            shutil.copytree(self._filestore_path(), filestore_path, copy_function=_link_or_copy)
+        except Exception as e:
+            build._log('_run_install_odoo', 'Database template %s not usable: %s' % (self.name, e), level='WARNING')
+            self._drop()
+            return False
+        self.write({'hits': self.hits + 1, 'last_used': fields.Datetime.now()})
+        return True
+
+    def _drop(self):
+        for template in self:
+            self.env['runbot.build']._local_pg_dropdb(template.name)
+            shutil.rmtree(template._filestore_path(), ignore_errors=True)
+        self.unlink()
+
+    @api.model
+    def _evict(self):
+        """ Drop the least recently used templates of the host exceeding the quota """
+        quota = float(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_db_template_quota', default=0)) * 1024
+        total_size = 0
+        to_drop = self.browse()
+        for template in self.search([('host', '=', fqdn())]):
+            total_size += template.size
+            if total_size > quota:
+                to_drop |= template
+        if to_drop:
+            _logger.info('Dropping database templates %s', ', '.join(to_drop.mapped('name')))
+            to_drop._drop()
+
+
+def _link_or_copy(src, dst):
+    """ Filestore files are never modified in place, they can be shared between databases """
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
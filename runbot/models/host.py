@@ -1,7 +1,8 @@
 import logging
 from odoo import models, fields, api
-from ..common import fqdn, local_pgadmin_cursor, os
-from ..container import docker_build
+from ..common import fqdn, local_pgadmin_cursor, os, percentile
+from ..container import docker_build, docker_stats, sanitize_container_name
+from ..fields import JsonDictField
 _logger = logging.getLogger(__name__)
 
 
@@ -28,6 +29,13 @@ class Host(models.Model):
     last_exception = fields.Char('Last exception')
     exception_count = fields.Integer('Exception count')
     psql_conn_count = fields.Integer('SQL connections count', default=0)
+    cpu_capacity = fields.Float('Cpu capacity', tracking=True, help="Number of cpus available for builds. When a capacity is set, builds are allocated according to the resources estimated on their config steps instead of the number of workers")
+    memory_capacity = fields.Float('Memory capacity (GiB)', tracking=True, help="Memory available for builds, see cpu capacity")
+    last_stats_sample = fields.Datetime('Last containers stats sample')
+    last_docker_calls = fields.Integer('Docker calls during last scheduler turn')
+    db_template_hits = fields.Integer('Database templates hits', help="Install steps restored from an installed database template")
+    db_template_misses = fields.Integer('Database templates misses', help="Install steps that could have used a database template but none was available")
+    turn_stats = JsonDictField('Loop turns stats', help="Last samples of duration, queries, subprocesses and commits of each phase, by loop")
 
     def _compute_nb(self):
         groups = self.env['runbot.build'].read_group(
@@ -49,6 +57,84 @@ class Host(models.Model):
             values['disp_name'] = values['name']
         return super().create(values)
 
+    def _uses_resources(self):
+        self.ensure_one()
+        return bool(self.cpu_capacity or self.memory_capacity)
+
+    def _free_resources(self, builds, ratio=1):
+        """ Return the (cpus, memory) remaining once resources of builds are reserved, a capacity of 0 meaning unlimited """
+        self.ensure_one()
+        cpu_free = self.cpu_capacity * ratio if self.cpu_capacity else float('inf')
+        memory_free = self.memory_capacity * ratio if self.memory_capacity else float('inf')
+        for build in builds:
+            cpu, memory = build._get_resources()
+            cpu_free -= cpu
+            memory_free -= memory
+        return cpu_free, memory_free
+
+    def _pack_builds(self, candidates, cpu_free, memory_free, empty=False):
+        """ Greedily select the candidates fitting in the free resources, in candidates order.
+        A candidate that could fit once some room is freed stops the selection so that smaller
+        builds cannot starve it. A candidate bigger than the host capacity is only accepted alone.
+        """
+        self.ensure_one()
+        cpu_capacity = self.cpu_capacity or float('inf')
+        memory_capacity = self.memory_capacity or float('inf')
+        selected = candidates.browse()
+        for build in candidates:
+            cpu, memory = build._get_resources()
+            if cpu <= cpu_free and memory <= memory_free:
+                selected |= build
+                cpu_free -= cpu
+                memory_free -= memory
+            elif cpu > cpu_capacity or memory > memory_capacity:
+                if empty and not selected:
+                    return build
+            else:
+                break
+        return selected
+
+    def _sample_containers_resources(self):
+        """ Keep the peak resources used by the containers of the testing builds, used to learn steps resources """
+        self.ensure_one()
+        if not self._uses_resources():
+            return
+        frequency = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_stats_frequency', default=60))
+        now = fields.Datetime.now()
+        if self.last_stats_sample and (now - self.last_stats_sample).total_seconds() < frequency:
+            return
+        self.last_stats_sample = now
+        stats = docker_stats()
+        for build in self.env['runbot.build'].search([('host', '=', self.name), ('local_state', '=', 'testing')]):
+            usage = stats.get(sanitize_container_name(build._get_docker_name()))
+            if not usage:
+                continue
+            cpu, memory = usage
+            memory = memory / 1024 ** 3
+            if cpu > build.peak_cpu or memory > build.peak_memory:
+                build.write({'peak_cpu': max(cpu, build.peak_cpu), 'peak_memory': max(memory, build.peak_memory)})
+
+    def _record_turn_stats(self, loop, phases):
+        """ Append the values of each phase of a loop turn to the rolling samples of the host """
+        self.ensure_one()
+        size = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_turn_stats_samples', default=50))
+        loop_stats = dict(self.turn_stats.get(loop) or {})
+        for phase, values in phases.items():
+            samples = loop_stats.get(phase) or {}
+            loop_stats[phase] = {key: (samples.get(key, []) + [round(value, 3)])[-size:] for key, value in values.items()}
+        self.turn_stats[loop] = loop_stats
+
+    def _turn_stats_percentiles(self):
+        """ Return a list of (loop, phase, {key: (p50, p95)}), slowest phases first """
+        self.ensure_one()
+        result = []
+        for loop, loop_stats in sorted(self.turn_stats.items()):
+            phases = []
+            for phase, samples in loop_stats.items():
+                phases.append((loop, phase, {key: (percentile(values, 0.5), percentile(values, 0.95)) for key, values in samples.items()}))
+            result += sorted(phases, key=lambda phase: phase[2].get('duration', (0, 0))[1], reverse=True)
+        return result
+
     def _bootstrap_db_template(self):
         """ boostrap template database if needed """
         icp = self.env['ir.config_parameter']
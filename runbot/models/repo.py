@@ -6,17 +6,127 @@ import re
 import subprocess
 import time
 
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
 import dateutil
 import requests
 
 from pathlib import Path
 
-from odoo import models, fields, api
+from odoo import models, fields, api, registry
+from odoo.addons.runbot_github.github import GithubClient
 from ..common import os, RunbotException
+from ..export_store import ExportStore
+from ..fields import JsonDictField
 from odoo.exceptions import UserError
 from odoo.tools.safe_eval import safe_eval
 
 _logger = logging.getLogger(__name__)
+# number of git commands run by this process
+_git_calls = {'count': 0}
+
+
+def git_calls_count():
+    return _git_calls['count']
+
+
+def _fetch_repo(dbname, uid, context, repo_id, commands=None):
+    """ Fetch a repo from a fetch thread, with a cursor of its own. Without
+    commands, the full fetch is done by _update_fetch_cmd, otherwise the
+    targeted fetch commands are run once: a missing ref will not appear by
+    retrying, the next full fetch will sort it out.
+    The failures reported by _update_fetch_cmd are returned instead of being
+    handled in the thread, so that the host is only reserved by the caller.
+    :return: tuple (success, output of the failure, duration)
+    """
+    start = time.time()
+    failures = []
+    with api.Environment.manage(), registry(dbname).cursor() as cr:
+        repo = api.Environment(cr, uid, dict(context, fetch_failures=failures))['runbot.repo'].browse(repo_id)
+        if not commands:
+            success = repo._update_fetch_cmd()
+            return success, '\n'.join(failures), time.time() - start
+        for cmd in commands:
+            try:
+                repo._git(cmd)
+            except subprocess.CalledProcessError as e:
+                return False, e.output.decode(errors='replace'), time.time() - start
+        return True, '', time.time() - start
+
+
+_full_sha_re = re.compile(r'^[0-9a-f]{40}$')
+
+
+class CatFile(object):
+    """ Long lived `git cat-file --batch-check` process of a repo: object
+    existence and type/size lookups are pipe round trips instead of a git
+    process each. Objects looked up by full sha are kept in a small LRU. The process is
+    restarted when the packs of the repo changed, e.g. after a fetch.
+    """
+
+    def __init__(self, path, cache_size=1000):
+        self.path = path
+        self.cache_size = cache_size
+        self.known = OrderedDict()
+        self.process = None
+        self.packs_mtime = None
+
+    def _packs_mtime(self):
+        try:
+            return os.path.getmtime(os.path.join(self.path, 'objects', 'pack'))
+        except OSError:
+            return None
+
+    def _start(self):
+        self.close()
+        self.packs_mtime = self._packs_mtime()
+        _logger.info('Starting git cat-file process for %s', self.path)
+        _git_calls['count'] += 1
+        self.process = subprocess.Popen(['git', '-C', self.path, 'cat-file', '--batch-check'], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+
+    def close(self):
+        if self.process:
+            try:
+                self.process.stdin.close()
+                self.process.wait(timeout=5)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+            self.process = None
+
+    def info(self, name):
+        """ Return (sha, type, size) of object name, None if it does not exist.
+        Raise an OSError if the process is not usable.
+        """
+        if name in self.known:
+            self.known.move_to_end(name)
+            return self.known[name]
+        if not name or any(c.isspace() for c in name):
+            return None
+        if not self.process or self.process.poll() is not None or self._packs_mtime() != self.packs_mtime:
+            self._start()
+        try:
+            self.process.stdin.write(name.encode() + b'\n')
+            self.process.stdin.flush()
+            line = self.process.stdout.readline().decode().split()
+        except OSError:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise OSError('git cat-file process of %s died' % self.path)
+        if len(line) != 3:  # "<name> missing" or "<name> ambiguous"
+            return None
+        info = (line[0], line[1], int(line[2]))
+        if _full_sha_re.match(name):  # a ref or an abbreviated sha may point to another object later
+            self.known[name] = info
+            if len(self.known) > self.cache_size:
+                self.known.popitem(last=False)
+        return info
+
+
+# cat-file processes of this process by repo path
+_cat_files = {}
 
 
 def _sanitize(name):
@@ -155,6 +265,20 @@ class Remote(models.Model):
         self._cr.after('commit', self.repo_id._update_git_config)
         return res
 
+    def _queue_hook_ref(self, name, is_pr, sha):
+        """ Remember a ref received in a hook payload so that the leader
+        only fetches this ref instead of all remotes """
+        for remote in self:
+            if (is_pr and remote.fetch_pull) or (not is_pr and remote.fetch_heads):
+                self.env['runbot.repo.hookref'].create({
+                    'repo_id': remote.repo_id.id,
+                    'remote_id': remote.id,
+                    'name': name,
+                    'is_pr': is_pr,
+                    'sha': sha,
+                    'time': time.time(),
+                })
+
     def _github(self, url, payload=None, ignore_errors=False, nb_tries=2, recursive=False):
         generator = self.sudo()._github_generator(url, payload=payload, ignore_errors=ignore_errors, nb_tries=nb_tries, recursive=recursive)
         if recursive:
@@ -164,15 +288,14 @@ class Remote(models.Model):
 
     def _github_generator(self, url, payload=None, ignore_errors=False, nb_tries=2, recursive=False):
         """Return a http request to be sent to github"""
+        cache_size = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_github_cache_size', default=10000))
         for remote in self:
             if remote.owner and remote.repo_name and remote.repo_domain:
                 url = url.replace(':owner', remote.owner)
                 url = url.replace(':repo', remote.repo_name)
-                url = 'https://api.%s%s' % (remote.repo_domain, url)
-                session = requests.Session()
-                if remote.token:
-                    session.auth = (remote.token, 'x-oauth-basic')
-                session.headers.update({'Accept': 'application/vnd.github.she-hulk-preview+json'})
+                client = GithubClient(remote.token, host='api.%s' % remote.repo_domain, dbname=self.env.cr.dbname, cache=True, cache_size=cache_size)
+                url = client.url(url)
+                headers = {'Accept': 'application/vnd.github.she-hulk-preview+json'}
                 while url:
                     if recursive:
                         _logger.info('Getting page %s', url)
@@ -180,9 +303,9 @@ class Remote(models.Model):
                     while try_count < nb_tries:
                         try:
                             if payload:
-                                response = session.post(url, data=json.dumps(payload))
+                                response = client.request('POST', url, data=json.dumps(payload), headers=headers)
                             else:
-                                response = session.get(url)
+                                response = client.request('GET', url, headers=headers)
                             response.raise_for_status()
                             if try_count > 0:
                                 _logger.info('Success after %s tries', (try_count + 1))
@@ -201,7 +324,7 @@ class Remote(models.Model):
                         except requests.HTTPError:
                             try_count += 1
                             if try_count < nb_tries:
-                                time.sleep(2)
+                                time.sleep(2 ** try_count)
                             else:
                                 if ignore_errors:
                                     _logger.exception('Ignored github error %s %r (try %s/%s)', url, payload, try_count, nb_tries)
@@ -240,6 +363,9 @@ class Repo(models.Model):
                             string="Mode", required=True, help="hook: Wait for webhook on /runbot/hook/<id> i.e. github push event", tracking=True)
     hook_time = fields.Float('Last hook time', compute='_compute_hook_time')
     last_processed_hook_time = fields.Float('Last processed hook time')
+    last_fetch_duration = fields.Float('Last fetch duration (s)', readonly=True)
+    ref_snapshot = JsonDictField('Refs snapshot', prefetch=False, help="Sha of each ref when the refs were last read, only the refs added or moved since are processed")
+    last_full_fetch = fields.Float('Last full fetch time', readonly=True, help="In hook mode, only the refs received in hooks are fetched until a full fetch is due")
     get_ref_time = fields.Float('Last refs db update', compute='_compute_get_ref_time')
     trigger_ids = fields.Many2many('runbot.trigger', relation='runbot_trigger_triggers', readonly=True)
     single_version = fields.Many2one('runbot.version', "Single version", help="Limit the repo to a single version for non versionned repo")
@@ -282,6 +408,9 @@ class Repo(models.Model):
         self.invalidate_cache()
 
     def _gc_times(self):
+        self.env.cr.execute("""
+            DELETE from runbot_repo_hookref WHERE time < %s
+        """, [time.time() - 24 * 60 * 60])
         self.env.cr.execute("""
             DELETE from runbot_repo_reftime WHERE id NOT IN (
                 SELECT max(id) FROM runbot_repo_reftime GROUP BY repo_id
@@ -300,14 +429,27 @@ class Repo(models.Model):
         for repo in self:
             repo.path = os.path.join(root, 'repo', _sanitize(repo.name))
 
-    def _git(self, cmd, errors='strict'):
-        """Execute a git command 'cmd'"""
+    def _export_store(self):
+        """ Export store of the repo, or None if exports use git archive """
+        self.ensure_one()
+        mode = self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_export_mode', default='archive')
+        if mode not in ('hardlink', 'reflink'):
+            return None
+        return ExportStore(os.path.join(self.env['runbot.runbot']._root(), 'sources_store', _sanitize(self.name)), self.path, mode)
+
+    def _git_command(self, cmd):
+        """Full command line of git command 'cmd'"""
         self.ensure_one()
         config_args = []
         if self.identity_file:
             config_args = ['-c', 'core.sshCommand=ssh -i %s/.ssh/%s' % (str(Path.home()), self.identity_file)]
-        cmd = ['git', '-C', self.path] + config_args + cmd
+        return ['git', '-C', self.path] + config_args + cmd
+
+    def _git(self, cmd, errors='strict'):
+        """Execute a git command 'cmd'"""
+        cmd = self._git_command(cmd)
         _logger.info("git command: %s", ' '.join(cmd))
+        _git_calls['count'] += 1
         return subprocess.check_output(cmd, stderr=subprocess.STDOUT).decode(errors=errors)
 
     def _fetch(self, sha):
@@ -324,9 +466,20 @@ class Repo(models.Model):
                 if not self._hash_exists(sha):
                     raise RunbotException("Commit %s is unreachable. Did you force push the branch?" % sha)
 
+    def _cat_file(self):
+        self.ensure_one()
+        if self.path not in _cat_files:
+            cache_size = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_cat_file_cache_size', default=1000))
+            _cat_files[self.path] = CatFile(self.path, cache_size)
+        return _cat_files[self.path]
+
     def _hash_exists(self, commit_hash):
         """ Verify that a commit hash exists in the repo """
         self.ensure_one()
+        try:
+            return bool(self._cat_file().info(commit_hash))
+        except OSError:
+            _logger.warning('git cat-file process failed for repo %s, falling back on git cat-file', self.name)
         try:
             self._git(['cat-file', '-e', commit_hash])
         except subprocess.CalledProcessError:
@@ -346,35 +499,66 @@ class Repo(models.Model):
             return os.path.getmtime(fname_fetch_head)
         return 0
 
-    def _get_refs(self, max_age=30, ignore=None):
+    def _get_refs(self, max_age=30, ignore=None, ref_names=None):
         """Find new refs
+        :param ref_names: only read those refs (targeted fetch) instead of all
+                          the refs if the repo was fetched since last call
         :return: list of tuples with following refs informations:
         name, sha, date, author, author_email, subject, committer, committer_email
         """
         self.ensure_one()
+        if ref_names:
+            try:
+                return self._read_refs(ref_names, max_age, ignore, partial=True)
+            except Exception:
+                _logger.exception('Fail to get refs %s for repo %s', ref_names, self.name)
+            return []
         get_ref_time = round(self._get_fetch_head_time(), 4)
         if not self.get_ref_time or get_ref_time > self.get_ref_time:
             try:
                 self.set_ref_time(get_ref_time)
-                fields = ['refname', 'objectname', 'committerdate:iso8601', 'authorname', 'authoremail', 'subject', 'committername', 'committeremail']
-                fmt = "%00".join(["%(" + field + ")" for field in fields])
-                cmd = ['for-each-ref', '--format', fmt, '--sort=-committerdate', 'refs/*/heads/*']
+                patterns = ['refs/*/heads/*']
                 if any(remote.fetch_pull for remote in self.remote_ids):
-                    cmd.append('refs/*/pull/*')
-                git_refs = self._git(cmd)
-                git_refs = git_refs.strip()
-                if not git_refs:
-                    return []
-                refs = [tuple(field for field in line.split('\x00')) for line in git_refs.split('\n')]
-                refs = [r for r in refs if dateutil.parser.parse(r[2][:19]) + datetime.timedelta(days=max_age) > datetime.datetime.now() or self.env['runbot.branch'].match_is_base(r[0])]
-                if ignore:
-                    refs = [r for r in refs if r[0].split('/')[-1] not in ignore]
-                return refs
+                    patterns.append('refs/*/pull/*')
+                return self._read_refs(patterns, max_age, ignore)
             except Exception:
                 _logger.exception('Fail to get refs for repo %s', self.name)
                 self.env['runbot.runbot'].warning('Fail to get refs for repo %s', self.name)
         return []
 
+    def _read_refs(self, patterns, max_age=30, ignore=None, partial=False):
+        """ Read the refs matching patterns and return the ones added or moved
+        since they were last read, according to ref_snapshot. Refs missing
+        from the output are considered deleted unless partial is set, meaning
+        that patterns do not match all the refs of the repo.
+        """
+        fields = ['refname', 'objectname', 'committerdate:iso8601', 'authorname', 'authoremail', 'subject', 'committername', 'committeremail']
+        fmt = "%00".join(["%(" + field + ")" for field in fields])
+        cmd = ['for-each-ref', '--format', fmt, '--sort=-committerdate'] + patterns
+        git_refs = self._git(cmd)
+        git_refs = git_refs.strip()
+        snapshot = dict(self.ref_snapshot)
+        new_snapshot = dict(snapshot) if partial else {}
+        refs = []
+        for line in git_refs.split('\n') if git_refs else []:
+            ref = tuple(field for field in line.split('\x00'))
+            ref_name, sha = ref[0], ref[1]
+            if ignore and ref_name.split('/')[-1] in ignore:
+                # keep the previous sha to process it again once not ignored anymore
+                if ref_name in snapshot:
+                    new_snapshot[ref_name] = snapshot[ref_name]
+                continue
+            new_snapshot[ref_name] = sha
+            if snapshot.get(ref_name) != sha:
+                refs.append(ref)
+        deleted = set(snapshot) - set(new_snapshot)
+        if deleted:
+            _logger.info('%s refs deleted from repo %s', len(deleted), self.name)
+        if new_snapshot != snapshot:
+            self.ref_snapshot = new_snapshot
+        _logger.info('%s new or moved refs in repo %s', len(refs), self.name)
+        return [r for r in refs if dateutil.parser.parse(r[2][:19]) + datetime.timedelta(days=max_age) > datetime.datetime.now() or self.env['runbot.branch'].match_is_base(r[0])]
+
     def _find_or_create_branches(self, refs):
         """Parse refs and create branches that does not exists yet
         :param refs: list of tuples returned by _get_refs()
@@ -416,56 +600,74 @@ class Repo(models.Model):
         """
         self.ensure_one()
 
+        moved = []
         for ref_name, sha, date, author, author_email, subject, committer, committer_email in refs:
             branch = ref_branches[ref_name]
             if branch.head_name != sha:  # new push on branch
                 _logger.info('repo %s branch %s new commit found: %s', self.name, branch.name, sha)
+                moved.append((branch, sha, {
+                    'author': author,
+                    'author_email': author_email,
+                    'committer': committer,
+                    'committer_email': committer_email,
+                    'subject': subject,
+                    'date': dateutil.parser.parse(date[:19]),
+                }))
+        if not moved:
+            return
+
+        # resolve all commits and move all heads at once
+        commits = self.env['runbot.commit']._get_many(self.id, {sha: vals for _, sha, vals in moved})
+        self.env['runbot.branch']._set_heads({branch: commits[sha] for branch, sha, _ in moved})
+
+        dead_branches = self.env['runbot.branch'].concat(*[branch for branch, _, _ in moved]).filtered(lambda branch: not branch.alive)
+        dead_prs = dead_branches.filtered('is_pr')
+        if dead_prs:
+            # a single page scan when many prs are revived after a downtime
+            _logger.info('Recomputing infos of dead prs %s', ', '.join(dead_prs.mapped('name')))
+            dead_prs._compute_branch_infos()
+        (dead_branches - dead_prs).write({'alive': True})
+
+        for branch, _, _ in moved:
+            if branch.reference_name and branch.remote_id and branch.remote_id.repo_id._is_branch_forbidden(branch.reference_name):
+                message = "This branch name is incorrect. Branch name should be prefixed with a valid version"
+                message = branch.remote_id.repo_id.invalid_branch_message or message
+                branch.head._github_status(False, "Branch naming", 'failure', False, message)
+
+            bundle = branch.bundle_id
+            if bundle.no_build:
+                continue
 
-                commit = self.env['runbot.commit']._get(sha, self.id, {
-                        'author': author,
-                        'author_email': author_email,
-                        'committer': committer,
-                        'committer_email': committer_email,
-                        'subject': subject,
-                        'date': dateutil.parser.parse(date[:19]),
-                    })
-                branch.head = commit
-                if not branch.alive:
-                    if branch.is_pr:
-                        _logger.info('Recomputing infos of dead pr %s', branch.name)
-                        branch._compute_branch_infos()
-                    else:
-                        branch.alive = True
-
-                if branch.reference_name and branch.remote_id and branch.remote_id.repo_id._is_branch_forbidden(branch.reference_name):
-                    message = "This branch name is incorrect. Branch name should be prefixed with a valid version"
-                    message = branch.remote_id.repo_id.invalid_branch_message or message
-                    branch.head._github_status(False, "Branch naming", 'failure', False, message)
-
-                bundle = branch.bundle_id
-                if bundle.no_build:
-                    continue
-
-                if bundle.last_batch.state != 'preparing':
-                    preparing = self.env['runbot.batch'].create({
-                        'last_update': fields.Datetime.now(),
-                        'bundle_id': bundle.id,
-                        'state': 'preparing',
-                    })
-                    bundle.last_batch = preparing
-
-                if bundle.last_batch.state == 'preparing':
-                    bundle.last_batch._new_commit(branch)
-
-    def _update_batches(self, force=False, ignore=None):
-        """ Find new commits in physical repos"""
+            if bundle.last_batch.state != 'preparing':
+                preparing = self.env['runbot.batch'].create({
+                    'last_update': fields.Datetime.now(),
+                    'bundle_id': bundle.id,
+                    'state': 'preparing',
+                })
+                bundle.last_batch = preparing
+
+            if bundle.last_batch.state == 'preparing':
+                bundle.last_batch._new_commit(branch)
+
+    def _update_batches(self, force=False, ignore=None, fetched=None):
+        """ Find new commits in physical repos
+        :param fetched: result of _update_parallel, the repos are fetched one
+                        by one if not given. The hook refs of a repo are removed
+                        once processed, in the same transaction.
+        """
         updated = False
         for repo in self:
-            if repo.remote_ids and self._update(poll_delay=30 if force else 60*5):
+            if fetched is not None:
+                need_update = repo.id in fetched
+            else:
+                need_update = repo.remote_ids and self._update(poll_delay=30 if force else 60*5)
+            if need_update:
                 max_age = int(self.env['ir.config_parameter'].get_param('runbot.runbot_max_age', default=30))
-                ref = repo._get_refs(max_age, ignore=ignore)
+                ref_names, hook_ref_ids = fetched[repo.id] if fetched is not None else (None, [])
+                ref = repo._get_refs(max_age, ignore=ignore, ref_names=ref_names)
                 ref_branches = repo._find_or_create_branches(ref)
                 repo._find_new_commits(ref, ref_branches)
+                self.env['runbot.repo.hookref'].browse(hook_ref_ids).exists().unlink()
                 updated = True
         return updated
 
@@ -501,6 +703,19 @@ class Repo(models.Model):
     def _update_git(self, force=False, poll_delay=5*60):
         """ Update the git repo on FS """
         self.ensure_one()
+        if not self._need_fetch(force, poll_delay):
+            return False
+        _logger.info('Updating repo %s', self.name)
+        success = self._update_fetch_cmd()
+        if success:
+            self.last_full_fetch = time.time()
+            if self.path in _cat_files:
+                _cat_files[self.path].close()
+        return success
+
+    def _need_fetch(self, force=False, poll_delay=5*60):
+        """ Initialize the git repo on FS if needed and tell if it must be fetched """
+        self.ensure_one()
         repo = self
         if not repo.remote_ids:
             return False
@@ -518,9 +733,7 @@ class Repo(models.Model):
             if repo.mode == 'poll':
                 if (time.time() < fetch_time + poll_delay):
                     return False
-
-        _logger.info('Updating repo %s', repo.name)
-        return self._update_fetch_cmd()
+        return True
 
     def _update_fetch_cmd(self):
         # Extracted from update_git to be easily overriden in external module
@@ -537,14 +750,98 @@ class Repo(models.Model):
                 try_count += 1
                 delay = delay * 1.5 if delay else 0.5
                 if try_count > 4:
-                    message = 'Failed to fetch repo %s: %s' % (self.name, e.output.decode())
-                    host = self.env['runbot.host']._get_current()
-                    host.message_post(body=message)
-                    self.env['runbot.runbot'].warning('Host %s got reserved because of fetch failure' % host.name)
-                    _logger.exception(message)
-                    host.disable()
+                    self._fetch_failed(e.output.decode())
         return success
 
+    def _fetch_failed(self, output):
+        """ Reserve the host after a fetch failure """
+        self.ensure_one()
+        failures = self.env.context.get('fetch_failures')
+        if failures is not None:
+            # in a fetch thread, reported to _update_parallel
+            failures.append(output)
+            return
+        message = 'Failed to fetch repo %s: %s' % (self.name, output)
+        host = self.env['runbot.host']._get_current()
+        host.message_post(body=message)
+        self.env['runbot.runbot'].warning('Host %s got reserved because of fetch failure' % host.name)
+        _logger.error(message)
+        host.disable()
+
+    def _full_fetch_due(self):
+        self.ensure_one()
+        delay = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_full_fetch_delay', default=60*60))
+        return time.time() > self.last_full_fetch + delay
+
+    def _targeted_fetch_commands(self, hook_refs):
+        """ One fetch command per remote, fetching the refs received in hooks """
+        self.ensure_one()
+        commands = []
+        for remote in hook_refs.remote_id:
+            refspecs = sorted(set(hook_refs.filtered(lambda hook_ref: hook_ref.remote_id == remote).mapped('refspec')))
+            commands.append(['fetch', remote.remote_name] + refspecs)
+        return commands
+
+    def _update_parallel(self, poll_delay=5*60, stats=None):
+        """ Fetch the repos concurrently, using at most runbot_fetch_workers threads.
+        Each thread fetches a repo with its own cursor, through _update_fetch_cmd
+        for a full fetch. Deciding what to fetch and handling the failures is
+        done with the current cursor.
+        In hook mode, only the refs received in hooks are fetched, a full fetch
+        is still done every runbot_full_fetch_delay seconds. The hook refs are
+        kept until _update_batches processed them.
+        :return: dict {repo id: (fetched ref names or None after a full fetch, ids of the fetched hook refs)}
+                 of the successfully fetched repos
+        """
+        jobs = {}
+        for repo in self:
+            try:
+                if not repo.remote_ids:
+                    continue
+                need_fetch = repo._need_fetch(poll_delay=poll_delay)
+                hook_refs = self.env['runbot.repo.hookref']
+                full_fetch_due = False
+                if repo.mode == 'hook':
+                    hook_refs = hook_refs.search([('repo_id', '=', repo.id)])
+                    full_fetch_due = repo._full_fetch_due()
+                # pending hook refs are fetched again if their processing was rolled back
+                if hook_refs and not full_fetch_due:
+                    _logger.info('Updating refs %s of repo %s', ', '.join(hook_refs.mapped('ref')), repo.name)
+                    jobs[repo] = (hook_refs, repo._targeted_fetch_commands(hook_refs), False)
+                elif need_fetch or full_fetch_due:
+                    _logger.info('Updating repo %s', repo.name)
+                    jobs[repo] = (hook_refs, None, True)
+            except Exception:
+                _logger.exception('Fail to update repo %s', repo.name)
+        fetched = {}
+        if not jobs:
+            return fetched
+        workers = int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_fetch_workers', default=4))
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(jobs)))) as executor:
+            futures = {repo: executor.submit(_fetch_repo, self.env.cr.dbname, self.env.uid, self.env.context, repo.id, commands) for repo, (_, commands, _) in jobs.items()}
+        for repo, future in futures.items():
+            try:
+                success, output, duration = future.result()
+            except Exception:
+                _logger.exception('Fail to update repo %s', repo.name)
+                continue
+            hook_refs, _, full_fetch = jobs[repo]
+            repo.last_fetch_duration = duration
+            if stats:
+                stats.add('fetch %s' % repo.name, duration=duration)
+            if success:
+                fetched[repo.id] = (None if full_fetch else sorted(set(hook_refs.mapped('ref'))), hook_refs.ids)
+                if full_fetch:
+                    repo.last_full_fetch = time.time()
+            elif full_fetch:
+                if output:
+                    repo._fetch_failed(output)
+            else:
+                # a ref may have been deleted since the hook, let the full fetch sort it out
+                _logger.warning('Failed to fetch refs of repo %s, full fetch on next update: %s', repo.name, output)
+                repo.last_full_fetch = 0
+        return fetched
+
     def _update(self, force=False, poll_delay=5*60):
         """ Update the physical git reposotories on FS"""
         for repo in self:
@@ -562,6 +859,32 @@ class RefTime(models.Model):
     repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, ondelete='cascade')
 
 
+class HookRef(models.Model):
+    _name = 'runbot.repo.hookref'
+    _description = "Ref received in a hook, to fetch"
+    _log_access = False
+
+    repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, index=True, ondelete='cascade')
+    remote_id = fields.Many2one('runbot.remote', 'Remote', required=True, ondelete='cascade')
+    name = fields.Char('Branch name or pr number', required=True)
+    is_pr = fields.Boolean('Is pr')
+    sha = fields.Char('Sha')
+    time = fields.Float('Time')
+    ref = fields.Char('Local ref', compute='_compute_ref')
+    refspec = fields.Char('Refspec', compute='_compute_ref')
+
+    @api.depends('remote_id', 'name', 'is_pr')
+    def _compute_ref(self):
+        for hook_ref in self:
+            remote_name = hook_ref.remote_id.remote_name
+            if hook_ref.is_pr:
+                hook_ref.ref = 'refs/%s/pull/%s' % (remote_name, hook_ref.name)
+                hook_ref.refspec = '+refs/pull/%s/head:%s' % (hook_ref.name, hook_ref.ref)
+            else:
+                hook_ref.ref = 'refs/%s/heads/%s' % (remote_name, hook_ref.name)
+                hook_ref.refspec = '+refs/heads/%s:%s' % (hook_ref.name, hook_ref.ref)
+
+
 class HookTime(models.Model):
     _name = 'runbot.repo.hooktime'
     _description = "Repo hooktime"
@@ -569,3 +892,19 @@ class HookTime(models.Model):
 
     time = fields.Float('Time')
     repo_id = fields.Many2one('runbot.repo', 'Repository', required=True, ondelete='cascade')
+
+    def init(self):
+        """ A received hook means there is something to fetch, wake up the leader """
+        self._cr.execute("""
+CREATE OR REPLACE FUNCTION runbot_hooktime_notify() RETURNS TRIGGER AS $runbot_hooktime_notify$
+BEGIN
+  PERFORM pg_notify('runbot_leader', '');
+  RETURN NULL;
+END;
+$runbot_hooktime_notify$ language plpgsql;
+
+DROP TRIGGER IF EXISTS runbot_hooktime_notify_trigger ON runbot_repo_hooktime;
+CREATE TRIGGER runbot_hooktime_notify_trigger
+AFTER INSERT ON runbot_repo_hooktime
+FOR EACH ROW EXECUTE PROCEDURE runbot_hooktime_notify();
+        """)
@@ -31,6 +31,22 @@ class ResConfigSettings(models.TransientModel):
     runbot_pending_warning = fields.Integer('Pending warning limit', default=5, config_parameter='runbot.pending.warning')
     runbot_pending_critical = fields.Integer('Pending critical limit', default=5, config_parameter='runbot.pending.critical')
 
+    runbot_scheduler_snapshot = fields.Boolean('Snapshot scheduler', help="Take scheduler decisions from a single snapshot of the host builds, committing once per phase", config_parameter='runbot.runbot_scheduler_snapshot')
+    runbot_status_queue = fields.Boolean('Queue github statuses', help="Statuses are queued and sent by the status_sender worker instead of after each commit", config_parameter='runbot.runbot_status_queue')
+    runbot_status_workers = fields.Integer('Status sender threads', default=4, config_parameter='runbot.runbot_status_workers')
+    runbot_fetch_workers = fields.Integer('Fetch threads', default=4, help="Number of repositories fetched concurrently by the leader", config_parameter='runbot.runbot_fetch_workers')
+    runbot_full_fetch_delay = fields.Integer('Full fetch delay (s)', default=3600, help="In hook mode, only the refs received in hooks are fetched, a full fetch is done after this delay", config_parameter='runbot.runbot_full_fetch_delay')
+    runbot_export_mode = fields.Selection([('archive', 'Git archive'), ('hardlink', 'Hardlinks to a blob store'), ('reflink', 'Reflinks to a blob store')], 'Sources export', default='archive', help="Blob store modes only write the files that changed since an already exported commit, reflinks need a filesystem supporting them (btrfs, xfs)", config_parameter='runbot.runbot_export_mode')
+    runbot_db_template_quota = fields.Float('Installed databases cache (GiB)', default=0, help="Disk space used on each host to keep databases installed by steps without tests, reused by the next install of the same modules on the same commits. 0 to disable", config_parameter='runbot.runbot_db_template_quota')
+    runbot_dump_cache_size = fields.Float('Dump cache (GiB)', default=0, help="Disk space used on each host to keep the dumps downloaded by restore steps, verified by their checksum and shared by the next restores. 0 to disable", config_parameter='runbot.runbot_dump_cache_size')
+    runbot_listen_notify = fields.Boolean('Wake up on notifications', help="Builders and leader wait for database notifications instead of polling, update frequency is only used as a fallback", config_parameter='runbot.runbot_listen_notify')
+
+    runbot_allocation_policy = fields.Selection([('fifo', 'First in, first out'), ('fair', 'Fair share'), ('critical_path', 'Longest critical path first')], 'Allocation policy', default='fifo', config_parameter='runbot.runbot_allocation_policy')
+    runbot_allocation_sticky_weight = fields.Float('Sticky bundles weight', default=2, config_parameter='runbot.runbot_allocation_sticky_weight')
+    runbot_allocation_rebuild_weight = fields.Float('Rebuilds weight', default=2, config_parameter='runbot.runbot_allocation_rebuild_weight')
+    runbot_allocation_aging = fields.Float('Aging (rank per hour)', default=6, config_parameter='runbot.runbot_allocation_aging')
+    runbot_slow_turn_threshold = fields.Integer('Slow turn threshold (s)', default=60, help="Log the phases of loop turns lasting longer, 0 to disable", config_parameter='runbot.runbot_slow_turn_threshold')
+
     # TODO other icp
     # runbot.runbot_maxlogs 100
     # runbot.runbot_nginx True
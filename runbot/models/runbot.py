@@ -1,3 +1,5 @@
+import datetime
+import json
 import time
 import logging
 import glob
@@ -10,8 +12,10 @@ import shutil
 from contextlib import contextmanager
 from requests.exceptions import HTTPError
 
-from ..common import fqdn, dest_reg, os
-from ..container import docker_ps, docker_stop
+from ..common import fqdn, dest_reg, host_channel, os, PgListener
+from ..container import docker_cache, docker_calls_count, docker_events, docker_ps, docker_stop
+from .build import PORTLESS_STATES
+from .repo import git_calls_count
 
 from odoo import models, fields
 from odoo.osv import expression
@@ -20,6 +24,148 @@ from odoo.modules.module import get_module_resource
 
 _logger = logging.getLogger(__name__)
 
+# fingerprint of the running builds used to generate the nginx config, by nginx dir
+_nginx_fingerprints = {}
+# number of commits done by the loops of this process
+_commits = {'count': 0}
+# lowest weight of the fair allocation policy, the virtual times are divided by the weights
+MIN_ALLOCATION_WEIGHT = 0.01
+
+
+class TurnStats(object):
+    """ Duration, sql queries, subprocesses (docker and git commands) and
+    commits of each phase of a loop turn. Phases with the same name are summed.
+    """
+
+    _keys = ('duration', 'queries', 'subprocesses', 'commits')
+
+    def __init__(self, env, loop):
+        self.env = env
+        self.loop = loop
+        self.phases = {}
+        self.start = self._counters()
+
+    def _counters(self):
+        return (time.time(), self.env.cr.sql_log_count, docker_calls_count() + git_calls_count(), _commits['count'])
+
+    @contextmanager
+    def phase(self, name):
+        start = self._counters()
+        try:
+            yield
+        finally:
+            self._add_values(self.phases.setdefault(name, dict.fromkeys(self._keys, 0)), start, self._counters())
+
+    def add(self, name, **values):
+        """ Add values measured outside of a phase, e.g. in another thread """
+        phase = self.phases.setdefault(name, dict.fromkeys(self._keys, 0))
+        for key, value in values.items():
+            phase[key] += value
+
+    def total(self):
+        total = dict.fromkeys(self._keys, 0)
+        self._add_values(total, self.start, self._counters())
+        return total
+
+    def _add_values(self, values, start, end):
+        for key, start_value, end_value in zip(self._keys, start, end):
+            values[key] += end_value - start_value
+
+    def record(self, host):
+        """ Store the turn in the host rolling samples and log it if the turn was slow """
+        total = self.total()
+        phases = dict(self.phases, total=total)
+        host._record_turn_stats(self.loop, phases)
+        threshold = float(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_slow_turn_threshold', default=60))
+        if threshold and total['duration'] > threshold:
+            _logger.warning('Slow %s turn on %s: %s', self.loop, host.name, json.dumps({
+                'loop': self.loop,
+                'host': host.name,
+                'phases': {name: {key: round(value, 3) for key, value in values.items()} for name, values in phases.items()},
+            }, sort_keys=True))
+
+
+class BuildSnapshot(object):
+    """ In memory view of the non done builds of a host, loaded with a single
+    query at the beginning of a scheduler turn. Scheduler phases use it to take
+    their decisions instead of searching runbot.build again and again, and only
+    refresh the rows of the builds they actually touched.
+    """
+
+    _columns = ['id', 'local_state', 'requested_action', 'port', 'job_start', 'docker_start', 'parent_path', 'keep_running', 'killable', 'build_type']
+
+    def __init__(self, env, host_name, rows):
+        self.env = env
+        self.cr = env.cr
+        self.host_name = host_name
+        self.rows = {row['id']: row for row in rows}
+        self.saved_queries = 0
+
+    @classmethod
+    def load(cls, env, host_name):
+        env['runbot.build'].flush(cls._columns + ['host'])
+        cr = env.cr
+        cr.execute("""
+            SELECT %s
+            FROM runbot_build
+            WHERE host = %%s AND local_state != 'done'
+            ORDER BY id DESC
+        """ % ', '.join(cls._columns), (host_name,))
+        return cls(env, host_name, cr.dictfetchall())
+
+    def _select(self, states=None, actions=None, exclude_actions=None, killable=None, saves_query=True):
+        """ Yield the rows matching the filters. saves_query tells if the
+        legacy scheduler searches the database for the same builds, to report
+        the queries saved by the snapshot.
+        """
+        if saves_query:
+            self.saved_queries += 1
+        for build_id in sorted(self.rows, reverse=True):
+            row = self.rows[build_id]
+            if states is not None and row['local_state'] not in states:
+                continue
+            if actions is not None and row['requested_action'] not in actions:
+                continue
+            if exclude_actions is not None and row['requested_action'] in exclude_actions:
+                continue
+            if killable is not None and bool(row['killable']) != killable:
+                continue
+            yield row
+
+    def ids(self, **filters):
+        return [row['id'] for row in self._select(**filters)]
+
+    def count(self, **filters):
+        return len(self.ids(**filters))
+
+    def rows_by_state(self, state):
+        return list(self._select(states=(state,)))
+
+    def add(self, build_ids, **values):
+        """ register builds newly assigned to this host """
+        for build_id in build_ids:
+            row = dict.fromkeys(self._columns)
+            row.update(values, id=build_id)
+            self.rows[build_id] = row
+
+    def refresh(self, builds):
+        """ reload the rows of the given builds, dropping the ones that are done or moved to another host """
+        build_ids = [build.id for build in builds]
+        if not build_ids:
+            return
+        self.env['runbot.build'].flush(self._columns + ['host'])
+        self.cr.execute("""
+            SELECT %s, host
+            FROM runbot_build
+            WHERE id IN %%s
+        """ % ', '.join(self._columns), (tuple(build_ids),))
+        for row in self.cr.dictfetchall():
+            host = row.pop('host')
+            if host != self.host_name or row['local_state'] == 'done':
+                self.rows.pop(row['id'], None)
+            else:
+                self.rows[row['id']] = row
+
 # after this point, not realy a repo buisness
 class Runbot(models.AbstractModel):
     _name = 'runbot.runbot'
@@ -29,6 +175,7 @@ class Runbot(models.AbstractModel):
         self.env.cr.commit()
         self.env.cache.invalidate()
         self.env.clear()
+        _commits['count'] += 1
 
     def _root(self):
         """Return root directory of repository"""
@@ -36,24 +183,134 @@ class Runbot(models.AbstractModel):
         return os.path.abspath(default)
 
     def _scheduler(self, host):
-        self._gc_testing(host)
+        start_docker_calls = docker_calls_count()
+        stats = TurnStats(self.env, 'scheduler')
+        with docker_cache():
+            with stats.phase('docker_events'):
+                self._process_docker_events(host)
+            with stats.phase('snapshot'):
+                snapshot = self._get_scheduler_snapshot(host)
+            if snapshot is not None:
+                self._scheduler_from_snapshot(host, snapshot, stats)
+            else:
+                self._scheduler_phases(host, stats)
+        host.last_docker_calls = docker_calls_count() - start_docker_calls
+        _logger.info('Scheduler turn on %s used %s docker calls', host.name, host.last_docker_calls)
+        stats.record(host)
         self._commit()
-        for build in self._get_builds_with_requested_actions(host):
-            build._process_requested_actions()
+        return snapshot
+
+    def _scheduler_phases(self, host, stats):
+        with stats.phase('gc_testing'):
+            self._gc_testing(host)
+            self._commit()
+        with stats.phase('requested_actions'):
+            for build in self._get_builds_with_requested_actions(host):
+                build._process_requested_actions()
+                self._commit()
+        with stats.phase('schedule'):
+            for build in self._get_builds_to_schedule(host):
+                build._schedule()
+                self._commit()
+        with stats.phase('assign'):
+            self._assign_pending_builds(host, host.nb_worker, [('build_type', '!=', 'scheduled')])
             self._commit()
-        for build in self._get_builds_to_schedule(host):
-            build._schedule()
+            self._assign_pending_builds(host, host.nb_worker-1 or host.nb_worker)
             self._commit()
-        self._assign_pending_builds(host, host.nb_worker, [('build_type', '!=', 'scheduled')])
-        self._commit()
-        self._assign_pending_builds(host, host.nb_worker-1 or host.nb_worker)
-        self._commit()
-        for build in self._get_builds_to_init(host):
-            build._init_pendings(host)
+        with stats.phase('init'):
+            for build in self._get_builds_to_init(host):
+                build._init_pendings(host)
+                self._commit()
+        with stats.phase('gc_running'):
+            self._gc_running(host)
+            self._commit()
+        with stats.phase('sample_resources'):
+            host._sample_containers_resources()
             self._commit()
-        self._gc_running(host)
+        with stats.phase('nginx'):
+            self._reload_nginx()
+
+    def _process_docker_events(self, host):
+        """ Log in their build the abnormal containers exits reported by the docker events watcher """
+        for container_name, action, exit_code in docker_events():
+            if action == 'start':
+                continue
+            build = self.env['runbot.build']._build_from_dest(container_name).exists()
+            if not build or build.host != host.name:
+                continue
+            if action == 'oom':
+                build._log('docker', 'Container %s was killed by the OOM killer' % container_name, level='ERROR')
+            elif exit_code not in (None, '0'):
+                build._log('docker', 'Container %s exited with code %s' % (container_name, exit_code), level='WARNING')
         self._commit()
-        self._reload_nginx()
+
+    def _get_scheduler_snapshot(self, host):
+        """ Return a BuildSnapshot of the host builds if the snapshot scheduler is enabled, None otherwise """
+        icp = self.env['ir.config_parameter'].sudo()
+        if not icp.get_param('runbot.runbot_scheduler_snapshot'):
+            return None
+        return BuildSnapshot.load(self.env, host.name)
+
+    def _scheduler_from_snapshot(self, host, snapshot, stats):
+        """ Same phases as _scheduler but all decisions are taken from the snapshot
+        loaded at the beginning of the turn.
+        """
+        start_query_count = self.env.cr.sql_log_count
+        Build = self.env['runbot.build']
+        Build._get_port_allocator(used_ports=[row['port'] for row in snapshot.rows.values() if row['local_state'] not in PORTLESS_STATES])
+
+        with stats.phase('gc_testing'):
+            self._gc_testing(host, snapshot)
+            self._commit()
+
+        with stats.phase('requested_actions'):
+            builds = Build.browse(snapshot.ids(actions=('wake_up', 'deathrow')))
+            self._run_snapshot_phase(builds, '_process_requested_actions', snapshot)
+            self._commit()
+
+        with stats.phase('schedule'):
+            builds = Build.browse(snapshot.ids(states=('testing', 'running')))
+            self._run_snapshot_phase(builds, '_schedule', snapshot)
+            self._commit()
+
+        with stats.phase('assign'):
+            self._assign_pending_builds(host, host.nb_worker, [('build_type', '!=', 'scheduled')], snapshot=snapshot)
+            self._assign_pending_builds(host, host.nb_worker-1 or host.nb_worker, snapshot=snapshot)
+            self._commit()
+
+        with stats.phase('init'):
+            builds = self._get_builds_to_init(host, snapshot)
+            self._run_snapshot_phase(builds, '_init_pendings', snapshot, host)
+            self._commit()
+
+        with stats.phase('gc_running'):
+            self._gc_running(host, snapshot)
+            self._commit()
+        with stats.phase('sample_resources'):
+            host._sample_containers_resources()
+            self._commit()
+        with stats.phase('nginx'):
+            self._reload_nginx()
+        _logger.info(
+            'Scheduler turn on %s done in %s queries, %s searches answered by snapshot',
+            host.name, self.env.cr.sql_log_count - start_query_count, snapshot.saved_queries
+        )
+        return snapshot
+
+    def _run_snapshot_phase(self, builds, method, snapshot, *args):
+        """ Call method on each build and commit after each of them, like
+        _scheduler_phases does, so that an error only loses the changes of the
+        failing build. A savepoint would not do: killing or starting a build commits.
+        """
+        for build in builds:
+            try:
+                getattr(build, method)(*args)
+                self._commit()
+            except Exception:
+                _logger.exception('%s failed for build %s', method, build.id)
+                self.env.cr.rollback()
+                self.env.clear()
+        snapshot.refresh(builds)
 
     def build_domain_host(self, host, domain=None):
         domain = domain or []
@@ -65,59 +322,138 @@ class Runbot(models.AbstractModel):
     def _get_builds_to_schedule(self, host):
         return self.env['runbot.build'].search(self.build_domain_host(host, [('local_state', 'in', ['testing', 'running'])]))
 
-    def _assign_pending_builds(self, host, nb_worker, domain=None):
+    def _assign_pending_builds(self, host, nb_worker, domain=None, snapshot=None):
         if host.assigned_only or nb_worker <= 0:
             return
-        domain_host = self.build_domain_host(host)
-        reserved_slots = self.env['runbot.build'].search_count(domain_host + [('local_state', 'in', ('testing', 'pending'))])
+        if host._uses_resources():
+            return self._assign_pending_builds_by_resources(host, nb_worker, domain, snapshot)
+        if snapshot is not None:
+            reserved_slots = snapshot.count(states=('testing', 'pending'))
+        else:
+            domain_host = self.build_domain_host(host)
+            reserved_slots = self.env['runbot.build'].search_count(domain_host + [('local_state', 'in', ('testing', 'pending'))])
         assignable_slots = (nb_worker - reserved_slots)
         if assignable_slots > 0:
             allocated = self._allocate_builds(host, assignable_slots, domain)
             if allocated:
+                if snapshot is not None:
+                    snapshot.add([build_id for (build_id,) in allocated], local_state='pending')
+                _logger.info('Builds %s where allocated to runbot', allocated)
 
+    def _assign_pending_builds_by_resources(self, host, nb_worker, domain=None, snapshot=None):
+        """ Bin-pack pending builds in the free resources of the host.
+        nb_worker is used as a ratio of the host capacity to keep room for non scheduled builds
+        """
+        Build = self.env['runbot.build']
+        if snapshot is not None:
+            reserved_builds = Build.browse(snapshot.ids(states=('testing', 'pending')))
+        else:
+            reserved_builds = Build.search(self.build_domain_host(host, [('local_state', 'in', ('testing', 'pending'))]))
+        cpu_free, memory_free = host._free_resources(reserved_builds, ratio=nb_worker / (host.nb_worker or nb_worker))
+        if cpu_free <= 0 or memory_free <= 0:
+            return
+        candidates = Build.browse(self._get_allocation_candidates(domain, limit=max(nb_worker * 4, 20)))
+        selected = host._pack_builds(candidates, cpu_free, memory_free, empty=not reserved_builds)
+        if selected:
+            allocated = self._allocate_builds(host, len(selected), expression.AND([domain or [], [('id', 'in', selected.ids)]]))
+            if allocated:
+                if snapshot is not None:
+                    snapshot.add([build_id for (build_id,) in allocated], local_state='pending')
                 _logger.info('Builds %s where allocated to runbot', allocated)
 
-    def _get_builds_to_init(self, host):
-        domain_host = self.build_domain_host(host)
-        used_slots = self.env['runbot.build'].search_count(domain_host + [('local_state', '=', 'testing')])
+    def _get_builds_to_init(self, host, snapshot=None):
+        if host._uses_resources():
+            return self._get_builds_to_init_by_resources(host, snapshot)
+        Build = self.env['runbot.build']
+        if snapshot is not None:
+            used_slots = snapshot.count(states=('testing',))
+        else:
+            domain_host = self.build_domain_host(host)
+            used_slots = Build.search_count(domain_host + [('local_state', '=', 'testing')])
         available_slots = host.nb_worker - used_slots
         if available_slots <= 0:
-            return self.env['runbot.build']
-        return self.env['runbot.build'].search(domain_host + [('local_state', '=', 'pending')], limit=available_slots)
+            return Build
+        if snapshot is not None:
+            pending_builds = Build.browse(snapshot.ids(states=('pending',)))
+        else:
+            pending_builds = Build.search(domain_host + [('local_state', '=', 'pending')])
+        return self._sort_builds_to_init(pending_builds)[:available_slots]
 
-    def _gc_running(self, host):
+    def _get_builds_to_init_by_resources(self, host, snapshot=None):
+        Build = self.env['runbot.build']
+        if snapshot is not None:
+            testing_builds = Build.browse(snapshot.ids(states=('testing',)))
+            pending_builds = Build.browse(snapshot.ids(states=('pending',)))
+        else:
+            testing_builds = Build.search(self.build_domain_host(host, [('local_state', '=', 'testing')]))
+            pending_builds = Build.search(self.build_domain_host(host, [('local_state', '=', 'pending')]))
+        cpu_free, memory_free = host._free_resources(testing_builds)
+        return host._pack_builds(self._sort_builds_to_init(pending_builds), cpu_free, memory_free, empty=not testing_builds)
+
+    def _sort_builds_to_init(self, builds):
+        """ With the critical path policy, the builds with the longest predicted duration are started first """
+        if self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_allocation_policy') == 'critical_path':
+            return builds.sorted(lambda build: -build.predicted_duration)
+        return builds
+
+    def _gc_running(self, host, snapshot=None):
         running_max = host.get_running_max()
         domain_host = self.build_domain_host(host)
         Build = self.env['runbot.build']
-        cannot_be_killed_ids = Build.search(domain_host + [('keep_running', '=', True)]).ids
+        if snapshot is not None:
+            running = snapshot.rows_by_state('running')
+            if len(running) <= running_max:
+                return
+            cannot_be_killed_ids = [row['id'] for row in running if row['keep_running']]
+        else:
+            cannot_be_killed_ids = Build.search(domain_host + [('keep_running', '=', True)]).ids
         sticky_bundles = self.env['runbot.bundle'].search([('sticky', '=', True), ('project_id.keep_sticky_running', '=', True)])
         cannot_be_killed_ids += [
             build.id
             for build in sticky_bundles.mapped('last_batchs.slot_ids.build_id')
             if build.host == host.name
         ][:running_max]
-        build_ids = Build.search(domain_host + [('local_state', '=', 'running'), ('id', 'not in', cannot_be_killed_ids)], order='job_start desc').ids
-        Build.browse(build_ids)[running_max:]._kill()
+        if snapshot is not None:
+            running = sorted(running, key=lambda row: (row['job_start'] is None, row['job_start'] or datetime.datetime.min), reverse=True)
+            snapshot.saved_queries += 1  # the legacy path searches the running builds again, ordered by job_start
+            build_ids = [row['id'] for row in running if row['id'] not in cannot_be_killed_ids]
+        else:
+            build_ids = Build.search(domain_host + [('local_state', '=', 'running'), ('id', 'not in', cannot_be_killed_ids)], order='job_start desc').ids
+        to_kill = Build.browse(build_ids)[running_max:]
+        to_kill._kill()
+        if snapshot is not None:
+            snapshot.refresh(to_kill)
 
-    def _gc_testing(self, host):
+    def _gc_testing(self, host, snapshot=None):
         """garbage collect builds that could be killed"""
         # decide if we need room
         Build = self.env['runbot.build']
         domain_host = self.build_domain_host(host)
-        testing_builds = Build.search(domain_host + [('local_state', 'in', ['testing', 'pending']), ('requested_action', '!=', 'deathrow')])
+        if snapshot is not None:
+            testing_ids = snapshot.ids(states=('testing', 'pending'), exclude_actions=('deathrow',))
+            testing_builds = Build.browse(testing_ids)
+        else:
+            testing_builds = Build.search(domain_host + [('local_state', 'in', ['testing', 'pending']), ('requested_action', '!=', 'deathrow')])
         used_slots = len(testing_builds)
         available_slots = host.nb_worker - used_slots
         nb_pending = Build.search_count([('local_state', '=', 'pending'), ('host', '=', False)])
         if available_slots > 0 or nb_pending == 0:
             return
 
-        for build in testing_builds:
-            if build.killable:
-                build.top_parent._ask_kill(message='Build automatically killed, new build found.')
-
-    def _allocate_builds(self, host, nb_slots, domain=None):
-        if nb_slots <= 0:
-            return []
+        if snapshot is not None:
+            # filtered in memory by the legacy path too
+            killable_builds = Build.browse(snapshot.ids(states=('testing', 'pending'), exclude_actions=('deathrow',), killable=True, saves_query=False))
+        else:
+            killable_builds = testing_builds.filtered('killable')
+        for build in killable_builds:
+            build.top_parent._ask_kill(message='Build automatically killed, new build found.')
+        if snapshot is not None:
+            snapshot.refresh(killable_builds.mapped('top_parent') | killable_builds)
+
+    def _allocation_query(self, domain=None):
+        """ Return the FROM, WHERE and ORDER BY clauses selecting pending builds
+        in the order of the allocation policy, with their parameters.
+        """
         non_allocated_domain = [('local_state', '=', 'pending'), ('host', '=', False)]
         if domain:
             non_allocated_domain = expression.AND([non_allocated_domain, domain])
@@ -125,6 +461,32 @@ class Runbot(models.AbstractModel):
         assert e.get_tables() == ['"runbot_build"']
         where_clause, where_params = e.to_sql()
 
+        policy = self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_allocation_policy', default='fifo')
+        allocation_order = getattr(self, '_allocation_order_%s' % policy, None)
+        if not allocation_order:
+            _logger.warning('Unknown allocation policy %s, falling back on fifo', policy)
+            allocation_order = self._allocation_order_fifo
+        join_clause, join_params, order_by = allocation_order(where_clause, where_params)
+        query = """
+                            FROM runbot_build
+                            %s
+                            WHERE
+                                %s
+                            ORDER BY
+                                %s""" % (join_clause, where_clause, order_by)
+        return query, join_params + where_params
+
+    def _get_allocation_candidates(self, domain=None, limit=None):
+        """ Ids of the next builds to allocate, without locking them """
+        query, params = self._allocation_query(domain)
+        self.env.cr.execute('SELECT runbot_build.id %s LIMIT %%s' % query, params + [limit])
+        return [build_id for (build_id,) in self.env.cr.fetchall()]
+
+    def _allocate_builds(self, host, nb_slots, domain=None):
+        if nb_slots <= 0:
+            return []
+        query, params = self._allocation_query(domain)
+
         # self-assign to be sure that another runbot batch cannot self assign the same builds
         query = """UPDATE
                         runbot_build
@@ -133,18 +495,85 @@ class Runbot(models.AbstractModel):
                     WHERE
                         runbot_build.id IN (
                             SELECT runbot_build.id
-                            FROM runbot_build
-                            WHERE
-                                %s
-                            ORDER BY
-                                parent_path
+                            %s
                             FOR UPDATE OF runbot_build SKIP LOCKED
                             LIMIT %%s
                         )
-                    RETURNING id""" % where_clause
-        self.env.cr.execute(query, [host.name] + where_params + [nb_slots])
+                    RETURNING id""" % query
+        self.env.cr.execute(query, [host.name] + params + [nb_slots])
         return self.env.cr.fetchall()
 
+    def _allocation_order_fifo(self, where_clause, where_params):
+        """ Oldest top build first, sub builds right after their parent """
+        return '', [], 'parent_path'
+
+    def _allocation_order_fair(self, where_clause, where_params):
+        """ Share the slots between projects, bundles and triggers.
+
+        Each candidate gets a virtual time: its rank among the pending builds of
+        the same bundle and trigger, multiplied by the number of triggers pending
+        in the bundle and by the number of bundles pending in the project. Builds
+        are then served round robin between triggers of a bundle, bundles of a
+        project and projects. The virtual time is divided by the weight of sticky
+        bundles and rebuilds, and decreases with the time spent in the queue so
+        that no build can starve. Scores are computed on the candidates only, the
+        lock being taken on runbot_build by the outer query.
+        """
+        get_param = self.env['ir.config_parameter'].sudo().get_param
+        sticky_weight = max(float(get_param('runbot.runbot_allocation_sticky_weight', default=2)), MIN_ALLOCATION_WEIGHT)
+        rebuild_weight = max(float(get_param('runbot.runbot_allocation_rebuild_weight', default=2)), MIN_ALLOCATION_WEIGHT)
+        aging = float(get_param('runbot.runbot_allocation_aging', default=6))  # virtual time gained per hour of waiting
+        join_clause = """
+            JOIN (
+                SELECT
+                    candidate.id AS build_id,
+                    candidate.rank
+                    * (dense_rank() OVER (PARTITION BY candidate.bundle_id ORDER BY candidate.trigger_id)
+                       + dense_rank() OVER (PARTITION BY candidate.bundle_id ORDER BY candidate.trigger_id DESC) - 1)
+                    * (dense_rank() OVER (PARTITION BY candidate.project_id ORDER BY candidate.bundle_id)
+                       + dense_rank() OVER (PARTITION BY candidate.project_id ORDER BY candidate.bundle_id DESC) - 1)
+                    / (CASE WHEN candidate.sticky THEN %%s ELSE 1 END)
+                    / (CASE WHEN candidate.build_type = 'rebuild' THEN %%s ELSE 1 END)
+                    - EXTRACT(EPOCH FROM ((now() at time zone 'UTC') - candidate.create_date)) / 3600 * %%s
+                    AS score
+                FROM (
+                    SELECT
+                        runbot_build.id,
+                        runbot_build.build_type,
+                        runbot_build.create_date,
+                        params.project_id,
+                        params.trigger_id,
+                        slot.bundle_id,
+                        slot.sticky,
+                        row_number() OVER (PARTITION BY slot.bundle_id, params.trigger_id ORDER BY runbot_build.parent_path)::float AS rank
+                    FROM runbot_build
+                    JOIN runbot_build_params params ON params.id = runbot_build.params_id
+                    %s
+                    WHERE
+                        %s
+                ) candidate
+            ) allocation ON allocation.build_id = runbot_build.id""" % (self._top_build_slot_join(), where_clause)
+        return join_clause, [sticky_weight, rebuild_weight, aging] + where_params, 'allocation.score, runbot_build.parent_path'
+
+    def _allocation_order_critical_path(self, where_clause, where_params):
+        """ Batches in creation order, the builds with the longest predicted
+        duration first inside a batch so that the whole batch finishes sooner.
+        """
+        return self._top_build_slot_join(), [], 'slot.batch_id NULLS FIRST, runbot_build.predicted_duration DESC NULLS LAST, runbot_build.parent_path'
+
+    def _top_build_slot_join(self):
+        """ Join the last batch slot of the top parent of runbot_build as slot """
+        return """
+                    LEFT JOIN LATERAL (
+                        SELECT batch.id AS batch_id, batch.bundle_id, bundle.sticky
+                        FROM runbot_batch_slot batch_slot
+                        JOIN runbot_batch batch ON batch.id = batch_slot.batch_id
+                        JOIN runbot_bundle bundle ON bundle.id = batch.bundle_id
+                        WHERE batch_slot.build_id = split_part(runbot_build.parent_path, '/', 1)::int
+                        ORDER BY batch_slot.id DESC
+                        LIMIT 1
+                    ) slot ON true"""
+
     def _domain(self):
         return self.env.get('ir.config_parameter').sudo().get_param('runbot.runbot_domain', fqdn())
 
@@ -163,7 +592,21 @@ class Runbot(models.AbstractModel):
         nginx = icp.get_param('runbot.runbot_nginx', True)  # or just force nginx?
 
         if nginx:
-            settings['builds'] = env['runbot.build'].search([('local_state', '=', 'running'), ('host', '=', fqdn())])
+            # only regenerate the config when the set of running builds changed since last turn
+            env['runbot.build'].flush(['local_state', 'host', 'dest', 'port'])
+            env.cr.execute("SELECT id, dest, port FROM runbot_build WHERE local_state = 'running' AND host = %s ORDER BY id", [settings['fqdn']])
+            running = env.cr.fetchall()
+            builds_dir = os.path.join(nginx_dir, 'builds') if icp.get_param('runbot.runbot_nginx_includes') else False
+            fingerprint = (tuple(running), builds_dir, settings['port'], settings['runbot_domain'])
+            previous = _nginx_fingerprints.get(nginx_dir)
+            if previous == fingerprint:
+                return
+
+            settings['builds'] = env['runbot.build'].browse([build_id for build_id, _, _ in running])
+            settings['builds_dir'] = builds_dir
+            changed = False
+            if builds_dir:
+                changed = self._write_nginx_build_configs(builds_dir, settings, previous[0] if previous and previous[1] == builds_dir else None)
 
             nginx_config = env['ir.ui.view'].render_template("runbot.nginx_config", settings)
             os.makedirs(nginx_dir, exist_ok=True)
@@ -174,9 +617,12 @@ class Runbot(models.AbstractModel):
                 with open(nginx_conf_path, 'rb') as f:
                     content = f.read()
             if content != nginx_config:
-                _logger.info('reload nginx')
                 with open(nginx_conf_path, 'wb') as f:
                     f.write(nginx_config)
+                changed = True
+            _nginx_fingerprints[nginx_dir] = fingerprint
+            if changed:
+                _logger.info('reload nginx')
                 try:
                     pid = int(open(os.path.join(nginx_dir, 'nginx.pid')).read().strip(' \n'))
                     os.kill(pid, signal.SIGHUP)
@@ -190,6 +636,29 @@ class Runbot(models.AbstractModel):
                         else:
                             _logger.warning('failed to start nginx - failed to kill orphan worker - oh well')
 
+    def _write_nginx_build_configs(self, builds_dir, settings, previous_running=None):
+        """ Write one server snippet per running build in builds_dir, included by nginx.conf.
+        Only snippets of builds that changed since previous_running are written.
+        Return True if a snippet was added or removed.
+        """
+        os.makedirs(builds_dir, exist_ok=True)
+        previous_running = set(previous_running or [])
+        expected = {'%s.conf' % build.dest for build in settings['builds']}
+        changed = False
+        for filename in os.listdir(builds_dir):
+            if filename.endswith('.conf') and filename not in expected:
+                os.remove(os.path.join(builds_dir, filename))
+                changed = True
+        for build in settings['builds']:
+            snippet_path = os.path.join(builds_dir, '%s.conf' % build.dest)
+            if (build.id, build.dest, build.port) in previous_running and os.path.exists(snippet_path):
+                continue
+            snippet = self.env['ir.ui.view'].render_template("runbot.nginx_build_config", dict(settings, build=build))
+            with open(snippet_path, 'wb') as f:
+                f.write(snippet)
+            changed = True
+        return changed
+
     def _get_cron_period(self):
         """ Compute a randomized cron period with a 2 min margin below
         real cron timeout from config.
@@ -224,31 +693,62 @@ class Runbot(models.AbstractModel):
             self._docker_cleanup()
         _logger.info('Starting loop')
         if runbot_do_schedule or runbot_do_fetch:
-            while time.time() - start_time < timeout:
-                if runbot_do_fetch:
-                    self._fetch_loop_turn(host, pull_info_failures)
-                if runbot_do_schedule:
-                    sleep_time = self._scheduler_loop_turn(host, update_frequency)
-                    self.sleep(sleep_time)
-                else:
-                    self.sleep(update_frequency)
-                self._commit()
+            listener = self._get_listener(self._notification_channels(host, leader=runbot_do_fetch, builder=runbot_do_schedule))
+            try:
+                while time.time() - start_time < timeout:
+                    if runbot_do_fetch:
+                        self._fetch_loop_turn(host, pull_info_failures)
+                    if runbot_do_schedule:
+                        sleep_time = self._scheduler_loop_turn(host, update_frequency)
+                        self.sleep(sleep_time, listener)
+                    else:
+                        self.sleep(update_frequency, listener)
+                    self._commit()
+            finally:
+                if listener:
+                    listener.close()
 
             host.last_end_loop = fields.Datetime.now()
 
-    def sleep(self, t):
-        time.sleep(t)
+    def sleep(self, t, listener=None):
+        if listener:
+            listener.wait(t)
+        else:
+            time.sleep(t)
+
+    def _notification_channels(self, host, leader=False, builder=False):
+        """ Channels notified by the runbot triggers that should wake up a loop """
+        channels = []
+        if builder:
+            channels.append(host_channel(host.name))
+            if not host.assigned_only:
+                channels.append('runbot_pending')
+        if leader:
+            channels.append('runbot_leader')
+        return channels
+
+    def _get_listener(self, channels):
+        """ Listener ignoring the notifications caused by our own cursor, None if notifications are disabled """
+        if not channels or not self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_listen_notify'):
+            return None
+        return PgListener(self.env.cr.dbname, channels, ignore_pid=self.env.cr._cnx.get_backend_pid())
 
     def _fetch_loop_turn(self, host, pull_info_failures, default_sleep=1):
         with self.manage_host_exception(host) as manager:
+            stats = TurnStats(self.env, 'fetch')
             repos = self.env['runbot.repo'].search([('mode', '!=', 'disabled')])
             processing_batch = self.env['runbot.batch'].search([('state', 'in', ('preparing', 'ready'))], order='id asc')
             preparing_batch = processing_batch.filtered(lambda b: b.state == 'preparing')
             self._commit()
+            with stats.phase('fetch'):
+                # only the git network part is run concurrently, refs are processed one repo at a time below
+                fetched = repos._update_parallel(poll_delay=30 if preparing_batch else 60*5, stats=stats)
+                self._commit()
             for repo in repos:
                 try:
-                    repo._update_batches(force=bool(preparing_batch), ignore=pull_info_failures)
-                    self._commit() # commit is mainly here to avoid to lose progression in case of fetch failure or concurrent update
+                    with stats.phase('update_batches %s' % repo.name):
+                        repo._update_batches(force=bool(preparing_batch), ignore=pull_info_failures, fetched=fetched)
+                        self._commit() # commit is mainly here to avoid to lose progression in case of fetch failure or concurrent update
                 except HTTPError as e:
                     # Sometimes a pr pull info can fail.
                     # - Most of the time it is only temporary and it will be successfull on next try.
@@ -266,10 +766,11 @@ class Runbot(models.AbstractModel):
                     self.warning('Pr pull info failed for %s', pull_number)
                     self._commit()
 
-            if processing_batch:
+            with stats.phase('process_batches'):
                 for batch in processing_batch:
                     if batch._process():
                         self._commit()
+            stats.record(host)
             self._commit()
 
             # cleanup old pull_info_failures
@@ -347,6 +848,10 @@ class Runbot(models.AbstractModel):
                     assert 'static' in source_dir
                     shutil.rmtree(source_dir)
                 _logger.info('%s/%s source folder where deleted (%s kept)' % (len(to_delete), len(to_delete+to_keep), len(to_keep)))
+            for repo in repos:
+                store = repo._export_store()
+                if store:
+                    _logger.info('%s unused blobs removed from %s', store.gc(), store.path)
         except:
             _logger.exception('An exception occured while cleaning sources')
             pass
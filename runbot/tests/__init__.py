@@ -12,5 +12,8 @@ from . import test_build_stat
 from . import test_version
 from . import test_runbot
 from . import test_commit
+from . import test_export_store
+from . import test_dump_cache
+from . import test_log_analyzer
 from . import test_upgrade
 from . import test_dockerfile
@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 import datetime
+import shutil
+import tempfile
 
 from odoo.tests.common import TransactionCase
 from unittest.mock import patch, DEFAULT
@@ -9,6 +11,15 @@ import logging
 _logger = logging.getLogger(__name__)
 
 
+class TmpDirCase(TransactionCase):
+    """ Tests of the helpers working on files, in a temporary directory removed after each test """
+
+    def setUp(self):
+        super().setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+
 class RunbotCase(TransactionCase):
 
     def mock_git_helper(self):
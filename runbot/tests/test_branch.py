@@ -30,6 +30,28 @@ class TestBranch(RunbotCase):
         self.assertEqual(pr.target_branch_name, 'master')
         self.assertEqual(pr.pull_head_name, 'foo-dev:bar_branch')
 
+    def test_set_heads(self):
+        """ Test that many heads are resolved and moved at once, with their ref logs """
+        branches = self.Branch.create([{
+            'remote_id': self.remote_server.id,
+            'name': 'master-test-%s' % i,
+            'is_pr': False,
+        } for i in range(3)])
+        existing = self.Commit.create({'name': 'aaaa', 'repo_id': self.repo_server.id})
+        commits = self.Commit._get_many(self.repo_server.id, {'aaaa': {'subject': 'ignored'}, 'bbbb': {'subject': 'new'}})
+        self.assertEqual(commits['aaaa'], existing)
+        self.assertEqual(commits['bbbb'].subject, 'new')
+        self.assertEqual(self.Commit._get_many(self.repo_server.id, {'bbbb': {}}), {'bbbb': commits['bbbb']})
+
+        self.Branch._set_heads({branches[0]: commits['aaaa'], branches[1]: commits['aaaa'], branches[2]: commits['bbbb']})
+        self.assertEqual(branches.mapped('head_name'), ['aaaa', 'aaaa', 'bbbb'])
+        self.assertEqual(len(self.env['runbot.ref.log'].search([('branch_id', 'in', branches.ids)])), 3)
+
+        # unchanged heads are not logged again
+        self.Branch._set_heads({branches[0]: commits['aaaa'], branches[1]: commits['bbbb']})
+        self.assertEqual(len(self.env['runbot.ref.log'].search([('branch_id', 'in', branches.ids)])), 4)
+
+
 class TestBranchRelations(RunbotCase):
 
     def setUp(self):
@@ -6,6 +6,8 @@ from unittest.mock import patch
 from odoo import fields
 from odoo.exceptions import UserError, ValidationError
 from .common import RunbotCase, RunbotCaseMinimalSetup
+from ..common import PortAllocator
+from ..models.build import _port_allocators as port_allocators
 
 
 def rev_parse(repo, branch_name):
@@ -191,6 +193,58 @@ class TestBuildResult(RunbotCase):
         with self.assertRaises(ValidationError):
             builds.write({'local_result': 'ok'})
 
+    def test_port_allocator(self):
+        allocator = PortAllocator(2000, [2000, 2006, None, 1234])
+        self.assertEqual(allocator.allocate(), 2003)
+        self.assertEqual(allocator.allocate(), 2009)
+        allocator.release(2000)
+        allocator.release(2000)  # releasing twice is harmless
+        self.assertEqual(allocator.allocate(), 2000)
+        self.assertEqual(allocator.allocate(), 2012)
+        allocator.release(2003)
+        allocator.reserve(2003)
+        allocator.reserve(2021)
+        self.assertEqual(allocator.allocate(), 2015)
+        self.assertEqual(allocator.allocate(), 2018)
+        self.assertEqual(allocator.allocate(), 2024)
+
+    def test_find_port(self):
+        testing = self.Build.create({'params_id': self.server_params.id, 'local_state': 'testing', 'host': 'host.runbot.com', 'port': 2000})
+        self.Build.create({'params_id': self.server_params.id, 'local_state': 'running', 'host': 'host.runbot.com', 'port': 2003})
+        self.Build.create({'params_id': self.server_params.id, 'local_state': 'done', 'host': 'host.runbot.com', 'port': 2006})
+        self.Build.create({'params_id': self.server_params.id, 'local_state': 'testing', 'host': 'other.runbot.com', 'port': 2009})
+        with patch.dict(port_allocators, clear=True):
+            self.assertEqual(self.Build._find_port(), 2006)
+            self.assertEqual(self.Build._find_port(), 2009)
+            testing._release_port()
+            self.assertEqual(self.Build._find_port(), 2000)
+            self.assertEqual(self.Build._find_port(), 2012)
+
+            # ports allocated or released in a rolled back transaction are restored
+            with patch.object(type(self.env.cr), 'after') as mock_after:
+                port = self.Build._find_port()
+                testing._release_port()
+            self.assertEqual(port, 2015)
+            for (event, handler), _ in mock_after.call_args_list:
+                self.assertEqual(event, 'rollback')
+                handler()
+            self.assertEqual(self.Build._find_port(), 2015)
+            self.assertEqual(self.Build._find_port(), 2018)
+
+    @patch('odoo.addons.runbot.models.build.BuildResult._github_status')
+    def test_kill(self, mock_github_status):
+        build = self.Build.create({
+            'params_id': self.server_params.id,
+            'local_state': 'testing',
+            'host': 'host.runbot.com',
+            'log_tail': {'offset': 42, 'step_id': 1},
+        })
+        build._kill(result='ko')
+        self.assertEqual(build.local_state, 'done')
+        self.assertEqual(build.local_result, 'ko')
+        self.assertFalse(build.log_tail)
+        mock_github_status.assert_called_once()
+
     def test_markdown_description(self):
         build = self.Build.create({
             'params_id': self.server_params.id,
@@ -1,4 +1,10 @@
 # -*- coding: utf-8 -*-
+import datetime
+import json
+import os
+import shutil
+import tempfile
+
 from unittest.mock import patch, mock_open
 from odoo.exceptions import UserError
 from odoo.addons.runbot.common import RunbotException
@@ -168,6 +174,93 @@ class TestBuildConfigStep(RunbotCase):
 
         config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
 
+    @patch('odoo.addons.runbot.models.build.BuildResult.write_file')
+    @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
+    def test_dump_directory(self, mock_checkout, mock_write_file):
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+            'dump_format': 'directory',
+            'dump_jobs': 8,
+        })
+        dest = self.parent_build.dest
+
+        def docker_run(cmd, log_path, *args, **kwargs):
+            self.assertEqual(cmd.finals[0], ['pg_dump', '-Fd', '-j', '8', '-Z0', '-f', '/data/build/logs/%s-all/dump' % dest, '%s-all' % dest])
+            self.assertEqual(cmd.finals[1][:5], ['tar', '-I', '"zstd -T0"', '-cf', '/data/build/logs/%s-all.dump.tar.zst' % dest])
+            self.assertEqual(cmd.finals[2][-6:], ['-cf', '/data/build/logs/%s-all.filestore.tar.zst' % dest, '-C', '/data/build/datadir/filestore/%s-all' % dest, '.'])
+
+        self.patchers['docker_run'].side_effect = docker_run
+        config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
+
+        manifest_path, manifest = mock_write_file.call_args[0]
+        self.assertEqual(manifest_path, 'logs/%s-all.manifest.json' % dest)
+        manifest = json.loads(manifest)
+        self.assertEqual(manifest['format'], 'directory')
+        self.assertEqual(manifest['db_name'], '%s-all' % dest)
+        self.assertEqual(manifest['files'], {'dump': '%s-all.dump.tar.zst' % dest, 'filestore': '%s-all.filestore.tar.zst' % dest})
+        self.assertEqual(self.env['runbot.database'].search([('name', '=', '%s-all' % dest)]).dump_format, 'directory')
+
+        restore_step = self.ConfigStep.create({
+            'name': 'restore',
+            'job_type': 'restore',
+            'restore_download_db_suffix': 'all',
+            'restore_rename_db_suffix': 'restored',
+            'dump_jobs': 2,
+        })
+        self.parent_build.host = 'host.runbot.com'
+        child_build = self.Build.create({'params_id': self.base_params.id, 'parent_id': self.parent_build.id})
+        result = restore_step._run_restore(child_build, 'dev/null/logpath')
+        cmds = result['cmd'].split(' && ')
+        log_url = 'http://host.runbot.com/runbot/static/build/%s/logs/' % dest
+        self.assertEqual(cmds[2], 'wget -q {0}{1}-all.manifest.json {0}{1}-all.dump.tar.zst {0}{1}-all.filestore.tar.zst'.format(log_url, dest))
+        self.assertIn('(pg_restore -j 2 --no-owner -d %s-restored dump || echo "### pg_restore reported errors")' % child_build.dest, cmds)
+        self.assertNotIn('psql -q %s-restored < dump.sql' % child_build.dest, cmds)
+
+    @patch('odoo.addons.runbot.models.build.BuildResult.write_file')
+    @patch('odoo.addons.runbot.models.build.BuildResult.read_file')
+    @patch('odoo.addons.runbot.models.build.BuildResult.is_file')
+    def test_dump_cache(self, mock_is_file, mock_read_file, mock_write_file):
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_dump_cache_size', 1)
+        install_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+        })
+        dest = self.parent_build.dest
+        checksum = 'a' * 64
+        database = self.env['runbot.database'].create({'name': '%s-all' % dest, 'build_id': self.parent_build.id})
+        mock_is_file.return_value = True
+        mock_read_file.return_value = '%s  %s-all.zip\n' % (checksum, dest)
+        install_step._publish_dump_checksums(self.parent_build)
+        self.assertEqual(database.dump_checksums.dict, {'%s-all.zip' % dest: checksum})
+        info_path, infos = mock_write_file.call_args[0]
+        self.assertEqual(info_path, 'logs/%s-all.info.json' % dest)
+        self.assertEqual(json.loads(infos)['sha256'], {'%s-all.zip' % dest: checksum})
+
+        restore_step = self.ConfigStep.create({
+            'name': 'restore',
+            'job_type': 'restore',
+            'restore_download_db_suffix': 'all',
+            'restore_rename_db_suffix': 'restored',
+        })
+        self.parent_build.host = 'host.runbot.com'
+        child_build = self.Build.create({'params_id': self.base_params.id, 'parent_id': self.parent_build.id})
+        cached_path = '/data/build/dump_cache/%s' % checksum
+        with patch('odoo.addons.runbot.models.build_config.DumpCache.has', return_value=False):
+            result = restore_step._run_restore(child_build, 'dev/null/logpath')
+        cmds = result['cmd'].split(' && ')
+        self.assertTrue(cmds[2].startswith('flock %s.lock' % cached_path), 'The first restore should download the dump in the cache')
+        self.assertIn('unzip -q %s' % cached_path, cmds)
+        self.assertEqual(result['rw_volumes'], {'dump_cache': '/tmp/runbot_test/static/dump_cache'})
+        self.assertNotIn('ro_volumes', result)
+
+        with patch('odoo.addons.runbot.models.build_config.DumpCache.has', return_value=True):
+            result = restore_step._run_restore(child_build, 'dev/null/logpath')
+        cmds = result['cmd'].split(' && ')
+        self.assertEqual(cmds[2], 'unzip -q %s' % cached_path, 'A cached dump should not be downloaded again')
+        self.assertEqual(result['ro_volumes'], {'dump_cache': '/tmp/runbot_test/static/dump_cache'})
+        self.assertNotIn('rw_volumes', result)
+
     @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
     def test_install_tags(self, mock_checkout):
         config_step = self.ConfigStep.create({
@@ -279,6 +372,59 @@ docker_params = dict(cmd=cmd)
 
         self.assertEqual(call_count, 1)
 
+    @patch('odoo.addons.runbot.models.database.shutil.copytree')
+    @patch('odoo.addons.runbot.models.build.BuildResult._checkout')
+    def test_db_template(self, mock_checkout, mock_copytree):
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_db_template_quota', 1)
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+            'test_enable': False,
+        })
+        host = self.env['runbot.host']._get_current()
+        db_name = '%s-all' % self.parent_build.dest
+        commands = []
+
+        def docker_run(cmd, *args, **kwargs):
+            commands.append(cmd)
+
+        self.patchers['docker_run'].side_effect = docker_run
+
+        config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
+        self.assertEqual(commands[-1].cmd[:2], ['python3', 'server/server.py'])
+        self.patchers['_local_pg_createdb'].assert_called_once_with(db_name)
+        self.assertEqual((host.db_template_hits, host.db_template_misses), (0, 1))
+
+        key = config_step._db_template_key(self.parent_build, config_step._modules_to_install(self.parent_build), '')
+        template = self.env['runbot.database.template'].create({'name': 'runbot-template-test', 'key': key, 'host': host.name, 'size': 10})
+        config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
+        self.assertEqual(commands[-1].cmd[0], 'echo', 'Modules should not be installed again')
+        self.assertIn(['pg_dump', db_name, '>', '/data/build/logs/%s//dump.sql' % db_name], commands[-1].finals)
+        self.patchers['_local_pg_createdb'].assert_called_with(db_name, db_template='runbot-template-test')
+        mock_copytree.assert_called_once()
+        self.assertEqual(mock_copytree.call_args[0][0], '/tmp/runbot_test/static/db_templates/runbot-template-test')
+        self.assertEqual((host.db_template_hits, host.db_template_misses), (1, 1))
+        self.assertEqual(template.hits, 1)
+
+        # tests cannot be skipped, steps running them never use a template
+        config_step.test_enable = True
+        config_step._run_install_odoo(self.parent_build, 'dev/null/logpath')
+        self.assertEqual(commands[-1].cmd[:2], ['python3', 'server/server.py'])
+        self.assertEqual((host.db_template_hits, host.db_template_misses), (1, 1))
+
+    def test_db_template_evict(self):
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_db_template_quota', 1)
+        Template = self.env['runbot.database.template']
+        now = datetime.datetime.now()
+        templates = Template
+        for i in range(3):
+            templates |= Template.create({'name': 'runbot-template-%s' % i, 'key': str(i), 'host': 'host.runbot.com', 'size': 600, 'last_used': now - datetime.timedelta(days=i)})
+        other_host = Template.create({'name': 'runbot-template-other', 'key': '0', 'host': 'other.runbot.com', 'size': 600})
+
+        Template._evict()
+        self.assertEqual(Template.search([]), templates[0] | other_host, 'Least recently used templates exceeding the quota should be dropped')
+        self.assertEqual(sorted(call[0][0] for call in self.patchers['_local_pg_dropdb_patcher'].call_args_list), ['runbot-template-1', 'runbot-template-2'])
+
 
 class TestMakeResult(RunbotCase):
 
@@ -436,4 +582,48 @@ Initiating shutdown
         result = config_step._make_results(build)
         self.assertEqual(result, {'local_result': 'warning'})
 
+    @patch('odoo.addons.runbot.models.build.BuildResult._kill')
+    @patch('odoo.addons.runbot.models.build.BuildResult._github_status')
+    def test_tail_log(self, mock_github_status, mock_kill):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        os.makedirs(os.path.join(tmp_dir, 'logs'))
+        log_path = os.path.join(tmp_dir, 'logs', 'all.txt')
+        self.start_patcher('build_path_patcher', 'odoo.addons.runbot.models.build.BuildResult._path', new=lambda build, *l, **kw: os.path.join(tmp_dir, *l))
+
+        config_step = self.ConfigStep.create({
+            'name': 'all',
+            'job_type': 'install_odoo',
+        })
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+            'local_state': 'testing',
+            'active_step': config_step.id,
+        })
+        with open(log_path, 'w') as log_file:
+            log_file.write('odoo.stuff.modules.loading: Modules loaded.\n2019-12-17 17:34:37,692 17 WARNING dbname path.to.test: timeout exceded\n')
+        self.assertFalse(config_step._tail_log(build))
+        self.assertEqual(build.log_tail['offset'], os.path.getsize(log_path))
+        self.assertEqual(build.log_tail['step_id'], config_step.id)
+        self.assertFalse(build.local_result)
+        mock_github_status.assert_not_called()
+
+        with open(log_path, 'a') as log_file:
+            log_file.write('2019-12-17 17:34:38,692 17 ERROR dbname path.to.test: FAIL: TestClass.test_\n')
+        self.assertFalse(config_step._tail_log(build))
+        self.assertEqual(build.local_result, 'ko')
+        mock_github_status.assert_called_once()
+        mock_kill.assert_not_called()
+
+        with patch('odoo.addons.runbot.log_analyzer._scan') as mock_scan:
+            self.assertEqual(config_step._check_error(build), 'ko')
+            self.assertEqual(config_step._check_module_loaded(build), 'ok')
+        mock_scan.assert_not_called()
+
+        # fail fast
+        config_step.fail_fast = True
+        build.write({'local_result': False, 'log_tail': {}})
+        self.assertTrue(config_step._tail_log(build))
+        mock_kill.assert_called_once_with(result='ko')
+
 # TODO add generic test to copy_paste _run_* in a python step
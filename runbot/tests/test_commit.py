@@ -1,11 +1,17 @@
 # -*- coding: utf-8 -*-
 import datetime
+import os
+import subprocess
+import tempfile
 from unittest.mock import patch
 from werkzeug.urls import url_parse
 
 from odoo.tests.common import HttpCase, new_test_user, tagged
 from odoo.tools import mute_logger
 
+from ..common import RunbotException
+from .common import RunbotCase
+
 
 @tagged('post_install', '-at_install')
 class TestCommitStatus(HttpCase):
@@ -92,3 +98,114 @@ class TestCommitStatus(HttpCase):
             response = self.url_open('/runbot/commit/resend/%s' % last_commit_status.id)
             self.assertEqual(response.status_code, 200)
             send_patcher.assert_not_called()
+
+
+class TestCommitStatusQueue(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_status_queue', True)
+        self.commit = self.Commit.create({'name': 'dfdfcfcf0000ffffffffffffffffffffffffffff', 'repo_id': self.repo_server.id})
+        self.Status = self.env['runbot.commit.status']
+
+    @patch('odoo.addons.runbot.models.commit._post_status', return_value=None)
+    def test_status_queue(self, mock_post):
+        self.commit._github_status(False, 'ci/runbot', 'pending', 'https://runbot.example.com')
+        self.commit._github_status(False, 'ci/runbot', 'success', 'https://runbot.example.com')
+        self.commit._github_status(False, 'ci/other', 'failure', 'https://runbot.example.com')
+        mock_post.assert_not_called()
+        pending, success, other = self.Status.search([('commit_id', '=', self.commit.id)], order='id')
+        # superseded status is collapsed
+        self.assertFalse(pending.to_send)
+        self.assertTrue(success.to_send)
+
+        self.assertEqual(self.Status._send_queued(), 2)
+        self.assertFalse((success | other).filtered('to_send'))
+        self.assertTrue(success.sent_date)
+        self.assertFalse(pending.sent_date)
+        sent = sorted((args[2], args[3]['state']) for args, _ in mock_post.call_args_list)
+        self.assertEqual(sent, [
+            ('https://api.example.com/repos/base/server/statuses/%s' % self.commit.name, 'failure'),
+            ('https://api.example.com/repos/base/server/statuses/%s' % self.commit.name, 'success'),
+            ('https://api.example.com/repos/dev/server/statuses/%s' % self.commit.name, 'failure'),
+            ('https://api.example.com/repos/dev/server/statuses/%s' % self.commit.name, 'success'),
+        ])
+        self.assertEqual(self.Status._send_queued(), 0)
+
+    @patch('odoo.addons.runbot.models.commit._post_status', return_value='502 Server Error')
+    def test_status_queue_retry(self, mock_post):
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_status_max_tries', 2)
+        self.commit._github_status(False, 'ci/runbot', 'success', 'https://runbot.example.com')
+        status = self.Status.search([('commit_id', '=', self.commit.id)])
+        with mute_logger('odoo.addons.runbot.models.commit'):
+            self.Status._send_queued()
+            self.assertTrue(status.to_send)
+            self.Status._send_queued()
+        self.assertFalse(status.to_send)
+        self.assertEqual(status.send_tries, 2)
+        self.assertFalse(status.sent_date)
+
+    @patch('odoo.addons.runbot.models.commit._post_status', return_value=None)
+    def test_status_queue_claim(self, mock_post):
+        self.commit._github_status(False, 'ci/runbot', 'pending', 'https://runbot.example.com')
+        pending = self.Status.search([('commit_id', '=', self.commit.id)])
+        pending.claimed_date = datetime.datetime.utcnow()  # being sent by another worker
+        self.commit._github_status(False, 'ci/runbot', 'success', 'https://runbot.example.com')
+        success = self.Status.search([('commit_id', '=', self.commit.id)], order='id desc', limit=1)
+        # the newer status waits for the older one being sent
+        self.assertEqual(self.Status._send_queued(), 0)
+        mock_post.assert_not_called()
+
+        pending.claimed_date = datetime.datetime.utcnow() - datetime.timedelta(minutes=20)  # worker died
+        self.assertEqual(self.Status._send_queued(), 1)
+        self.assertTrue(success.sent_date)
+        self.assertFalse(success.claimed_date)
+        self.assertFalse(pending.to_send)
+
+
+class TestCommitRebase(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        tmp_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp_dir.cleanup)
+        self.patchers['repo_root_patcher'].return_value = tmp_dir.name
+        self.repo_server.invalidate_cache(['path'])
+        self.git_dir = self.repo_server.path
+        subprocess.check_output(['git', 'init', '--bare', self.git_dir])
+        self.index = os.path.join(tmp_dir.name, 'index')
+
+    def _git(self, cmd, input_data=''):
+        env = dict(os.environ, GIT_INDEX_FILE=self.index, GIT_AUTHOR_NAME='Marc Bidule', GIT_AUTHOR_EMAIL='marc@example.com', GIT_COMMITTER_NAME='Marc Bidule', GIT_COMMITTER_EMAIL='marc@example.com')
+        return subprocess.check_output(['git', '--git-dir=%s' % self.git_dir] + cmd, input=input_data.encode(), env=env).decode().strip()
+
+    def _commit(self, parent, files):
+        """ Create a commit on top of parent, files being a {path: content or None to remove} dict """
+        if parent:
+            self._git(['read-tree', parent])
+        else:
+            self._git(['read-tree', '--empty'])
+        for path, content in files.items():
+            if content is None:
+                self._git(['update-index', '--index-info'], '0 %s\t%s\n' % ('0' * 40, path))
+            else:
+                self._git(['update-index', '--add', '--cacheinfo', '100644,%s,%s' % (self._git(['hash-object', '-w', '--stdin'], content), path)])
+        return self._git(['commit-tree', self._git(['write-tree'])] + (['-p', parent] if parent else []), 'commit')
+
+    def _files(self, tree):
+        return {path: self._git(['cat-file', 'blob', '%s:%s' % (tree, path)]) for path in self._git(['ls-tree', '-r', '--name-only', tree]).split('\n')}
+
+    def test_rebased_tree(self):
+        root = self._commit(None, {'models.py': 'a\nb\nc\n', 'data.xml': '<odoo/>'})
+        base = self._commit(root, {'views.xml': '<odoo></odoo>'})
+        dev = self._commit(root, {'models.py': None, 'fields.py': 'a\nB\nc\n'})  # renamed and modified
+
+        base_commit = self.Commit.create({'name': base, 'repo_id': self.repo_server.id})
+        rebased = self.Commit.create({'name': dev, 'repo_id': self.repo_server.id, 'rebase_on_id': base_commit.id})
+        tree = rebased._rebased_tree()
+        self.assertEqual(self._files(tree), {'fields.py': 'a\nB\nc', 'data.xml': '<odoo/>', 'views.xml': '<odoo></odoo>'})
+
+        conflicting_base = self.Commit.create({'name': self._commit(root, {'models.py': 'a\nX\nc\n'}), 'repo_id': self.repo_server.id})
+        conflicting = self.Commit.create({'name': self._commit(root, {'models.py': 'a\nB\nc\n'}), 'repo_id': self.repo_server.id, 'rebase_on_id': conflicting_base.id})
+        with self.assertRaises(RunbotException):
+            conflicting._rebased_tree()
@@ -18,8 +18,9 @@ class TestCron(RunbotCase):
         self.start_patcher('_get_cron_period', 'odoo.addons.runbot.models.runbot.Runbot._get_cron_period', 2)
 
     @patch('time.sleep', side_effect=sleep)
+    @patch('odoo.addons.runbot.models.repo.Repo._update_parallel', return_value={})
     @patch('odoo.addons.runbot.models.repo.Repo._update_batches')
-    def test_cron_schedule(self, mock_update_batches, *args):
+    def test_cron_schedule(self, mock_update_batches, mock_update_parallel, *args):
         """ test that cron_fetch_and_schedule do its work """
         self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_update_frequency', 1)
         self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_do_fetch', True)
@@ -28,6 +29,7 @@ class TestCron(RunbotCase):
             self.Runbot._cron()
         except SleepException:
             pass  # sleep raises an exception to avoid to stay stuck in loop
+        mock_update_parallel.assert_called()
         mock_update_batches.assert_called()
 
     @patch('time.sleep', side_effect=sleep)
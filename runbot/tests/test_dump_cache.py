@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import os
+import time
+
+from .common import TmpDirCase
+
+from ..dump_cache import DumpCache
+
+
+class TestDumpCache(TmpDirCase):
+
+    def setUp(self):
+        super().setUp()
+        self.cache = DumpCache(self.tmp_dir)
+
+    def _add(self, checksum, size, age):
+        path = os.path.join(self.tmp_dir, checksum)
+        with open(path, 'wb') as dump_file:
+            dump_file.write(b'0' * size)
+        mtime = time.time() - age
+        os.utime(path, (mtime, mtime))
+        return path
+
+    def test_gc(self):
+        self._add('a' * 64, 100, 30)
+        self._add('b' * 64, 100, 20)
+        self._add('c' * 64, 100, 10)
+        self._add('d' * 64 + '.tmp', 50, 3 * 24 * 3600)
+        self._add('e' * 64 + '.lock', 0, 10)
+
+        self.assertTrue(self.cache.has('a' * 64), 'A cached dump should be found')
+        self.assertFalse(self.cache.has('f' * 64))
+        self.assertEqual(self.cache.gc(250), 1)
+        self.assertEqual(sorted(os.listdir(self.tmp_dir)), ['a' * 64, 'c' * 64, 'e' * 64 + '.lock'], 'The least recently used dump and old downloads should be removed')
+        self.assertEqual(self.cache.gc(0), 2)
+
+    def test_fetch_cmd(self):
+        checksum = 'a' * 64
+        cmd = self.cache.fetch_cmd(checksum, 'http://host/dump.zip', '/data/build/dump_cache')
+        self.assertTrue(cmd.startswith('flock /data/build/dump_cache/%s.lock ' % checksum), 'Concurrent downloads of a dump should wait for each other')
+        self.assertIn('test -f /data/build/dump_cache/%s ||' % checksum, cmd)
+        self.assertIn('echo "%s  /data/build/dump_cache/%s.tmp" | sha256sum -c --quiet -' % (checksum, checksum), cmd)
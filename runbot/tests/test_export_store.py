@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import subprocess
+
+from .common import TmpDirCase
+
+from ..export_store import ExportStore
+
+
+class TestExportStore(TmpDirCase):
+
+    def setUp(self):
+        super().setUp()
+        self.git_dir = os.path.join(self.tmp_dir, 'repo')
+        subprocess.check_output(['git', 'init', '--bare', self.git_dir])
+
+    def _git(self, cmd, input_data='', env=None):
+        return subprocess.check_output(['git', '--git-dir=%s' % self.git_dir] + cmd, input=input_data.encode(), env=env).decode().strip()
+
+    def _tree(self, files):
+        """ Create a tree from a {path: (mode, content)} dict, using a temporary index """
+        env = dict(os.environ, GIT_INDEX_FILE=os.path.join(self.tmp_dir, 'index'))
+        self._git(['read-tree', '--empty'], env=env)
+        for path, (mode, content) in files.items():
+            sha = self._git(['hash-object', '-w', '--stdin'], content)
+            self._git(['update-index', '--add', '--cacheinfo', '%s,%s,%s' % (mode, sha, path)], env=env)
+        return self._git(['write-tree'], env=env)
+
+    def test_export_hardlink(self):
+        files = {
+            'odoo-bin': ('100755', '#!/usr/bin/env python3\n'),
+            'addons/web/__init__.py': ('100644', 'from . import models\n'),
+            'addons/base/__init__.py': ('100644', 'from . import models, report\n'),
+            'link.py': ('120000', 'addons/web/__init__.py'),
+        }
+        first_tree = self._tree(files)
+        files['addons/web/__init__.py'] = ('100644', 'from . import controllers\n')
+        second_tree = self._tree(files)
+
+        store = ExportStore(os.path.join(self.tmp_dir, 'store'), self.git_dir)
+        first_path = os.path.join(self.tmp_dir, 'sources', 'first')
+        second_path = os.path.join(self.tmp_dir, 'sources', 'second')
+        self.assertEqual(store.export(first_tree, first_path), (4, 3))
+        self.assertEqual(store.export(second_tree, second_path), (4, 1), 'Only the changed blob should be stored')
+
+        with open(os.path.join(second_path, 'addons/web/__init__.py')) as f:
+            self.assertEqual(f.read(), 'from . import controllers\n')
+        self.assertEqual(os.readlink(os.path.join(first_path, 'link.py')), 'addons/web/__init__.py')
+        self.assertTrue(os.access(os.path.join(first_path, 'odoo-bin'), os.X_OK))
+        self.assertFalse(os.stat(os.path.join(first_path, 'addons/base/__init__.py')).st_mode & 0o222, 'Exported files should be read only')
+        self.assertEqual(os.stat(os.path.join(first_path, 'odoo-bin')).st_ino, os.stat(os.path.join(second_path, 'odoo-bin')).st_ino)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tmp_dir, 'sources'))), ['first', 'second'])
+
+        self.assertEqual(store.gc(), 0)
+        shutil.rmtree(first_path)
+        self.assertEqual(store.gc(), 1, 'Only the blob of the first export should be removed')
+        shutil.rmtree(second_path)
+        self.assertEqual(store.gc(), 3)
+
+    def test_export_failure(self):
+        store = ExportStore(os.path.join(self.tmp_dir, 'store'), self.git_dir)
+        with self.assertRaises(subprocess.CalledProcessError):
+            store.export('0' * 40, os.path.join(self.tmp_dir, 'sources', 'missing'))
+        self.assertEqual(os.listdir(os.path.join(self.tmp_dir, 'sources')), [], 'No partial export should be left')
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+import os
+from unittest.mock import patch
+
+from .common import TmpDirCase
+
+from .. import log_analyzer
+from ..log_analyzer import analyze_log, LogTail
+
+_re_error = r'^(?:\d{4}-\d\d-\d\d \d\d:\d\d:\d\d,\d{3} \d+ (?:ERROR|CRITICAL) )|(?:Traceback \(most recent call last\):)$'
+
+
+class TestLogAnalyzer(TmpDirCase):
+
+    def setUp(self):
+        super().setUp()
+        self.log_path = os.path.join(self.tmp_dir, 'all.txt')
+        with open(self.log_path, 'w') as log_file:
+            log_file.write("""2020-03-02 22:06:58,391 17 INFO xxx odoo.modules.loading: Modules loaded.
+2020-03-02 22:06:58,391 17 INFO xxx odoo.modules.module: odoo.addons.website_blog.tests.test_ui tested in 10.35s, 2501 queries
+2020-03-02 22:07:14,340 17 INFO xxx odoo.modules.module: odoo.addons.website_event.tests.test_ui tested in 9.26s, 2435 queries
+2020-03-02 22:07:15,340 17 INFO xxx odoo.service.server: Initiating shutdown
+""")
+        patcher = patch.dict(log_analyzer._analyses, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_analyze_log(self):
+        stat_regexes = [('query_count', r'odoo.addons.(?P<key>.+) tested in .+, (?P<value>\d+) queries')]
+        analysis = analyze_log(self.log_path, strings=['Modules loaded.', 'Initiating shutdown', 'Not there'], patterns=[_re_error], stat_regexes=stat_regexes)
+        self.assertTrue(analysis.found('Modules loaded.'))
+        self.assertTrue(analysis.found('Initiating shutdown'))
+        self.assertFalse(analysis.found('Not there'))
+        self.assertFalse(analysis.matched(_re_error))
+        self.assertEqual(analysis.stat_values(stat_regexes), {
+            'query_count.website_blog.tests.test_ui': 2501.0,
+            'query_count.website_event.tests.test_ui': 2435.0,
+        })
+
+        with patch('builtins.open') as mock_open:
+            self.assertEqual(analyze_log(self.log_path, stat_regexes=stat_regexes).stat_values(stat_regexes)['query_count.website_event.tests.test_ui'], 2435.0)
+            self.assertFalse(analyze_log(self.log_path, patterns=[_re_error]).matched(_re_error))
+        mock_open.assert_not_called()
+
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('Traceback (most recent call last):\n')
+        self.assertTrue(analyze_log(self.log_path, patterns=[_re_error]).matched(_re_error), 'A modified log should be analyzed again')
+
+    def test_analyze_missing_log(self):
+        analysis = analyze_log(os.path.join(self.tmp_dir, 'missing.txt'), strings=['Initiating shutdown'], patterns=[_re_error])
+        self.assertFalse(analysis.found('Initiating shutdown'))
+        self.assertFalse(analysis.matched(_re_error))
+
+    def test_log_tail(self):
+        tail = LogTail(strings=['Initiating shutdown'], patterns=[_re_error])
+        self.assertEqual(tail.update(self.log_path), {})
+        self.assertTrue(tail.found['Initiating shutdown'])
+        offset = tail.offset
+        self.assertEqual(offset, os.path.getsize(self.log_path))
+
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('Traceback (most recent call last):\nFile "x.py", line 1')
+        self.assertEqual(tail.update(self.log_path), {_re_error: 'Traceback (most recent call last):'})
+        self.assertEqual(tail.offset, offset + len('Traceback (most recent call last):\n'), 'An incomplete line should be read on next update')
+        self.assertEqual(tail.update(self.log_path), {}, 'A pattern should only be reported once')
+
+        tail = LogTail.from_dict(tail.to_dict())
+        with patch('odoo.addons.runbot.log_analyzer._scan') as mock_scan:
+            analysis = analyze_log(self.log_path, strings=['Initiating shutdown'], patterns=[_re_error], tail=tail)
+        mock_scan.assert_not_called()
+        self.assertTrue(analysis.found('Initiating shutdown'))
+        self.assertTrue(analysis.matched(_re_error))
+
+    def test_log_tail_offset(self):
+        tail = LogTail(patterns=[_re_error])
+        tail.update(self.log_path)
+        with open(self.log_path, 'a') as log_file:
+            log_file.write('2020-03-02 22:07:16,340 17 ERROR xxx odoo.service.server: Oops\n')
+        analysis = analyze_log(self.log_path, patterns=[_re_error], tail=tail)
+        self.assertTrue(analysis.matched(_re_error), 'The content written after the tail offset should be scanned')
+
+        with open(self.log_path, 'w') as log_file:
+            log_file.write('Rewritten\n')
+        self.assertEqual(tail.update(self.log_path), {})
+        self.assertEqual(tail.offset, len('Rewritten\n'), 'A rewritten log should be scanned again')
@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 import datetime
 import re
+import subprocess
+import tempfile
 from unittest import skip
 from unittest.mock import patch, Mock
 from subprocess import CalledProcessError
@@ -10,6 +12,8 @@ import logging
 import odoo
 import time
 
+from ..models.repo import CatFile, Repo
+from ..models.runbot import BuildSnapshot, TurnStats
 from .common import RunbotCase, RunbotCaseMinimalSetup
 
 _logger = logging.getLogger(__name__)
@@ -327,26 +331,27 @@ class TestGithub(TransactionCase):
         remote_server.token = 'abc'
 
         import requests
-        with patch('odoo.addons.runbot.models.repo.requests.Session') as mock_session, patch('time.sleep') as mock_sleep:
+        with patch('odoo.addons.runbot_github.github.GithubClient.request') as mock_request, patch('time.sleep') as mock_sleep:
             mock_sleep.return_value = None
             with self.assertRaises(Exception, msg='should raise an exception with ignore_errors=False'):
-                mock_session.return_value.post.side_effect = requests.HTTPError('301: Bad gateway')
+                mock_request.side_effect = requests.HTTPError('301: Bad gateway')
                 remote_server._github('/repos/:owner/:repo/statuses/abcdef', {'foo': 'bar'}, ignore_errors=False)
+            self.assertEqual(mock_request.call_args[0], ('POST', 'https://api.example.com/repos/base/server/statuses/abcdef'))
 
-            mock_session.return_value.post.reset_mock()
+            mock_request.reset_mock()
             with self.assertLogs(logger='odoo.addons.runbot.models.repo') as assert_log:
                 remote_server._github('/repos/:owner/:repo/statuses/abcdef', {'foo': 'bar'}, ignore_errors=True)
                 self.assertIn('Ignored github error', assert_log.output[0])
 
-            self.assertEqual(2, mock_session.return_value.post.call_count, "_github method should try two times by default")
+            self.assertEqual(2, mock_request.call_count, "_github method should try two times by default")
 
-            mock_session.return_value.post.reset_mock()
-            mock_session.return_value.post.side_effect = [requests.HTTPError('301: Bad gateway'), Mock()]
+            mock_request.reset_mock()
+            mock_request.side_effect = [requests.HTTPError('301: Bad gateway'), Mock()]
             with self.assertLogs(logger='odoo.addons.runbot.models.repo') as assert_log:
                 remote_server._github('/repos/:owner/:repo/statuses/abcdef', {'foo': 'bar'}, ignore_errors=True)
                 self.assertIn('Success after 2 tries', assert_log.output[0])
 
-            self.assertEqual(2, mock_session.return_value.post.call_count, "_github method should try two times by default")
+            self.assertEqual(2, mock_request.call_count, "_github method should try two times by default")
 
 
 class TestFetch(RunbotCase):
@@ -356,13 +361,17 @@ class TestFetch(RunbotCase):
         self.mock_root = self.patchers['repo_root_patcher']
         self.fetch_count = 0
         self.force_failure = False
+        self.failing_repos = set()
+        # the fetch threads use the test cursor
+        self.registry.enter_test_mode(self.cr)
+        self.addCleanup(self.registry.leave_test_mode)
 
     def mock_git_helper(self):
         """Helper that returns a mock for repo._git()"""
         def mock_git(repo, cmd):
             self.assertIn('fetch', cmd)
             self.fetch_count += 1
-            if self.fetch_count < 3 or self.force_failure:
+            if self.fetch_count < 3 or self.force_failure or repo.id in self.failing_repos:
                 raise CalledProcessError(128, cmd, 'Dummy Error'.encode('utf-8'))
             else:
                 return True
@@ -389,6 +398,125 @@ class TestFetch(RunbotCase):
         self.assertTrue(host.assigned_only)
         self.assertEqual(self.fetch_count, 5)
 
+    def test_read_refs_snapshot(self):
+        """ Test that only the added or moved refs are returned """
+        def ref(name, sha):
+            return ('refs/base_server/heads/%s' % name, sha, datetime.datetime.now().strftime("%Y-%m-%d, %H:%M:%S"),
+                    'Marc Bidule', '<marc.bidule@somewhere.com>', 'subject', 'Marc Bidule', '<marc.bidule@somewhere.com>')
+
+        self.commit_list[self.repo_server.id] = [ref('13.0-a', 'aaaa'), ref('13.0-b', 'bbbb')]
+        refs = self.repo_server._read_refs(['refs/*/heads/*'])
+        self.assertEqual([r[0] for r in refs], ['refs/base_server/heads/13.0-a', 'refs/base_server/heads/13.0-b'])
+        self.assertEqual(self.repo_server._read_refs(['refs/*/heads/*']), [])
+
+        # a moves, b is deleted, c is new and ignored
+        self.commit_list[self.repo_server.id] = [ref('13.0-a', 'a2a2'), ref('13.0-c', 'cccc')]
+        refs = self.repo_server._read_refs(['refs/*/heads/*'], ignore={'13.0-c': 0})
+        self.assertEqual([r[:2] for r in refs], [('refs/base_server/heads/13.0-a', 'a2a2')])
+        self.assertEqual(dict(self.repo_server.ref_snapshot), {'refs/base_server/heads/13.0-a': 'a2a2'})
+
+        # c is not ignored anymore, b is pushed again
+        self.commit_list[self.repo_server.id] = [ref('13.0-a', 'a2a2'), ref('13.0-b', 'bbbb'), ref('13.0-c', 'cccc')]
+        refs = self.repo_server._read_refs(['refs/*/heads/*'])
+        self.assertEqual([r[1] for r in refs], ['bbbb', 'cccc'])
+
+        # a partial read does not consider the other refs as deleted
+        self.commit_list[self.repo_server.id] = [ref('13.0-a', 'a3a3')]
+        refs = self.repo_server._read_refs(['refs/base_server/heads/13.0-a'], partial=True)
+        self.assertEqual([r[1] for r in refs], ['a3a3'])
+        self.assertEqual(len(self.repo_server.ref_snapshot), 3)
+
+    @patch('time.sleep', return_value=None)
+    @patch('odoo.addons.runbot.models.repo.Repo._need_fetch', return_value=True)
+    def test_update_parallel(self, mock_need_fetch, mock_sleep):
+        """ Test that repos are fetched concurrently through _update_fetch_cmd """
+        host = self.env['runbot.host']._get_current()
+        repos = self.repo_server | self.repo_addons
+        self.fetch_count = 3  # no failure for the first tries
+        self.failing_repos = {self.repo_addons.id}
+
+        stats = TurnStats(self.env, 'fetch')
+        with patch('odoo.addons.runbot.models.repo.Repo._update_fetch_cmd', side_effect=Repo._update_fetch_cmd, autospec=True) as mock_fetch_cmd, mute_logger("odoo.addons.runbot.models.repo"):
+            fetched = repos._update_parallel(stats=stats)
+
+        self.assertEqual(sorted(call[0][0].id for call in mock_fetch_cmd.call_args_list), sorted(repos.ids))
+        self.assertEqual(fetched, {self.repo_server.id: (None, [])})
+        self.assertEqual(self.fetch_count, 3 + 1 + 5)
+        self.assertIn('fetch %s' % self.repo_addons.name, stats.phases)
+        self.assertTrue(host.assigned_only)
+        # the host is reserved by the main cursor, once
+        self.assertEqual(len(host.message_ids.filtered(lambda m: 'Failed to fetch repo' in (m.body or ''))), 1)
+
+        with patch('odoo.addons.runbot.models.repo.Repo._get_refs', return_value=[]) as mock_get_refs:
+            repos._update_batches(fetched=fetched)
+        self.assertEqual(mock_get_refs.call_count, 1)
+
+    @patch('odoo.addons.runbot.models.repo.Repo._need_fetch', return_value=True)
+    def test_update_parallel_hook_refs(self, mock_need_fetch):
+        """ Test that only the refs received in hooks are fetched in hook mode """
+        host = self.env['runbot.host']._get_current()
+        self.repo_server.write({'mode': 'hook', 'last_full_fetch': time.time()})
+        self.remote_server.fetch_pull = True
+        self.remote_server._queue_hook_ref('13.0-foo', False, 'd0d0')
+        self.remote_server._queue_hook_ref('42', True, 'cafe')
+        self.remote_server_dev._queue_hook_ref('13.0-bar', False, 'beef')
+        self.remote_server_dev._queue_hook_ref('43', True, 'f00d')  # dev remote does not fetch pr
+        commands = []
+
+        def git(repo, cmd):
+            commands.append(cmd)
+            if self.force_failure:
+                raise CalledProcessError(128, cmd, b'Dummy Error')
+            return ''
+
+        hook_refs = self.env['runbot.repo.hookref'].search([('repo_id', '=', self.repo_server.id)])
+        with patch('odoo.addons.runbot.models.repo.Repo._git', side_effect=git, autospec=True):
+            fetched = self.repo_server._update_parallel()
+
+        self.assertEqual(sorted(commands), [
+            ['fetch', 'base_server', '+refs/heads/13.0-foo:refs/base_server/heads/13.0-foo', '+refs/pull/42/head:refs/base_server/pull/42'],
+            ['fetch', 'dev_server', '+refs/heads/13.0-bar:refs/dev_server/heads/13.0-bar'],
+        ])
+        self.assertEqual(fetched, {self.repo_server.id: (['refs/base_server/heads/13.0-foo', 'refs/base_server/pull/42', 'refs/dev_server/heads/13.0-bar'], hook_refs.ids)})
+
+        # the hook refs are kept until processed, fetched again if the processing is lost
+        self.assertEqual(self.env['runbot.repo.hookref'].search([('repo_id', '=', self.repo_server.id)]), hook_refs)
+        mock_need_fetch.return_value = False
+        commands.clear()
+        with patch('odoo.addons.runbot.models.repo.Repo._git', side_effect=git, autospec=True):
+            fetched = self.repo_server._update_parallel()
+        self.assertEqual(len(commands), 2)
+        mock_need_fetch.return_value = True
+
+        self.remote_server._queue_hook_ref('13.0-baz', False, 'baba')  # received during the processing, kept
+        with patch('odoo.addons.runbot.models.repo.Repo._get_refs', return_value=[]) as mock_get_refs:
+            self.repo_server._update_batches(fetched=fetched)
+        self.assertEqual(mock_get_refs.call_args[1]['ref_names'], fetched[self.repo_server.id][0])
+        self.assertEqual(self.env['runbot.repo.hookref'].search([('repo_id', '=', self.repo_server.id)]).mapped('ref'), ['refs/base_server/heads/13.0-baz'])
+        self.env['runbot.repo.hookref'].search([]).unlink()
+
+        # a failing targeted fetch is not retried, does not disable the host but forces a full fetch
+        self.force_failure = True
+        self.remote_server._queue_hook_ref('13.0-foo', False, 'd1d1')
+        hook_refs = self.env['runbot.repo.hookref'].search([('repo_id', '=', self.repo_server.id)])
+        commands.clear()
+        with patch('odoo.addons.runbot.models.repo.Repo._git', side_effect=git, autospec=True), mute_logger("odoo.addons.runbot.models.repo"):
+            fetched = self.repo_server._update_parallel()
+        self.assertEqual(len(commands), 1)
+        self.assertEqual(fetched, {})
+        self.assertFalse(host.assigned_only)
+        self.assertEqual(self.repo_server.last_full_fetch, 0)
+
+        self.force_failure = False
+        commands.clear()
+        with patch('odoo.addons.runbot.models.repo.Repo._git', side_effect=git, autospec=True):
+            fetched = self.repo_server._update_parallel()
+        self.assertEqual(commands, [['fetch', '-p', '--all']])
+        self.assertEqual(fetched, {self.repo_server.id: (None, hook_refs.ids)})
+        with patch('odoo.addons.runbot.models.repo.Repo._get_refs', return_value=[]):
+            self.repo_server._update_batches(fetched=fetched)
+        self.assertFalse(self.env['runbot.repo.hookref'].search([('repo_id', '=', self.repo_server.id)]))
+
 
 class TestIdentityFile(RunbotCase):
 
@@ -414,6 +542,39 @@ class TestIdentityFile(RunbotCase):
                 self.repo_server._update_fetch_cmd()
 
 
+class TestCatFile(RunbotCase):
+
+    def test_cat_file(self):
+        """ Test that objects are looked up through a single git process """
+        with tempfile.TemporaryDirectory() as path:
+            subprocess.check_output(['git', 'init', '--bare', path])
+            sha = subprocess.check_output(['git', '-C', path, 'hash-object', '-w', '--stdin'], input=b'hello').decode().strip()
+            cat_file = CatFile(path, cache_size=1)
+            self.assertEqual(cat_file.info(sha), (sha, 'blob', 5))
+            process = cat_file.process
+            self.assertIsNone(cat_file.info('0' * 40))
+            self.assertIsNone(cat_file.info('not a sha'))
+            other_sha = subprocess.check_output(['git', '-C', path, 'hash-object', '-w', '--stdin'], input=b'world!').decode().strip()
+            self.assertEqual(cat_file.info(other_sha), (other_sha, 'blob', 6))
+            self.assertEqual(list(cat_file.known), [other_sha])
+            # only full shas are cached, a ref can move
+            subprocess.check_output(['git', '-C', path, 'update-ref', 'refs/tags/moving', sha])
+            self.assertEqual(cat_file.info('moving'), (sha, 'blob', 5))
+            subprocess.check_output(['git', '-C', path, 'update-ref', 'refs/tags/moving', other_sha])
+            self.assertEqual(cat_file.info('moving'), (other_sha, 'blob', 6))
+            self.assertEqual(list(cat_file.known), [other_sha])
+            self.assertIs(cat_file.process, process, 'The same process should be used for all lookups')
+
+            # new packs restart the process
+            cat_file.packs_mtime = -1
+            self.assertEqual(cat_file.info(sha), (sha, 'blob', 5))
+            self.assertIsNot(cat_file.process, process)
+            cat_file.close()
+
+        with self.assertRaises(OSError):
+            CatFile('/tmp/runbot_test/not_a_repo').info(sha)
+
+
 class TestRepoScheduler(RunbotCase):
 
     def setUp(self):
@@ -467,3 +628,56 @@ class TestRepoScheduler(RunbotCase):
         builds[0].write({'local_state': 'done'})
 
         self.Runbot._scheduler(host)
+
+    @patch('odoo.addons.runbot.models.build.BuildResult._kill')
+    @patch('odoo.addons.runbot.models.build.BuildResult._schedule')
+    @patch('odoo.addons.runbot.models.build.BuildResult._init_pendings')
+    def test_repo_scheduler_snapshot(self, mock_init_pendings, mock_schedule, mock_kill):
+        self.env['ir.config_parameter'].set_param('runbot.runbot_workers', 6)
+        self.env['ir.config_parameter'].set_param('runbot.runbot_scheduler_snapshot', True)
+        builds = self.Build
+        for _ in range(6):
+            builds |= self.Build.create({
+                'params_id': self.base_params.id,
+                'build_type': 'normal',
+                'local_state': 'testing',
+                'host': 'host.runbot.com'
+            })
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+            'build_type': 'normal',
+            'local_state': 'pending',
+        })
+        host = self.env['runbot.host']._get_current()
+        snapshot = self.Runbot._scheduler(host)
+
+        self.assertEqual(mock_schedule.call_count, 6)
+        self.assertEqual(sorted(snapshot.ids(states=('testing',))), sorted(builds.ids))
+        self.assertGreater(snapshot.saved_queries, 0)
+        build.invalidate_cache()
+        self.assertFalse(build.host)
+        mock_init_pendings.assert_not_called()
+
+        # give some room for the pending build
+        builds[0].write({'local_state': 'done'})
+
+        snapshot = self.Runbot._scheduler(host)
+        build.invalidate_cache()
+        self.assertEqual(build.host, 'host.runbot.com')
+        self.assertIn(build.id, snapshot.ids(states=('pending',)))
+        self.assertNotIn(builds[0].id, snapshot.ids())
+        mock_init_pendings.assert_called_once_with(host)
+
+        # each build is committed, an error only rolls back the failing build
+        mock_schedule.reset_mock()
+        mock_schedule.side_effect = [Exception('Docker error')] + [None] * 4
+        with patch('odoo.sql_db.Cursor.rollback') as mock_rollback, mute_logger('odoo.addons.runbot.models.runbot'):
+            snapshot = self.Runbot._scheduler(host)
+        self.assertEqual(mock_schedule.call_count, 5)
+        mock_rollback.assert_called_once()
+
+        # only the selections replacing a search of the legacy scheduler are counted
+        snapshot = BuildSnapshot(self.env, host.name, [dict(id=1, local_state='testing', requested_action=False, killable=True)])
+        self.assertEqual(snapshot.ids(states=('testing', 'pending')), [1])
+        self.assertEqual(snapshot.ids(states=('testing', 'pending'), killable=True, saves_query=False), [1])
+        self.assertEqual(snapshot.saved_queries, 1)
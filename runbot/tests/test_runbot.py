@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 import logging
+import os
+import shutil
+import tempfile
+import threading
 
+from unittest.mock import patch
 from .common import RunbotCase
+from ..common import host_channel, percentile
+from ..models.runbot import _nginx_fingerprints as nginx_fingerprints
+from ..container import _count_docker_call, docker_cache, docker_is_running, docker_ps, docker_state, DockerEventsWatcher
 
 _logger = logging.getLogger(__name__)
 
@@ -12,3 +20,125 @@ class TestRunbot(RunbotCase):
         warning = self.env['runbot.runbot'].warning('Test warning message')
 
         self.assertTrue(self.env['runbot.warning'].browse(warning.id).exists())
+
+    def test_notification_channels(self):
+        host = self.env['runbot.host'].create({'name': 'notify.runbot.com'})
+        channels = self.Runbot._notification_channels(host, builder=True)
+        # the channel computed by the runbot_build_notify trigger must match the python one
+        self.env.cr.execute("SELECT 'runbot_host_' || left(md5(%s), 16)", [host.name])
+        self.assertEqual(channels, [self.env.cr.fetchone()[0], 'runbot_pending'])
+
+        host.assigned_only = True
+        self.assertEqual(self.Runbot._notification_channels(host, builder=True, leader=True), [host_channel(host.name), 'runbot_leader'])
+
+        self.assertIsNone(self.Runbot._get_listener(channels))
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_listen_notify', True)
+        self.assertEqual(self.Runbot._get_listener(channels).channels, channels)
+
+    def test_docker_cache(self):
+        self.patchers['docker_ps'].return_value = ['12345-build_server']
+        with docker_cache():
+            self.assertTrue(docker_is_running('12345-build_server'))
+            self.assertFalse(docker_is_running('12346-build_server'))
+            self.assertEqual(docker_ps(), ['12345-build_server'])
+        self.assertEqual(self.patchers['docker_ps'].call_count, 1)
+
+    def test_scheduler_docker_calls(self):
+        host = self.env['runbot.host']._get_current()
+
+        def docker_ps():
+            _count_docker_call()
+            return []
+        self.patchers['docker_ps'].side_effect = docker_ps
+        self.Runbot._scheduler(host)
+        # a single docker ps shared by the whole turn
+        self.assertEqual(host.last_docker_calls, 1)
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 0.5), 0)
+        self.assertEqual(percentile([3, 1, 2, 4], 0.5), 2)
+        self.assertEqual(percentile(list(range(1, 101)), 0.95), 95)
+        self.assertEqual(percentile([7], 0.95), 7)
+
+    def test_scheduler_turn_stats(self):
+        host = self.env['runbot.host']._get_current()
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_turn_stats_samples', 3)
+        for _ in range(4):
+            self.Runbot._scheduler(host)
+        scheduler_stats = host.turn_stats['scheduler']
+        for phase in ('gc_testing', 'requested_actions', 'schedule', 'assign', 'init', 'gc_running', 'nginx', 'total'):
+            self.assertEqual(set(scheduler_stats[phase]), {'duration', 'queries', 'subprocesses', 'commits'})
+            self.assertEqual(len(scheduler_stats[phase]['duration']), 3)
+        self.assertGreater(scheduler_stats['total']['queries'][-1], 0)
+        self.assertGreaterEqual(scheduler_stats['total']['queries'][-1], scheduler_stats['assign']['queries'][-1])
+
+        percentiles = host._turn_stats_percentiles()
+        self.assertEqual(percentiles[0][:2], ('scheduler', 'total'))
+
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_slow_turn_threshold', 0.000001)
+        with self.assertLogs('odoo.addons.runbot.models.runbot', level='WARNING') as logs:
+            self.Runbot._scheduler(host)
+        self.assertIn('Slow scheduler turn on host.runbot.com', logs.output[0])
+
+    def test_docker_events_watcher(self):
+        wakeup = threading.Event()
+        watcher = DockerEventsWatcher(wakeup)
+        watcher._process_line(b'{"Action": "start", "Actor": {"Attributes": {"name": "12345-build_server"}}}')
+        self.assertEqual(watcher.get_state('12345-build_server'), {'running': True, 'exit_code': None, 'oom': False})
+        self.assertFalse(wakeup.is_set())
+
+        markers = ['exist-']
+        with patch('odoo.addons.runbot.container._events_watcher', {'watcher': watcher}), \
+                patch('odoo.addons.runbot.container.os.path.exists', side_effect=lambda path: any(marker in path for marker in markers)):
+            self.assertEqual(docker_state('12345-build_server', '/tmp/build'), 'UNKNOWN', 'A container is only running once it wrote its start marker')
+            markers.append('start-')
+            self.assertEqual(docker_state('12345-build_server', '/tmp/build'), 'RUNNING')
+            watcher._process_line(b'{"Action": "oom", "Actor": {"Attributes": {"name": "12345-build_server"}}}')
+            watcher._process_line(b'{"Action": "die", "Actor": {"Attributes": {"name": "12345-build_server", "exitCode": "137"}}}')
+            self.assertTrue(wakeup.is_set())
+            # dead container is detected without waiting, a missing end marker meaning it did not end normally
+            self.assertEqual(docker_state('12345-build_server', '/tmp/build'), 'GHOST')
+            markers.append('end-')
+            self.assertEqual(docker_state('12345-build_server', '/tmp/build'), 'END')
+            self.assertEqual(watcher.pop_events(), [
+                ('12345-build_server', 'start', None),
+                ('12345-build_server', 'oom', None),
+                ('12345-build_server', 'die', '137'),
+            ])
+            self.assertEqual(watcher.pop_events(), [])
+            watcher.forget('12345-build_server')
+            self.assertIsNone(watcher.get_state('12345-build_server'))
+
+    @patch('odoo.addons.runbot.models.runbot.subprocess.call')
+    @patch('odoo.addons.runbot.models.runbot.os.kill')
+    def test_reload_nginx_fingerprint(self, mock_kill, mock_call):
+        for patcher_name in ('reload_nginx', 'makedirs', 'mkdir', 'isfile', 'isdir'):
+            self.stop_patcher(patcher_name)
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.patchers['repo_root_patcher'].return_value = root
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_nginx_includes', True)
+        build = self.Build.create({
+            'params_id': self.base_params.id,
+            'local_state': 'running',
+            'host': 'host.runbot.com',
+            'port': 2000,
+        })
+        nginx_conf_path = os.path.join(root, 'nginx', 'nginx.conf')
+        snippet_path = os.path.join(root, 'nginx', 'builds', '%s.conf' % build.dest)
+
+        with patch.dict(nginx_fingerprints, clear=True):
+            self.Runbot._reload_nginx()
+            self.assertTrue(os.path.exists(nginx_conf_path))
+            with open(snippet_path) as snippet:
+                self.assertIn('proxy_pass http://127.0.0.1:2000;', snippet.read())
+
+            # nothing changed, no render and no file written
+            os.remove(nginx_conf_path)
+            self.Runbot._reload_nginx()
+            self.assertFalse(os.path.exists(nginx_conf_path))
+
+            build.local_state = 'done'
+            self.Runbot._reload_nginx()
+            self.assertTrue(os.path.exists(nginx_conf_path))
+            self.assertFalse(os.path.exists(snippet_path))
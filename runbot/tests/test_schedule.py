@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 import datetime
+import logging
 from unittest.mock import patch
+from odoo.tools import mute_logger
 from .common import RunbotCase
 
+_logger = logging.getLogger(__name__)
+
 
 class TestSchedule(RunbotCase):
 
@@ -35,3 +39,206 @@ class TestSchedule(RunbotCase):
         build._schedule()
         self.assertEqual(build.local_state, 'done')
         self.assertEqual(build.local_result, 'ok')
+
+
+class TestAllocationPolicy(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        self.host = self.env['runbot.host'].create({'name': 'host.runbot.com'})
+        self.Bundle.create({'name': 'master', 'project_id': self.project.id, 'is_base': True})
+        self.bundle_big = self.Bundle.create({'name': 'master-big', 'project_id': self.project.id})
+        self.bundle_small = self.Bundle.create({'name': 'master-small', 'project_id': self.project.id})
+        self.builds_big = self._create_pending_builds(self.bundle_big, 20)
+        self.builds_small = self._create_pending_builds(self.bundle_small, 2)
+
+    def _create_pending_builds(self, bundle, count):
+        batch = self.env['runbot.batch'].create({'bundle_id': bundle.id, 'state': 'ready'})
+        builds = self.Build
+        for _ in range(count):
+            build = self.Build.create({'params_id': self.base_params.id, 'local_state': 'pending'})
+            self.env['runbot.batch.slot'].create({
+                'batch_id': batch.id,
+                'trigger_id': self.trigger_server.id,
+                'params_id': self.base_params.id,
+                'build_id': build.id,
+                'link_type': 'created',
+            })
+            builds |= build
+        return builds
+
+    def _queue_wait(self, policy, slots_per_turn=2):
+        """ Simulate scheduler turns freeing `slots_per_turn` slots and return the number of turns each build waited """
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_allocation_policy', policy)
+        (self.builds_big | self.builds_small).write({'local_state': 'pending', 'host': False})
+        waits = {}
+        turn = 0
+        while len(waits) < len(self.builds_big | self.builds_small):
+            allocated = [build_id for (build_id,) in self.Runbot._allocate_builds(self.host, slots_per_turn)]
+            self.assertTrue(allocated)
+            self.Build.browse(allocated).write({'local_state': 'done'})
+            waits.update(dict.fromkeys(allocated, turn))
+            turn += 1
+        return waits
+
+    def test_fair_allocation_queue_wait(self):
+        fifo_waits = self._queue_wait('fifo')
+        fair_waits = self._queue_wait('fair')
+
+        def mean_wait(waits, builds):
+            return sum(waits[build_id] for build_id in builds.ids) / len(builds)
+
+        for name, builds in (('big', self.builds_big), ('small', self.builds_small)):
+            _logger.info('Mean queue wait of %s bundle: fifo %.2f turns, fair %.2f turns', name, mean_wait(fifo_waits, builds), mean_wait(fair_waits, builds))
+
+        # fifo serves the big bundle first, fair share does not let it starve the small one
+        self.assertGreater(min(fifo_waits[build_id] for build_id in self.builds_small.ids), 1)
+        self.assertEqual(max(fair_waits[build_id] for build_id in self.builds_small.ids), 1)
+        self.assertLess(mean_wait(fair_waits, self.builds_small), mean_wait(fifo_waits, self.builds_small))
+        # builds of a same bundle are still allocated in order
+        big_by_path = self.builds_big.sorted('parent_path')
+        self.assertEqual([fair_waits[build.id] for build in big_by_path], sorted(fair_waits[build.id] for build in big_by_path))
+
+    def test_fair_allocation_null_weights(self):
+        set_param = self.env['ir.config_parameter'].sudo().set_param
+        set_param('runbot.runbot_allocation_sticky_weight', 0)
+        set_param('runbot.runbot_allocation_rebuild_weight', 0)
+        self.bundle_small.sticky = True
+        waits = self._queue_wait('fair')
+        # a null weight is clamped: the sticky bundle is served last instead of failing every turn
+        self.assertEqual(min(waits[build_id] for build_id in self.builds_small.ids), max(waits.values()))
+
+    def test_unknown_allocation_policy(self):
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_allocation_policy', 'unknown')
+        with mute_logger('odoo.addons.runbot.models.runbot'):
+            allocated = self.Runbot._allocate_builds(self.host, 1)
+        self.assertEqual(allocated, [((self.builds_big | self.builds_small).sorted('parent_path')[0].id,)])
+
+
+class TestResourcesAllocation(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        self.host = self.env['runbot.host'].create({'name': 'host.runbot.com', 'cpu_capacity': 4, 'memory_capacity': 8})
+        self.heavy_params = self._create_params('heavy', 3, 4)
+        self.light_params = self._create_params('light', 1, 1)
+
+    def _create_params(self, name, cpu, memory):
+        step = self.Step.create({'name': 'step_%s' % name, 'job_type': 'install_odoo', 'cpu_estimate': cpu, 'memory_estimate': memory})
+        config = self.Config.create({'name': 'config_%s' % name, 'step_order_ids': [(0, 0, {'sequence': 10, 'step_id': step.id})]})
+        return self.BuildParameters.create({
+            'version_id': self.version_13.id,
+            'project_id': self.project.id,
+            'config_id': config.id,
+        })
+
+    def test_step_resources(self):
+        step = self.Step.create({'name': 'step_learn', 'job_type': 'install_odoo'})
+        self.assertEqual(step._get_resources(), (1, 2))  # defaults
+        step._learn_resources(2, 3)
+        self.assertEqual(step._get_resources(), (2, 3))
+        step._learn_resources(4, 3)
+        self.assertAlmostEqual(step.learned_cpu, 2.6)
+        self.assertEqual(self.Step.create({'name': 'step_no_docker', 'job_type': 'create_build'})._get_resources(), (0, 0))
+
+    def test_assign_pending_builds_bin_packing(self):
+        heavy = self.Build.create({'params_id': self.heavy_params.id, 'local_state': 'pending'})
+        lights = self.Build
+        for _ in range(3):
+            lights |= self.Build.create({'params_id': self.light_params.id, 'local_state': 'pending'})
+
+        self.Runbot._assign_pending_builds(self.host, self.host.nb_worker)
+        allocated = self.Build.search([('host', '=', self.host.name)])
+        self.assertEqual(allocated, heavy | lights[0])
+        self.assertEqual(self.host._free_resources(allocated), (0, 3))
+
+        self.assertEqual(self.Runbot._get_builds_to_init(self.host), heavy | lights[0])
+        heavy.local_state = 'testing'
+        lights[0].local_state = 'done'
+        self.assertFalse(self.Runbot._get_builds_to_init(self.host))
+
+    def test_oversized_build(self):
+        testing = self.Build.create({'params_id': self.light_params.id, 'local_state': 'testing', 'host': self.host.name})
+        big_params = self._create_params('big', 8, 4)
+        big = self.Build.create({'params_id': big_params.id, 'local_state': 'pending'})
+        light = self.Build.create({'params_id': self.light_params.id, 'local_state': 'pending'})
+        self.Runbot._assign_pending_builds(self.host, self.host.nb_worker)
+        # an oversized build is not blocking the queue
+        self.assertEqual(light.host, self.host.name)
+        self.assertFalse(big.host)
+        (testing | light).write({'local_state': 'done'})
+        self.Runbot._assign_pending_builds(self.host, self.host.nb_worker)
+        # but runs alone once the host is empty
+        self.assertEqual(big.host, self.host.name)
+
+
+class TestBuildDuration(RunbotCase):
+
+    def setUp(self):
+        super().setUp()
+        self.Duration = self.env['runbot.build.duration']
+        self.host = self.env['runbot.host'].create({'name': 'host.runbot.com', 'nb_worker': 1})
+        self.step_tests = self.Step.create({'name': 'tests', 'job_type': 'install_odoo'})
+        self.step_install = self.Step.create({'name': 'install', 'job_type': 'install_odoo'})
+        self.child_config = self.Config.create({'name': 'child', 'step_order_ids': [(0, 0, {'sequence': 10, 'step_id': self.step_tests.id})]})
+        self.step_create = self.Step.create({'name': 'create', 'job_type': 'create_build', 'create_config_ids': [(4, self.child_config.id)]})
+        self.parent_config = self.Config.create({'name': 'parent', 'step_order_ids': [
+            (0, 0, {'sequence': 10, 'step_id': self.step_create.id}),
+            (0, 0, {'sequence': 20, 'step_id': self.step_install.id}),
+        ]})
+        self.child_params = self._create_params(self.child_config)
+        self.parent_params = self._create_params(self.parent_config)
+
+    def _create_params(self, config):
+        return self.BuildParameters.create({
+            'version_id': self.version_13.id,
+            'project_id': self.project.id,
+            'config_id': config.id,
+        })
+
+    def _learn_durations(self):
+        child = self.Build.create({'params_id': self.child_params.id, 'local_state': 'done'})
+        parent = self.Build.create({'params_id': self.parent_params.id, 'local_state': 'done'})
+        self.Duration._learn(child, self.step_tests, 100)
+        self.Duration._learn(child, self.step_tests, 200)
+        self.Duration._learn(parent, self.step_create, 10)
+        self.Duration._learn(parent, self.step_install, 50)
+
+    def test_predict(self):
+        self.assertEqual(self.Duration._predict(self.Build.trigger_id, self.parent_config, self.version_13), 0)
+        self._learn_durations()
+        self.assertAlmostEqual(self.Duration.search([('step_id', '=', self.step_tests.id)]).duration, 130)
+        # the children created by the first step are on the critical path
+        self.assertAlmostEqual(self.Duration._predict(self.Build.trigger_id, self.parent_config, self.version_13), 140)
+        self.assertEqual(self.Build.create({'params_id': self.parent_params.id}).predicted_duration, 140)
+
+        # a config creating builds of itself does not recurse without end
+        self.step_create.create_config_ids |= self.parent_config
+        self.assertAlmostEqual(self.Duration._predict(self.Build.trigger_id, self.parent_config, self.version_13), 140)
+
+    def test_critical_path_order(self):
+        self._learn_durations()
+        bundle = self.Bundle.create({'name': 'master', 'project_id': self.project.id, 'is_base': True})
+        batch = self.env['runbot.batch'].create({'bundle_id': bundle.id, 'state': 'ready'})
+        builds = self.Build
+        for params in (self.child_params, self.parent_params):
+            build = self.Build.create({'params_id': params.id, 'local_state': 'pending'})
+            self.env['runbot.batch.slot'].create({
+                'batch_id': batch.id,
+                'trigger_id': self.trigger_server.id,
+                'params_id': params.id,
+                'build_id': build.id,
+                'link_type': 'created',
+            })
+            builds |= build
+        short_build, long_build = builds
+        self.assertEqual(batch.predicted_remaining, 140)
+
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_allocation_policy', 'critical_path')
+        self.assertEqual(self.Runbot._get_allocation_candidates(limit=2), [long_build.id, short_build.id])
+        builds.write({'host': self.host.name})
+        self.assertEqual(self.Runbot._get_builds_to_init(self.host), long_build)
+
+        self.env['ir.config_parameter'].sudo().set_param('runbot.runbot_allocation_policy', 'fifo')
+        builds.write({'host': False})
+        self.assertEqual(self.Runbot._get_allocation_candidates(limit=2), [short_build.id, long_build.id])
@@ -7,8 +7,14 @@ _logger = logging.getLogger(__name__)
 class BuilderClient(RunbotClient):
 
     def on_start(self):
+        from odoo.addons.runbot.container import start_docker_events_watcher
+        start_docker_events_watcher(self.wakeup)
         self.env['runbot.repo'].search([('mode', '!=', 'disabled')])._update()
 
+    def on_stop(self):
+        from odoo.addons.runbot.container import stop_docker_events_watcher
+        stop_docker_events_watcher()
+
     def loop_turn(self):
         if self.count == 1: # cleanup at second iteration
             self.env['runbot.runbot']._source_cleanup()
@@ -16,7 +22,14 @@ class BuilderClient(RunbotClient):
             self.env['runbot.runbot']._docker_cleanup()
             self.host.set_psql_conn_count()
             self.host._docker_build()
-        return self.env['runbot.runbot']._scheduler_loop_turn(self.host)
+        sleep_time = self.env['runbot.runbot']._scheduler_loop_turn(self.host)
+        if self.listener and not self.host.nb_testing:
+            # nothing to monitor, new work will be notified
+            return self.idle_sleep()
+        return sleep_time
+
+    def notification_channels(self):
+        return self.env['runbot.runbot']._notification_channels(self.host, builder=True)
 
 
 if __name__ == '__main__':
@@ -1,6 +1,7 @@
 #!/usr/bin/python3
 import argparse
 import contextlib
+import json
 import logging
 import psycopg2
 import os
@@ -19,6 +20,7 @@ logging.addLevelName(25, "!NFO")
 _logger = logging.getLogger(__name__)
 
 DBRE = r'^(?P<build_id>\d+)-.+-[0-9a-f]{6}-?(?P<db_suffix>.*)$'
+MANIFEST_SUFFIX = '.manifest.json'  # directory format dumps, see runbot.models.build_config
 
 
 @contextlib.contextmanager
@@ -51,6 +53,83 @@ def _local_pg_rename_db(dbname, new_db_name):
         local_cr.execute("ALTER DATABASE \"%s\" RENAME TO \"%s\";" % (dbname, new_db_name))
 
 
+def _rename_checksums(checksums, renamed):
+    """ Key the sha256 checksums of dump files by their new names, dropping the files not renamed """
+    return {renamed[file_name]: checksum for file_name, checksum in checksums.items() if file_name in renamed}
+
+
+def rename_dumps(logs_path, origin_dest, dest, dry_run=False):
+    """ Rename the dumps published in logs_path by a build moved from origin_dest to dest.
+    Zip dumps are single files, directory dumps are renamed with the files listed in their manifest,
+    the missing ones being dropped from it. The checksums published with the dumps are rewritten for
+    the new file names.
+    """
+    if not os.path.isdir(logs_path):
+        return
+    prefix = '%s-' % origin_dest
+    for file_name in sorted(os.listdir(logs_path)):
+        if not file_name.startswith(prefix):
+            continue
+        new_file_name = dest + file_name[len(origin_dest):]
+        file_path = os.path.join(logs_path, file_name)
+        if file_name.endswith('.zip'):
+            _logger.info('Renaming dump "%s" --> "%s"', file_name, new_file_name)
+            if not dry_run:
+                os.rename(file_path, os.path.join(logs_path, new_file_name))
+        elif file_name.endswith('.sha256'):
+            # sha256sum output, "<checksum>  <file name>" lines
+            _logger.info('Renaming checksums "%s" --> "%s"', file_name, new_file_name)
+            if dry_run:
+                continue
+            with open(file_path) as checksums_file:
+                lines = checksums_file.read().splitlines()
+            with open(os.path.join(logs_path, new_file_name), 'w') as checksums_file:
+                for line in lines:
+                    match = re.match(r'^(\S+\s+\*?)(.*)$', line)
+                    if match and match.group(2).startswith(prefix):
+                        line = match.group(1) + dest + match.group(2)[len(origin_dest):]
+                    checksums_file.write(line + '\n')
+            os.remove(file_path)
+        elif file_name.endswith('.info.json'):
+            # infos of a zip dump, published next to it
+            _logger.info('Renaming dump infos "%s" --> "%s"', file_name, new_file_name)
+            if dry_run:
+                continue
+            with open(file_path) as infos_file:
+                infos = json.load(infos_file)
+            if infos.get('db_name', '').startswith(origin_dest):
+                infos['db_name'] = dest + infos['db_name'][len(origin_dest):]
+            renamed = {name: dest + name[len(origin_dest):] if name.startswith(prefix) else name for name in infos.get('sha256', {})}
+            infos['sha256'] = _rename_checksums(infos.get('sha256', {}), renamed)
+            with open(os.path.join(logs_path, new_file_name), 'w') as infos_file:
+                json.dump(infos, infos_file, indent=4)
+            os.remove(file_path)
+        elif file_name.endswith(MANIFEST_SUFFIX):
+            with open(file_path) as manifest_file:
+                manifest = json.load(manifest_file)
+            db_name = manifest['db_name']
+            new_db_name = dest + db_name[len(origin_dest):]
+            files = {}
+            renamed = {}
+            for key, dump_file_name in manifest.get('files', {}).items():
+                if not os.path.isfile(os.path.join(logs_path, dump_file_name)):
+                    _logger.warning('Dump "%s" listed in manifest "%s" not found, skipping', dump_file_name, file_name)
+                    continue
+                files[key] = renamed[dump_file_name] = new_db_name + dump_file_name[len(db_name):]
+                _logger.info('Renaming dump "%s" --> "%s"', dump_file_name, files[key])
+                if not dry_run:
+                    os.rename(os.path.join(logs_path, dump_file_name), os.path.join(logs_path, files[key]))
+            _logger.info('Renaming manifest "%s" --> "%s"', file_name, new_file_name)
+            if dry_run:
+                continue
+            manifest.update(db_name=new_db_name, files=files)
+            if 'sha256' in manifest:
+                manifest['sha256'] = _rename_checksums(manifest['sha256'], renamed)
+            with open(os.path.join(logs_path, new_file_name), 'w') as manifest_file:
+                json.dump(manifest, manifest_file, indent=4)
+            os.remove(file_path)
+
+
 class RunbotClient():
 
     def __init__(self, env):
@@ -82,6 +161,7 @@ class RunbotClient():
                 _logger.info('Skip moving %s, already moved', build.dest)
                 continue
             _logger.info('Moving "%s" --> "%s"', origin_dir, build.dest)
+            rename_dumps(os.path.join(origin_path, 'logs'), origin_dir, build.dest, args.dry_run)
             if args.dry_run:
                 continue
             dest_path = os.path.join(builds_root, build.dest)
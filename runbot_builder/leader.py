@@ -11,7 +11,14 @@ class LeaderClient(RunbotClient):  # Conductor, Director, Main, Maestro, Lead
         super().__init__(env)
 
     def loop_turn(self):
-        return self.env['runbot.runbot']._fetch_loop_turn(self.host, self.pull_info_failures)
+        sleep_time = self.env['runbot.runbot']._fetch_loop_turn(self.host, self.pull_info_failures)
+        if self.listener and not self.env['runbot.batch'].search_count([('state', 'in', ('preparing', 'ready'))]):
+            # nothing to process, new batches and hooks will be notified
+            return self.idle_sleep()
+        return sleep_time
+
+    def notification_channels(self):
+        return self.env['runbot.runbot']._notification_channels(self.host, leader=True)
 
 
 if __name__ == '__main__':
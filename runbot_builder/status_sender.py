@@ -0,0 +1,26 @@
+#!/usr/bin/python3
+from tools import RunbotClient, run
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+class StatusSenderClient(RunbotClient):
+    """ Drain the github statuses queued when runbot.runbot_status_queue is set """
+
+    def loop_turn(self):
+        limit = 100
+        sent = self.env['runbot.commit.status']._send_queued(limit=limit)
+        if sent >= limit:
+            return 0
+        if self.listener:
+            # new statuses will be notified
+            return self.idle_sleep()
+        return 1
+
+    def notification_channels(self):
+        return ['runbot_status']
+
+
+if __name__ == '__main__':
+    run(StatusSenderClient)
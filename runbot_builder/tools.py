@@ -21,13 +21,18 @@ class RunbotClient():
     def __init__(self, env):
         self.env = env
         self.ask_interrupt = threading.Event()
+        self.wakeup = threading.Event()
         self.host = None
         self.count = 0
         self.max_count = 60
+        self.listener = None
 
     def on_start(self):
         pass
 
+    def on_stop(self):
+        pass
+
     def main_loop(self):
         from odoo import fields
         self.on_start()
@@ -43,6 +48,9 @@ class RunbotClient():
             os.getpid(),
             ' (assigned only)' if self.host.assigned_only else ''
         )
+        self.listener = self.env['runbot.runbot']._get_listener(self.notification_channels())
+        if self.listener:
+            _logger.info('Listening on %s', ', '.join(self.listener.channels))
         while True:
             try:
                 self.host.last_start_loop = fields.Datetime.now()
@@ -59,11 +67,22 @@ class RunbotClient():
                 self.env.clear()
                 self.sleep(10)
             if self.ask_interrupt.is_set():
+                if self.listener:
+                    self.listener.close()
+                self.on_stop()
                 return
 
     def loop_turn(self):
         raise NotImplementedError()
 
+    def notification_channels(self):
+        """ Channels that should interrupt the sleep between two turns """
+        return []
+
+    def idle_sleep(self):
+        """ Sleep used when nothing is expected to happen unless notified """
+        return int(self.env['ir.config_parameter'].sudo().get_param('runbot.runbot_update_frequency', default=10))
+
     def signal_handler(self, _signal, _frame):
         if self.ask_interrupt.is_set():
             _logger.info("Second Interrupt detected, force exit")
@@ -71,13 +90,18 @@ class RunbotClient():
 
         _logger.info("Interrupt detected")
         self.ask_interrupt.set()
+        self.wakeup.set()
 
     def dump_stack(self, _signal, _frame):
         import odoo
         odoo.tools.misc.dumpstacks()
 
     def sleep(self, t):
-        self.ask_interrupt.wait(t)
+        if self.listener:
+            self.listener.wait(t, self.wakeup)
+        else:
+            self.wakeup.wait(t)
+        self.wakeup.clear()
 
 
 def run(client_class):
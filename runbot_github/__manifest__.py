@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+{
+    'name': "runbot github",
+    'summary': "Github client shared by runbot and the merge bot",
+    'description': "Pooled github sessions, with the rate limits and cached responses of each token shared between the processes",
+    'author': "Odoo SA",
+    'website': "http://runbot.odoo.com",
+    'category': 'Website',
+    'version': '1.0',
+    'depends': ['base'],
+    'data': [
+        'security/ir.model.access.csv',
+    ],
+    'license': 'LGPL-3',
+}
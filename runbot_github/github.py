@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""Github http client shared by runbot (remotes, status sender) and the merge bot.
+
+Sessions are pooled by (api host, token). The rate limit budget of each token
+is kept in memory and synchronised every FLUSH_INTERVAL seconds with the
+runbot.github.rate.limit table, so that all the processes working on the same
+database share it without a query per request: requests wait for the reset
+once the budget is exhausted and back off when github asks to (secondary rate
+limits, Retry-After). The same table keeps the request count, latency and
+cache hits of each token.
+
+GET responses carrying an ETag or Last-Modified header can be cached and
+revalidated with conditional requests, github answering 304 without counting
+them in the rate limit. The most recently used responses are kept in memory,
+the runbot.github.response table sharing them between the processes: it is only
+queried on a memory miss and written during the synchronisation.
+"""
+import collections
+import hashlib
+import json
+import logging
+import threading
+import time
+
+import psycopg2
+import requests
+
+from requests.adapters import HTTPAdapter
+
+from odoo import sql_db
+
+_logger = logging.getLogger(__name__)
+
+POOL_SIZE = 10
+DEFAULT_TIMEOUT = 60
+MAX_WAIT = 60  # never sleep longer than this before a request, in seconds
+CACHE_SIZE = 10000  # number of responses kept by the response cache
+MEMORY_CACHE_SIZE = 500  # number of responses kept in memory when the cache is in the database
+FLUSH_INTERVAL = 10  # seconds between two synchronisations of the state of a process with its database
+COUNTERS = ('request_count', 'total_latency', 'max_latency', 'cache_hits', 'cache_misses')
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+# shared state by dbname, None for the clients without database
+_states = {}
+_states_lock = threading.Lock()
+
+
+def token_key(token):
+    """ Key identifying a token without storing it """
+    return hashlib.sha256((token or '').encode()).hexdigest()[:16]
+
+
+def get_session(host, token):
+    """ Keep-alive session shared by all the clients of a host and token """
+    with _sessions_lock:
+        session = _sessions.get((host, token))
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=POOL_SIZE)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            if token:
+                session.headers['Authorization'] = 'token %s' % token
+            _sessions[(host, token)] = session
+        return session
+
+
+def _state(dbname):
+    with _states_lock:
+        state = _states.get(dbname)
+        if state is None:
+            state = _states[dbname] = SharedState(dbname)
+        return state
+
+
+class SharedState(object):
+    """ Rate limits, counters and cached responses of the tokens used by a
+    process. When dbname is given, the counters and the new responses are
+    flushed and the limits exchanged with the other processes every
+    FLUSH_INTERVAL seconds, in a single transaction.
+    """
+
+    def __init__(self, dbname=None):
+        self.dbname = dbname
+        self.lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.limits = {}  # token key: {'remaining', 'rate_limit', 'reset_at', 'retry_at'}
+        self.counters = {}  # token key: counters not flushed yet, all of them without database
+        self.responses = collections.OrderedDict()  # (token key, url): (etag, last_modified, headers, body), most recently used last
+        self.cache_size = CACHE_SIZE
+        self.stored = {}  # (token key, url): (response, last_used) not flushed yet
+        self.used = {}  # (token key, url): last_used not flushed yet
+        self.missing = set()  # (token key, url) not found in the database since the last synchronisation
+        self.synced_at = 0
+
+    def sync(self, force=False):
+        now = time.time()
+        if not self.dbname or (not force and now - self.synced_at < FLUSH_INTERVAL):
+            return
+        if not self.sync_lock.acquire(blocking=False):
+            return  # another thread is synchronising
+        try:
+            with self.lock:
+                self.synced_at = now
+                counters, self.counters = self.counters, {}
+                limits = {key: dict(self.limits.get(key, {})) for key in counters}
+                stored, self.stored = self.stored, {}
+                used, self.used = self.used, {}
+                self.missing.clear()
+            try:
+                with sql_db.db_connect(self.dbname).cursor() as cr:
+                    self._flush_limits(cr, counters, limits)
+                    self._flush_responses(cr, stored, used)
+                    cr.execute("SELECT token_key, remaining, rate_limit, reset_at, retry_at FROM runbot_github_rate_limit")
+                    rows = cr.fetchall()
+            except psycopg2.Error as e:
+                _logger.warning('Could not synchronise github rate limits: %s', e)
+                return
+            with self.lock:
+                for key, remaining, rate_limit, reset_at, retry_at in rows:
+                    if key not in self.counters:  # not used by this process since the flush
+                        self.limits[key] = dict(remaining=remaining, rate_limit=rate_limit, reset_at=reset_at, retry_at=retry_at)
+        finally:
+            self.sync_lock.release()
+
+    def _flush_limits(self, cr, counters, limits):
+        for key in sorted(counters):  # same order in all processes
+            limit = limits[key]
+            cr.execute("""
+                INSERT INTO runbot_github_rate_limit (token_key, remaining, rate_limit, reset_at, retry_at, request_count, total_latency, max_latency, cache_hits, cache_misses, updated_at)
+                VALUES (%(key)s, %(remaining)s, %(rate_limit)s, %(reset_at)s, %(retry_at)s, %(request_count)s, %(total_latency)s, %(max_latency)s, %(cache_hits)s, %(cache_misses)s, now() at time zone 'UTC')
+                ON CONFLICT (token_key) DO UPDATE SET
+                    remaining = COALESCE(EXCLUDED.remaining, runbot_github_rate_limit.remaining),
+                    rate_limit = COALESCE(EXCLUDED.rate_limit, runbot_github_rate_limit.rate_limit),
+                    reset_at = COALESCE(EXCLUDED.reset_at, runbot_github_rate_limit.reset_at),
+                    retry_at = EXCLUDED.retry_at,
+                    request_count = COALESCE(runbot_github_rate_limit.request_count, 0) + EXCLUDED.request_count,
+                    total_latency = COALESCE(runbot_github_rate_limit.total_latency, 0) + EXCLUDED.total_latency,
+                    max_latency = GREATEST(runbot_github_rate_limit.max_latency, EXCLUDED.max_latency),
+                    cache_hits = COALESCE(runbot_github_rate_limit.cache_hits, 0) + EXCLUDED.cache_hits,
+                    cache_misses = COALESCE(runbot_github_rate_limit.cache_misses, 0) + EXCLUDED.cache_misses,
+                    updated_at = EXCLUDED.updated_at
+            """, dict(counters[key], key=key, remaining=limit.get('remaining'), rate_limit=limit.get('rate_limit'), reset_at=limit.get('reset_at'), retry_at=limit.get('retry_at')))
+
+    def _flush_responses(self, cr, stored, used):
+        for (key, url), (response, last_used) in sorted(stored.items()):
+            etag, last_modified, headers, body = response
+            cr.execute("""
+                INSERT INTO runbot_github_response (token_key, url, etag, last_modified, headers, body, last_used)
+                VALUES (%s, %s, %s, %s, %s, %s, %s)
+                ON CONFLICT (token_key, url) DO UPDATE SET
+                    etag = EXCLUDED.etag,
+                    last_modified = EXCLUDED.last_modified,
+                    headers = EXCLUDED.headers,
+                    body = EXCLUDED.body,
+                    last_used = GREATEST(runbot_github_response.last_used, EXCLUDED.last_used)
+            """, [key, url, etag, last_modified, json.dumps(headers), psycopg2.Binary(body), last_used])
+        used = {entry: last_used for entry, last_used in used.items() if entry not in stored}
+        if used:
+            keys, urls, last_useds = zip(*((key, url, last_used) for (key, url), last_used in sorted(used.items())))
+            cr.execute("""
+                UPDATE runbot_github_response r SET last_used = GREATEST(r.last_used, u.last_used)
+                FROM unnest(%s, %s, %s) AS u(token_key, url, last_used)
+                WHERE r.token_key = u.token_key AND r.url = u.url
+            """, [list(keys), list(urls), list(last_useds)])
+        if stored:
+            # remove the least recently used responses above the cache size
+            cr.execute("""
+                DELETE FROM runbot_github_response
+                WHERE last_used < (
+                    SELECT last_used FROM runbot_github_response ORDER BY last_used DESC OFFSET %s LIMIT 1
+                )
+            """, [self.cache_size - 1])
+
+
+def _int_header(response, name):
+    try:
+        return int(response.headers[name])
+    except (KeyError, ValueError):
+        return None
+
+
+class RateLimits(object):
+    """ Rate limit state of the tokens, shared with the other processes of dbname if given """
+
+    def __init__(self, dbname=None):
+        self.state = _state(dbname)
+
+    def get(self, key):
+        """ Return the (remaining, reset_at, retry_at) known for key """
+        self.state.sync()
+        with self.state.lock:
+            limit = self.state.limits.get(key, {})
+        return limit.get('remaining'), limit.get('reset_at'), limit.get('retry_at')
+
+    def wait_time(self, key, now=None):
+        """ Seconds to wait before sending a request with key """
+        now = now or time.time()
+        remaining, reset_at, retry_at = self.get(key)
+        wait = 0
+        if remaining == 0 and reset_at:
+            wait = reset_at - now
+        if retry_at:
+            wait = max(wait, retry_at - now)
+        return max(wait, 0)
+
+    def record(self, key, response, latency, cache_hit=None, now=None):
+        """ Store the budget returned by github, the latency of the request and
+        whether the response cache was hit (None if the request was not cacheable)
+        """
+        now = now or time.time()
+        remaining = _int_header(response, 'X-RateLimit-Remaining')
+        limit = _int_header(response, 'X-RateLimit-Limit')
+        reset_at = _int_header(response, 'X-RateLimit-Reset')
+        retry_after = _int_header(response, 'Retry-After')
+        with self.state.lock:
+            state = self.state.limits.setdefault(key, {})
+            if remaining is not None:
+                state.update(remaining=remaining, rate_limit=limit, reset_at=reset_at)
+            state['retry_at'] = now + retry_after if retry_after else None
+            counters = self.state.counters.setdefault(key, dict.fromkeys(COUNTERS, 0))
+            counters['request_count'] += 1
+            counters['total_latency'] += latency
+            counters['max_latency'] = max(counters['max_latency'], latency)
+            counters['cache_hits'] += int(cache_hit is True)
+            counters['cache_misses'] += int(cache_hit is False)
+        self.state.sync()
+
+
+class ResponseCache(object):
+    """ LRU cache of the GET responses by token and url, shared with the other processes of dbname if given.
+    The size is shared by all the caches of dbname, the last size given is kept.
+    """
+
+    def __init__(self, dbname=None, size=None):
+        self.dbname = dbname
+        self.state = _state(dbname)
+        if size:
+            self.state.cache_size = size
+        self.size = self.state.cache_size
+        self.memory_size = min(self.size, MEMORY_CACHE_SIZE) if dbname else self.size
+
+    def get(self, key, url):
+        """ Return the (etag, last_modified, headers, body) cached for url, None if unknown """
+        self.state.sync()
+        with self.state.lock:
+            entry = self.state.responses.get((key, url))
+            if entry:
+                self.state.responses.move_to_end((key, url))
+                if self.dbname:
+                    self.state.used[(key, url)] = time.time()
+                return entry
+            if not self.dbname or (key, url) in self.state.missing:
+                return None
+        try:
+            with sql_db.db_connect(self.dbname).cursor() as cr:
+                cr.execute("""
+                    SELECT etag, last_modified, headers, body FROM runbot_github_response
+                    WHERE token_key = %s AND url = %s
+                """, [key, url])
+                row = cr.fetchone()
+        except psycopg2.Error as e:
+            _logger.warning('Could not read cached github response: %s', e)
+            return None
+        with self.state.lock:
+            if not row:
+                self.state.missing.add((key, url))
+                return None
+            etag, last_modified, headers, body = row
+            entry = (etag, last_modified, json.loads(headers or '{}'), bytes(body or b''))
+            self._remember(key, url, entry)
+            self.state.used[(key, url)] = time.time()
+        return entry
+
+    def store(self, key, url, response):
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not etag and not last_modified:
+            return
+        headers = {name: value for name, value in response.headers.items() if name.lower() in ('content-type', 'link', 'etag', 'last-modified')}
+        entry = (etag, last_modified, headers, response.content)
+        with self.state.lock:
+            self._remember(key, url, entry)
+            if self.dbname:
+                self.state.stored[(key, url)] = (entry, time.time())
+                self.state.missing.discard((key, url))
+
+    def _remember(self, key, url, entry):
+        """ Keep entry in memory, evicting the least recently used ones. Called with the state lock """
+        responses = self.state.responses
+        responses[(key, url)] = entry
+        responses.move_to_end((key, url))
+        while len(responses) > self.memory_size:
+            responses.popitem(last=False)
+
+
+def metrics(cr=None):
+    """ Remaining budget, latency and cache hit rate of each token, from the database of cr or from memory """
+    columns = ['token_key', 'remaining', 'rate_limit', 'reset_at'] + list(COUNTERS)
+    if cr is None:
+        state = _state(None)
+        with state.lock:
+            rows = [dict(state.limits.get(key, {}), token_key=key, **counters) for key, counters in state.counters.items()]
+        rows = [{column: row.get(column) for column in columns} for row in rows]
+    else:
+        cr.execute("SELECT %s FROM runbot_github_rate_limit ORDER BY token_key" % ', '.join(columns))
+        rows = cr.dictfetchall()
+    for row in rows:
+        row['mean_latency'] = row['total_latency'] / row['request_count'] if row['request_count'] else 0
+        cache_requests = row['cache_hits'] + row['cache_misses']
+        row['cache_hit_rate'] = row['cache_hits'] / cache_requests if cache_requests else 0
+    return rows
+
+
+class GithubClient(object):
+    """ Send requests to a github api host with a token, waiting and retrying according to the rate limits """
+
+    def __init__(self, token, host='api.github.com', dbname=None, max_tries=3, max_wait=MAX_WAIT, timeout=DEFAULT_TIMEOUT, cache=False, cache_size=None):
+        self.token = token
+        self.host = host
+        self.key = token_key(token)
+        self.session = get_session(host, token)
+        self.limits = RateLimits(dbname)
+        self.cache = ResponseCache(dbname, cache_size) if cache else None
+        self.max_tries = max_tries
+        self.max_wait = max_wait
+        self.timeout = timeout
+
+    def url(self, path):
+        return 'https://%s/%s' % (self.host, path.lstrip('/'))
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        cache_url = cached = None
+        if self.cache and method.upper() == 'GET':
+            cache_url = requests.Request('GET', url, params=kwargs.get('params')).prepare().url
+            cached = self.cache.get(self.key, cache_url)
+            if cached:
+                etag, last_modified, _, _ = cached
+                headers = kwargs['headers'] = dict(kwargs.get('headers') or {})
+                if etag:
+                    headers['If-None-Match'] = etag
+                if last_modified:
+                    headers['If-Modified-Since'] = last_modified
+        for try_count in range(1, self.max_tries + 1):
+            wait = min(self.limits.wait_time(self.key), self.max_wait)
+            if wait:
+                _logger.info('Waiting %.1fs for github rate limit of %s', wait, self.host)
+                time.sleep(wait)
+            start = time.time()
+            response = self.session.request(method, url, **kwargs)
+            cache_hit = None
+            if cache_url:
+                cache_hit = bool(cached) and response.status_code == 304
+            self.limits.record(self.key, response, time.time() - start, cache_hit=cache_hit)
+            delay = self._backoff_delay(response, try_count)
+            if delay is None or try_count == self.max_tries:
+                if cache_hit:
+                    return self._replay(response, cached)
+                if cache_url and response.status_code == 200:
+                    self.cache.store(self.key, cache_url, response)
+                return response
+            _logger.warning('Github rate limit reached on %s %s (try %s/%s), retrying in %ss', method, url, try_count, self.max_tries, delay)
+            time.sleep(delay)
+
+    def _replay(self, response, cached):
+        """ Turn a 304 response into the cached 200 response """
+        _, _, headers, body = cached
+        response.status_code = 200
+        response.reason = 'OK'
+        response.headers.update(headers)
+        response._content = body
+        return response
+
+    def _backoff_delay(self, response, try_count):
+        """ Seconds to wait before retrying a rate limited request, None if the request was not limited """
+        if response.status_code not in (403, 429):
+            return None
+        retry_after = _int_header(response, 'Retry-After')
+        if retry_after:
+            return min(retry_after, self.max_wait)
+        if _int_header(response, 'X-RateLimit-Remaining') == 0:
+            reset_at = _int_header(response, 'X-RateLimit-Reset') or time.time()
+            return min(max(reset_at - time.time(), 1), self.max_wait)
+        if response.status_code == 429 or 'rate limit' in response.text.lower():
+            # secondary rate limit without Retry-After, exponential backoff
+            return min(2 ** try_count * 5, self.max_wait)
+        return None
@@ -0,0 +1,45 @@
+from odoo import models, fields
+
+
+class GithubRateLimit(models.Model):
+    _name = 'runbot.github.rate.limit'
+    _description = "Github rate limit"
+    _log_access = False
+    _rec_name = 'token_key'
+
+    # written by the github client of each process, see github.py
+    token_key = fields.Char('Token key', required=True, readonly=True, help="Hash identifying the token")
+    remaining = fields.Integer('Remaining requests', readonly=True)
+    rate_limit = fields.Integer('Rate limit', readonly=True)
+    reset_at = fields.Float('Reset time', readonly=True, help="Timestamp of the reset of the budget")
+    retry_at = fields.Float('Retry time', readonly=True, help="Timestamp before which github asked not to send requests")
+    request_count = fields.Integer('Requests', readonly=True)
+    total_latency = fields.Float('Total latency (s)', readonly=True)
+    max_latency = fields.Float('Max latency (s)', readonly=True)
+    cache_hits = fields.Integer('Cache hits', readonly=True)
+    cache_misses = fields.Integer('Cache misses', readonly=True)
+    updated_at = fields.Datetime('Last update', readonly=True)
+
+    _sql_constraints = [
+        ('token_key_unique', 'unique (token_key)', 'A token has a single rate limit'),
+    ]
+
+
+class GithubResponse(models.Model):
+    _name = 'runbot.github.response'
+    _description = "Github cached response"
+    _log_access = False
+    _rec_name = 'url'
+
+    # written by the github client of each process, see github.py
+    token_key = fields.Char('Token key', required=True, readonly=True, help="Hash identifying the token")
+    url = fields.Char('Url', required=True, readonly=True)
+    etag = fields.Char('ETag', readonly=True)
+    last_modified = fields.Char('Last modified', readonly=True)
+    headers = fields.Text('Headers', readonly=True, help="Json encoded headers replayed with the response")
+    body = fields.Binary('Body', attachment=False, readonly=True)
+    last_used = fields.Float('Last use', readonly=True, index=True)
+
+    _sql_constraints = [
+        ('token_key_url_unique', 'unique (token_key, url)', 'A response is cached once by token and url'),
+    ]
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+import time
+
+import requests
+
+from unittest.mock import patch
+
+from odoo import sql_db
+from odoo.tests.common import TransactionCase
+
+from ..github import GithubClient, RateLimits, ResponseCache, metrics, token_key
+
+
+def _response(status_code=200, headers=None, content=b'{}'):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers.update(headers or {})
+    response._content = content
+    return response
+
+
+class TestGithubClient(TransactionCase):
+
+    def setUp(self):
+        super().setUp()
+        states_patcher = patch.dict('odoo.addons.runbot_github.github._states', clear=True)
+        states_patcher.start()
+        self.addCleanup(states_patcher.stop)
+        self.client = GithubClient('test_token_%s' % time.time(), max_wait=30)
+        # sleeping advances a fake clock
+        clock = [time.time()]
+        time_patcher = patch('odoo.addons.runbot_github.github.time.time', side_effect=lambda: clock[0])
+        time_patcher.start()
+        self.addCleanup(time_patcher.stop)
+        sleep_patcher = patch('odoo.addons.runbot_github.github.time.sleep', side_effect=lambda seconds: clock.__setitem__(0, clock[0] + seconds))
+        self.sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def test_secondary_rate_limit(self):
+        responses = [
+            _response(403, {'Retry-After': '3'}, b'{"message": "You have exceeded a secondary rate limit"}'),
+            _response(200, {'X-RateLimit-Remaining': '4999', 'X-RateLimit-Limit': '5000', 'X-RateLimit-Reset': '0'}),
+        ]
+        with patch.object(self.client.session, 'request', side_effect=responses) as mock_request:
+            response = self.client.request('GET', self.client.url('/repos/odoo/odoo'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(mock_request.call_args[0], ('GET', 'https://api.github.com/repos/odoo/odoo'))
+        self.sleep.assert_called_once_with(3)
+
+        token_metrics, = [row for row in metrics() if row['token_key'] == self.client.key]
+        self.assertEqual(token_metrics['remaining'], 4999)
+        self.assertEqual(token_metrics['request_count'], 2)
+
+    def test_exhausted_budget(self):
+        reset_at = int(time.time()) + 20
+        with patch.object(self.client.session, 'request', return_value=_response(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset_at)})):
+            self.client.request('GET', self.client.url('/user'))
+            self.sleep.assert_not_called()
+            # next request waits for the reset
+            self.client.request('GET', self.client.url('/user'))
+        self.sleep.assert_called_once()
+        self.assertAlmostEqual(self.sleep.call_args[0][0], 20, delta=2)
+
+    def test_response_cache(self):
+        client = GithubClient(self.client.token, cache=True)
+        url = client.url('/repos/odoo/odoo/pulls/1')
+        responses = [
+            _response(200, {'ETag': '"abc"', 'Content-Type': 'application/json'}, b'{"number": 1}'),
+            _response(304, {'ETag': '"abc"'}, b''),
+        ]
+        with patch.object(client.session, 'request', side_effect=responses) as mock_request:
+            self.assertEqual(client.request('GET', url).json(), {'number': 1})
+            response = client.request('GET', url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'number': 1})
+        self.assertEqual(mock_request.call_args[1]['headers']['If-None-Match'], '"abc"')
+
+        token_metrics, = [row for row in metrics() if row['token_key'] == client.key]
+        self.assertEqual((token_metrics['cache_hits'], token_metrics['cache_misses']), (1, 1))
+        self.assertEqual(token_metrics['cache_hit_rate'], 0.5)
+
+    def test_response_cache_lru(self):
+        cache = ResponseCache(size=2)
+        urls = ['https://api.github.com/test_lru/%s' % i for i in range(3)]
+        for url in urls[:2]:
+            cache.store('key', url, _response(200, {'ETag': url}))
+        cache.get('key', urls[0])
+        # the least recently used response is evicted
+        cache.store('key', urls[2], _response(200, {'ETag': urls[2]}))
+        self.assertTrue(cache.get('key', urls[0]))
+        self.assertIsNone(cache.get('key', urls[1]))
+        # responses without validator are not cached
+        cache.store('key', urls[1], _response(200))
+        self.assertIsNone(cache.get('key', urls[1]))
+
+    def test_shared_sessions(self):
+        self.assertIs(GithubClient(self.client.token).session, self.client.session)
+        self.assertIsNot(GithubClient(self.client.token, host='api.example.com').session, self.client.session)
+
+    def test_database_rate_limits(self):
+        key = token_key('test_token_db_%s' % time.time())
+
+        def cleanup():
+            with sql_db.db_connect(self.env.cr.dbname).cursor() as cr:
+                cr.execute("DELETE FROM runbot_github_rate_limit WHERE token_key = %s", [key])
+        self.addCleanup(cleanup)
+
+        reset_at = int(time.time()) + 10
+        limits = RateLimits(self.env.cr.dbname)
+        limits.record(key, _response(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset_at)}), 0.5)
+        limits.record(key, _response(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': str(reset_at)}), 1.5)
+        # the second request is only counted in memory until the next synchronisation
+        limits.state.sync(force=True)
+        # another process sees the exhausted budget
+        with patch.dict('odoo.addons.runbot_github.github._states', clear=True):
+            self.assertGreater(RateLimits(self.env.cr.dbname).wait_time(key), 5)
+        with sql_db.db_connect(self.env.cr.dbname).cursor() as cr:
+            token_metrics, = [row for row in metrics(cr) if row['token_key'] == key]
+        self.assertEqual(token_metrics['request_count'], 2)
+        self.assertEqual(token_metrics['mean_latency'], 1)
+
+    def test_database_response_cache(self):
+        key = token_key('test_token_db_%s' % time.time())
+        url = 'https://api.github.com/test_db_cache'
+
+        def cleanup():
+            with sql_db.db_connect(self.env.cr.dbname).cursor() as cr:
+                cr.execute("DELETE FROM runbot_github_response WHERE token_key = %s", [key])
+        self.addCleanup(cleanup)
+
+        cache = ResponseCache(self.env.cr.dbname)
+        self.assertIsNone(cache.get(key, url))
+        cache.store(key, url, _response(200, {'ETag': '"abc"', 'Content-Type': 'application/json'}, b'{"number": 1}'))
+        # served from memory until the next synchronisation
+        self.assertEqual(cache.get(key, url)[0], '"abc"')
+        cache.state.sync(force=True)
+        # another process reads it from the database
+        with patch.dict('odoo.addons.runbot_github.github._states', clear=True):
+            etag, _, headers, body = ResponseCache(self.env.cr.dbname).get(key, url)
+        self.assertEqual(etag, '"abc"')
+        self.assertEqual(headers['Content-Type'], 'application/json')
+        self.assertEqual(body, b'{"number": 1}')
@@ -1,7 +1,7 @@
 {
     'name': 'merge bot',
     'version': '1.7',
-    'depends': ['contacts', 'website'],
+    'depends': ['contacts', 'website', 'runbot_github'],
     'data': [
         'security/security.xml',
         'security/ir.model.access.csv',
@@ -14,6 +14,7 @@ import requests
 import werkzeug.urls
 
 import odoo.netsvc
+from odoo.addons.runbot_github.github import GithubClient
 from odoo.tools import topological_sort, config
 from . import exceptions, utils
 
@@ -56,12 +57,15 @@ GH_LOG_PATTERN = """=> {method} /{self._repo}/{path}{qs}{body}
 ^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^
 """
 class GH(object):
-    def __init__(self, token, repo):
+    def __init__(self, token, repo, dbname=None):
         self._url = 'https://api.github.com'
         self._repo = repo
-        session = self._session = requests.Session()
-        session.headers['Authorization'] = 'token {}'.format(token)
-        session.headers['Accept'] = 'application/vnd.github.symmetra-preview+json'
+        # sessions are pooled by token, the rate limits and GET responses are
+        # shared with the other processes (and runbot) through the database
+        # when dbname is given, unchanged resources (pr, comments, reviews,
+        # commits, statuses...) being revalidated with their ETag
+        self._client = GithubClient(token, dbname=dbname, cache=True)
+        self._headers = {'Accept': 'application/vnd.github.symmetra-preview+json'}
 
     def _log_gh(self, logger, method, path, params, json, response, level=logging.INFO):
         """ Logs a pair of request / response to github, to the specified
@@ -106,11 +110,12 @@ class GH(object):
         """
         :type check: bool | dict[int:Exception]
         """
-        r = self._session.request(
+        r = self._client.request(
             method,
             '{}/repos/{}/{}'.format(self._url, self._repo, path),
             params=params,
-            json=json
+            json=json,
+            headers=self._headers,
         )
         self._log_gh(_gh, method, path, params, json, r)
         if check:
@@ -130,7 +135,7 @@ class GH(object):
         return r
 
     def user(self, username):
-        r = self._session.get("{}/users/{}".format(self._url, username))
+        r = self._client.request('GET', "{}/users/{}".format(self._url, username), headers=self._headers)
         r.raise_for_status()
         return r.json()
 
@@ -95,7 +95,7 @@ All substitutions are tentatively applied sequentially to the input.
         return super().write(vals)
 
     def github(self, token_field='github_token'):
-        return github.GH(self.project_id[token_field], self.name)
+        return github.GH(self.project_id[token_field], self.name, dbname=self.env.cr.dbname)
 
     def _auto_init(self):
         res = super(Repository, self)._auto_init()
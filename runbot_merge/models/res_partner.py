@@ -39,7 +39,7 @@ class Partner(models.Model):
     def fetch_github_email(self):
         # this requires a token in order to fetch the email field, otherwise
         # it's just not returned, select a random project to fetch
-        gh = github.GH(random.choice(self.env['runbot_merge.project'].search([])).github_token, None)
+        gh = github.GH(random.choice(self.env['runbot_merge.project'].search([])).github_token, None, dbname=self.env.cr.dbname)
         for p in self.filtered(lambda p: p.github_login and p.email is False):
             p.email = gh.user(p.github_login)['email'] or False
         return False